@@ -1,13 +1,37 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Response
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import asyncio
+import copy
+import hashlib
+import heapq
+import itertools
+import re
+import socket
+import sqlite3
+import queue
+import struct
 import threading
 import time
+import unicodedata
 import uuid
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
 from segment_anything.utils.transforms import ResizeLongestSide
+from segment_anything.utils.amg import (
+    MaskData,
+    area_from_rle,
+    batch_iterator,
+    box_xyxy_to_xywh,
+    build_point_grid,
+    rle_to_mask,
+)
+from torchvision.ops.boxes import batched_nms
 import torch
 from PIL import Image
 import numpy as np
@@ -16,6 +40,24 @@ from io import BytesIO
 import os
 import cv2
 import json
+from mask_utils import (
+    cropped_rle_to_full,
+    decode_masks_binary,
+    decode_rgb_image,
+    encode_masks_binary,
+    fill_mask_holes,
+    image_content_hash,
+    iter_segment_everything_results,
+    mask_bbox,
+    mask_record_to_json,
+    masks_to_rle,
+    remove_mask_islands,
+    resize_to_work_size,
+    rle_counts,
+    to_work_crops,
+    work_size_scale,
+    work_size_shape,
+)
 
 # --- Vertex AI：憑證須在 import vertexai 之前設定 GOOGLE_APPLICATION_CREDENTIALS ---
 _APP_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -187,23 +229,828 @@ def _veo_print_request_debug(label: str, payload: dict) -> None:
     print(f"\n=== Veo 請求除錯 ({label}) ===\n{json.dumps(payload, ensure_ascii=False, indent=2)}\n=== 結束 ===\n")
 
 
-# 非同步影片任務（記憶體內；重啟服務後 job_id 失效）
-_video_jobs_lock = threading.Lock()
-_video_jobs: dict = {}
+# 服務的本機資料目錄（影片任務資料庫、圖片工作階段暫存等；多個 worker 進程共用）
+LAYOUT_CUT_DATA_DIR = os.environ.get("LAYOUT_CUT_DATA_DIR", os.path.join(_APP_DIR, "data"))
+os.makedirs(LAYOUT_CUT_DATA_DIR, exist_ok=True)
+
+# 影片任務保留期限（秒，依最後存取時間）與影片檔總容量上限；超過時先淘汰最久未存取的影片
+VIDEO_JOB_TTL_SEC = int(os.environ.get("VIDEO_JOB_TTL_SEC", str(7 * 24 * 3600)))
+VIDEO_STORE_MAX_BYTES = int(os.environ.get("VIDEO_STORE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# 進行中任務的租約秒數：持有者每次輪詢時續約；逾期未續約（例如進程已結束）即可由其他進程接手
+VIDEO_JOB_LEASE_SEC = int(os.environ.get("VIDEO_JOB_LEASE_SEC", "60"))
+
+# 本進程識別碼（寫入任務的 owner 欄位，用於租約）
+_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_VIDEO_JOB_COLUMNS = (
+    "job_id",
+    "status",
+    "message",
+    "prompt",
+    "error",
+    "video_mime_type",
+    "video_url",
+    "video_sha256",
+    "video_size",
+    "gcp_operation_name",
+    "request_key",
+    "owner",
+    "lease_until",
+    "created_at",
+    "updated_at",
+    "last_access",
+)
+
+_VIDEO_JOB_ACTIVE_STATUSES = ("pending", "running")
+
+_VIDEO_EXTENSIONS = {"video/mp4": ".mp4", "video/webm": ".webm", "video/quicktime": ".mov"}
+
+# 剛寫入、尚未記錄到資料表的影片檔不會被當成孤兒刪除（秒）
+_VIDEO_ORPHAN_GRACE_SEC = 600
+
+
+class _VideoJobStore:
+    """
+    影片任務存放：中繼資料存於 SQLite（WAL 模式），影片本體以內容雜湊（sha256）命名寫入
+    videos/ 目錄，資料表只記錄雜湊與大小；相同內容的影片只存一份。
+    多個 worker 進程共用：POST /generate-video 與 GET /video-status 打到不同 worker 也能查到同一個任務。
+    每個執行緒各自持有連線（sqlite3 連線不可跨執行緒共用）。
+    """
+
+    def __init__(self, db_path: str, video_dir: str, ttl_sec: int, max_bytes: int):
+        self.db_path = db_path
+        self.video_dir = video_dir
+        self.ttl_sec = ttl_sec
+        self.max_bytes = max_bytes
+        # 任務更新成功後呼叫 on_change(job_id)（可能在任意執行緒），用於推播狀態給 SSE 連線
+        self.on_change = None
+        self._local = threading.local()
+        os.makedirs(video_dir, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS video_jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                message TEXT,
+                prompt TEXT,
+                error TEXT,
+                video_mime_type TEXT,
+                video_url TEXT,
+                video_sha256 TEXT,
+                video_size INTEGER,
+                gcp_operation_name TEXT,
+                request_key TEXT,
+                owner TEXT,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                last_access REAL
+            )
+            """
+        )
+        self._migrate(conn)
+        conn.execute("CREATE INDEX IF NOT EXISTS video_jobs_status ON video_jobs (status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS video_jobs_sha256 ON video_jobs (video_sha256)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS video_jobs_request_key ON video_jobs (request_key, created_at)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        """補上舊版資料表缺少的欄位；舊版存在 video_bytes BLOB 的影片搬到 videos/ 目錄。"""
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(video_jobs)")}
+        for col, decl in (
+            ("video_sha256", "TEXT"),
+            ("video_size", "INTEGER"),
+            ("request_key", "TEXT"),
+            ("owner", "TEXT"),
+            ("lease_until", "REAL"),
+            ("last_access", "REAL"),
+        ):
+            if col not in existing:
+                conn.execute(f"ALTER TABLE video_jobs ADD COLUMN {col} {decl}")
+        if "video_bytes" not in existing:
+            return
+        rows = conn.execute(
+            "SELECT job_id, video_bytes, video_mime_type FROM video_jobs "
+            "WHERE video_bytes IS NOT NULL AND video_sha256 IS NULL"
+        ).fetchall()
+        for row in rows:
+            sha, size = self.write_video([row["video_bytes"]], row["video_mime_type"])
+            conn.execute(
+                "UPDATE video_jobs SET video_sha256 = ?, video_size = ?, video_bytes = NULL "
+                "WHERE job_id = ?",
+                (sha, size, row["job_id"]),
+            )
+
+    def video_path(self, sha256: str, mime_type: Optional[str]) -> str:
+        ext = _VIDEO_EXTENSIONS.get((mime_type or "").lower(), ".bin")
+        return os.path.join(self.video_dir, sha256 + ext)
+
+    def write_video(self, chunks, mime_type: Optional[str], verify=None) -> tuple[str, int]:
+        """
+        將分段的影片位元組寫入暫存檔，邊寫邊計算 sha256，完成後以內容雜湊命名（os.replace，
+        避免讀到寫一半的檔案；相同內容已存在則直接沿用並更新 mtime）。不在記憶體中保留整個影片。
+        verify 在改名前呼叫（例如檢查下載的校驗碼），拋出例外時捨棄暫存檔。回傳 (sha256, 位元組數)。
+        改名在 SQLite 寫入鎖內進行，與 evict 清除孤兒檔互斥：回傳的檔案在任務引用前都在寬限期內。
+        """
+        sha = hashlib.sha256()
+        size = 0
+        tmp = os.path.join(self.video_dir, f"{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if verify is not None:
+                verify()
+            digest = sha.hexdigest()
+            path = self.video_path(digest, mime_type)
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if os.path.exists(path):
+                    # 沿用的檔案可能已無任務引用，更新 mtime 才不會在 complete_with_video 前被 evict 刪除
+                    os.utime(path)
+                    os.remove(tmp)
+                else:
+                    os.replace(tmp, path)
+            finally:
+                conn.execute("COMMIT")
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        return digest, size
+
+    def create(self, job_id: str, **fields) -> None:
+        """建立任務；由本進程持有租約（重啟後可由其他進程接手輪詢）。"""
+        self._insert(self._conn(), job_id, fields)
+
+    def create_or_attach(self, job_id: str, request_key: str, **fields) -> tuple[dict, bool]:
+        """
+        以 request_key 去重建立任務：已有相同鍵的進行中任務，或影片檔仍在的已完成任務時，
+        回傳 (該任務, False)；否則建立新任務並回傳 (新任務, True)。
+        以 BEGIN IMMEDIATE 交易進行，多個 worker 同時收到相同請求時也只會建立一個任務。
+        """
+        conn = self._conn()
+        cols = ", ".join(_VIDEO_JOB_COLUMNS)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT {cols} FROM video_jobs WHERE request_key = ? "
+                "AND status IN ('pending', 'running', 'completed') ORDER BY created_at DESC",
+                (request_key,),
+            ).fetchall()
+            for row in rows:
+                job = dict(row)
+                if job["status"] == "completed" and self.get_video_path(job) is None:
+                    continue
+                conn.execute(
+                    "UPDATE video_jobs SET last_access = ? WHERE job_id = ?",
+                    (time.time(), job["job_id"]),
+                )
+                conn.execute("COMMIT")
+                return job, False
+            self._insert(conn, job_id, {**fields, "request_key": request_key})
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get(job_id), True
+
+    def _insert(self, conn: sqlite3.Connection, job_id: str, fields: dict) -> None:
+        now = time.time()
+        row = {
+            "job_id": job_id,
+            "owner": _WORKER_ID,
+            "lease_until": now + VIDEO_JOB_LEASE_SEC,
+            "created_at": now,
+            "updated_at": now,
+            "last_access": now,
+            **fields,
+        }
+        cols = ", ".join(row)
+        marks = ", ".join("?" for _ in row)
+        conn.execute(f"INSERT INTO video_jobs ({cols}) VALUES ({marks})", tuple(row.values()))
+
+    def update(self, job_id: str, active_only: bool = False, **fields) -> bool:
+        """
+        更新欄位；任務不存在時回傳 False。進行中的任務順帶續約。
+        active_only=True 時只更新仍為 pending / running 的任務（已取消的任務不會被覆寫回來）。
+        """
+        unknown = set(fields) - set(_VIDEO_JOB_COLUMNS)
+        if unknown:
+            raise ValueError(f"未知的任務欄位: {sorted(unknown)}")
+        now = time.time()
+        fields["updated_at"] = now
+        if fields.get("status") not in ("completed", "failed", "cancelled"):
+            fields.setdefault("lease_until", now + VIDEO_JOB_LEASE_SEC)
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        where = "job_id = ?"
+        params = [*fields.values(), job_id]
+        if active_only:
+            where += f" AND status IN ({', '.join('?' for _ in _VIDEO_JOB_ACTIVE_STATUSES)})"
+            params.extend(_VIDEO_JOB_ACTIVE_STATUSES)
+        cur = self._conn().execute(f"UPDATE video_jobs SET {assignments} WHERE {where}", params)
+        updated = cur.rowcount > 0
+        if updated and self.on_change is not None:
+            self.on_change(job_id)
+        return updated
+
+    def renew_leases(self, job_ids) -> None:
+        """替本進程持有的進行中任務續約（排隊或長間隔輪詢期間避免被其他進程接手）。"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        marks = ", ".join("?" for _ in job_ids)
+        self._conn().execute(
+            f"UPDATE video_jobs SET lease_until = ? WHERE owner = ? AND job_id IN ({marks})",
+            (time.time() + VIDEO_JOB_LEASE_SEC, _WORKER_ID, *job_ids),
+        )
+
+    def complete_with_video(self, job_id: str, sha: str, size: int, mime_type: str) -> bool:
+        """以 write_video 寫好的影片將任務標記為 completed；任務已取消或不存在時回傳 False。"""
+        ok = self.update(
+            job_id,
+            active_only=True,
+            status="completed",
+            message="完成",
+            video_sha256=sha,
+            video_size=size,
+            video_mime_type=mime_type,
+            video_url=f"/video-result/{job_id}",
+            lease_until=None,
+        )
+        self.evict()
+        return ok
+
+    def get(self, job_id: str, touch: bool = False) -> Optional[dict]:
+        """讀取任務中繼資料；touch=True 時更新最後存取時間（影響 TTL 與容量淘汰順序）。"""
+        conn = self._conn()
+        if touch:
+            conn.execute(
+                "UPDATE video_jobs SET last_access = ? WHERE job_id = ?", (time.time(), job_id)
+            )
+        cols = ", ".join(_VIDEO_JOB_COLUMNS)
+        row = conn.execute(
+            f"SELECT {cols} FROM video_jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_video_path(self, job: dict) -> Optional[str]:
+        """回傳已完成任務的影片檔路徑；檔案不存在時回傳 None。"""
+        if not job.get("video_sha256"):
+            return None
+        path = self.video_path(job["video_sha256"], job.get("video_mime_type"))
+        return path if os.path.exists(path) else None
+
+    def claim_orphans(self) -> list[dict]:
+        """
+        接手租約已過期的進行中任務（原持有進程已重啟或結束），回傳接手成功的任務。
+        以條件式 UPDATE 搶租約，多個 worker 同時啟動時每個任務只會被一個進程接手。
+        """
+        now = time.time()
+        conn = self._conn()
+        placeholders = ", ".join("?" for _ in _VIDEO_JOB_ACTIVE_STATUSES)
+        candidates = conn.execute(
+            f"SELECT job_id FROM video_jobs WHERE status IN ({placeholders}) "
+            "AND (lease_until IS NULL OR lease_until < ?)",
+            (*_VIDEO_JOB_ACTIVE_STATUSES, now),
+        ).fetchall()
+        claimed = []
+        for row in candidates:
+            cur = conn.execute(
+                f"UPDATE video_jobs SET owner = ?, lease_until = ?, updated_at = ? "
+                f"WHERE job_id = ? AND status IN ({placeholders}) "
+                "AND (lease_until IS NULL OR lease_until < ?)",
+                (
+                    _WORKER_ID,
+                    now + VIDEO_JOB_LEASE_SEC,
+                    now,
+                    row["job_id"],
+                    *_VIDEO_JOB_ACTIVE_STATUSES,
+                    now,
+                ),
+            )
+            if cur.rowcount > 0:
+                claimed.append(self.get(row["job_id"]))
+        return claimed
+
+    def evict(self) -> dict:
+        """
+        淘汰過期任務與影片：已結束且超過 TTL 未存取的任務刪除；影片總量超過上限時，
+        依最後存取時間由舊到新刪除任務，直到總量回到上限內；最後清掉無任務引用的影片檔。
+        """
+        now = time.time()
+        conn = self._conn()
+        cur = conn.execute(
+            "DELETE FROM video_jobs WHERE status NOT IN ('pending', 'running') "
+            "AND COALESCE(last_access, updated_at) < ?",
+            (now - self.ttl_sec,),
+        )
+        expired = cur.rowcount
+
+        rows = conn.execute(
+            "SELECT video_sha256, MAX(video_size) AS size, "
+            "MAX(COALESCE(last_access, updated_at)) AS accessed "
+            "FROM video_jobs WHERE video_sha256 IS NOT NULL "
+            "GROUP BY video_sha256 ORDER BY accessed ASC"
+        ).fetchall()
+        total = sum(int(r["size"] or 0) for r in rows)
+        evicted = 0
+        for r in rows:
+            if total <= self.max_bytes:
+                break
+            cur = conn.execute("DELETE FROM video_jobs WHERE video_sha256 = ?", (r["video_sha256"],))
+            evicted += cur.rowcount
+            total -= int(r["size"] or 0)
+
+        # 持有寫入鎖清除孤兒檔：write_video 的沿用／改名不會夾在檢查 mtime 與刪除之間
+        removed_files = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            referenced = {
+                r["video_sha256"]
+                for r in conn.execute(
+                    "SELECT DISTINCT video_sha256 FROM video_jobs WHERE video_sha256 IS NOT NULL"
+                )
+            }
+            try:
+                entries = list(os.scandir(self.video_dir))
+            except OSError:
+                entries = []
+            for entry in entries:
+                sha = entry.name.split(".", 1)[0]
+                if sha in referenced:
+                    continue
+                try:
+                    if now - entry.stat().st_mtime < _VIDEO_ORPHAN_GRACE_SEC:
+                        continue
+                    os.remove(entry.path)
+                    removed_files += 1
+                except OSError:
+                    pass
+        finally:
+            conn.execute("COMMIT")
+        return {
+            "expired_jobs": expired,
+            "evicted_jobs": evicted,
+            "removed_files": removed_files,
+            "video_bytes": total,
+        }
+
+
+# 非同步影片任務（SQLite + 影片檔；跨 worker 共用，重啟後仍可查詢並接續進行中的任務）
+_video_job_store = _VideoJobStore(
+    os.path.join(LAYOUT_CUT_DATA_DIR, "video_jobs.sqlite3"),
+    os.path.join(LAYOUT_CUT_DATA_DIR, "videos"),
+    VIDEO_JOB_TTL_SEC,
+    VIDEO_STORE_MAX_BYTES,
+)
+
+# 輪詢 Google 長時間作業的間隔（秒）：自初始值起每次乘以倍率，直到上限
+VEO_POLL_INITIAL_SEC = float(os.environ.get("VEO_POLL_INITIAL_SEC", "8"))
+VEO_POLL_MAX_SEC = float(os.environ.get("VEO_POLL_MAX_SEC", "30"))
+VEO_POLL_BACKOFF = float(os.environ.get("VEO_POLL_BACKOFF", "1.5"))
+# 輪詢連續失敗（網路錯誤、配額限制等）幾次後判定任務失敗
+VEO_POLL_MAX_ERRORS = int(os.environ.get("VEO_POLL_MAX_ERRORS", "5"))
+# 本進程同時進行的 Veo API 呼叫上限與兩次呼叫的最短間隔（秒），避免觸發配額限制
+VEO_API_CONCURRENCY = int(os.environ.get("VEO_API_CONCURRENCY", "4"))
+VEO_API_MIN_INTERVAL_SEC = float(os.environ.get("VEO_API_MIN_INTERVAL_SEC", "0.2"))
+
+
+# SAM image encoder 輸出快取上限（同一張圖反覆圈選時可略過 encoder；ViT-B 每張約 4 MB）
+SAM_EMBEDDING_CACHE_MAX_BYTES = int(
+    os.environ.get("SAM_EMBEDDING_CACHE_MAX_BYTES", str(512 * 1024 * 1024))
+)
+SAM_EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("SAM_EMBEDDING_CACHE_MAX_ENTRIES", "64"))
+
+
+class _EmbeddingCache:
+    """以圖片內容雜湊為鍵的 SamPredictor 嵌入快取（LRU，依位元組總量與筆數淘汰）。"""
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: dict) -> None:
+        nbytes = int(entry.get("nbytes", 0))
+        if nbytes > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old["nbytes"]
+            self._entries[key] = entry
+            self._bytes += nbytes
+            while self._entries and (
+                self._bytes > self.max_bytes or len(self._entries) > self.max_entries
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted["nbytes"]
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+_embedding_cache = _EmbeddingCache(SAM_EMBEDDING_CACHE_MAX_BYTES, SAM_EMBEDDING_CACHE_MAX_ENTRIES)
+
+
+def _set_image_with_cache(
+    sam_predictor, content_hash: str, image: np.ndarray, session: Optional[dict] = None
+) -> bool:
+    """
+    等同 sam_predictor.set_image(image)，但若同一內容、同一尺寸的嵌入已在快取中，
+    直接還原 features / input_size / original_size，只需再跑 prompt encoder 與 mask decoder。
+    若提供圖片工作階段（session），嵌入也會掛在該工作階段上，存活期間不受 LRU 淘汰影響。
+    回傳是否命中快取。
+    """
+    key = f"{content_hash}:{image.shape[0]}x{image.shape[1]}"
+    entry = session["embeddings"].get(key) if session is not None else None
+    if entry is None:
+        entry = _embedding_cache.get(key)
+    if entry is not None:
+        sam_predictor.reset_image()
+        sam_predictor.features = entry["features"]
+        sam_predictor.input_size = entry["input_size"]
+        sam_predictor.original_size = entry["original_size"]
+        sam_predictor.is_image_set = True
+        if session is not None:
+            session["embeddings"][key] = entry
+        return True
+
+    sam_predictor.set_image(image)
+    features = sam_predictor.features
+    entry = {
+        "features": features,
+        "input_size": tuple(sam_predictor.input_size),
+        "original_size": tuple(sam_predictor.original_size),
+        "nbytes": features.element_size() * features.nelement(),
+    }
+    _embedding_cache.put(key, entry)
+    if session is not None:
+        session["embeddings"][key] = entry
+    return False
+
+
+# 圖片工作階段：POST /images 上傳一次，之後各分割端點以 image_id 取代重複上傳與解碼
+IMAGE_SESSION_TTL_SEC = int(os.environ.get("IMAGE_SESSION_TTL_SEC", "1800"))
+IMAGE_SESSION_MAX = int(os.environ.get("IMAGE_SESSION_MAX", "32"))
+
+_image_sessions_lock = threading.Lock()
+_image_sessions: "OrderedDict[str, dict]" = OrderedDict()
+
+
+def _evict_image_sessions_locked(now: float) -> None:
+    """移除過期（TTL）與超出數量上限的工作階段；呼叫端須持有 _image_sessions_lock。"""
+    expired = [
+        sid
+        for sid, sess in _image_sessions.items()
+        if now - sess["last_access"] > IMAGE_SESSION_TTL_SEC
+    ]
+    for sid in expired:
+        del _image_sessions[sid]
+    while len(_image_sessions) > max(IMAGE_SESSION_MAX, 1):
+        _image_sessions.popitem(last=False)
+
+
+# 原圖另存一份於資料目錄，其他 worker 進程收到同一 image_id 時可自行載入
+_IMAGE_SPOOL_DIR = os.path.join(LAYOUT_CUT_DATA_DIR, "images")
+os.makedirs(_IMAGE_SPOOL_DIR, exist_ok=True)
+_IMAGE_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+
+def _image_spool_path(image_id: str) -> str:
+    return os.path.join(_IMAGE_SPOOL_DIR, image_id)
+
+
+def _write_image_spool(image_id: str, image_data: bytes) -> None:
+    path = _image_spool_path(image_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(image_data)
+    os.replace(tmp_path, path)
+
+
+def _touch_image_spool(image_id: str) -> bool:
+    """更新暫存原圖的 mtime（跨 worker 的閒置 TTL 以此計算）；檔案不存在時回傳 False。"""
+    try:
+        os.utime(_image_spool_path(image_id))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _sweep_image_spool(now: float) -> None:
+    """刪除閒置超過 TTL 的暫存原圖。"""
+    with os.scandir(_IMAGE_SPOOL_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime > IMAGE_SESSION_TTL_SEC:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def _new_image_session(image_id: str, content_hash: str, image_array: np.ndarray, now: float) -> dict:
+    # 工作階段內的陣列會被多個請求共用，設為唯讀避免被意外就地修改
+    image_array.setflags(write=False)
+    return {
+        "image_id": image_id,
+        "content_hash": content_hash,
+        "array": image_array,
+        "embeddings": {},
+        "created_at": now,
+        "last_access": now,
+    }
+
+
+def _create_image_session(image_data: bytes) -> dict:
+    """解碼圖片並建立工作階段；相同內容已有工作階段時直接沿用並延長期限。"""
+    content_hash = image_content_hash(image_data)
+    now = time.time()
+    with _image_sessions_lock:
+        _evict_image_sessions_locked(now)
+        existing = next(
+            (sess for sess in _image_sessions.values() if sess["content_hash"] == content_hash),
+            None,
+        )
+        if existing is not None:
+            existing["last_access"] = now
+            _image_sessions.move_to_end(existing["image_id"])
+    if existing is not None:
+        if not _touch_image_spool(existing["image_id"]):
+            _write_image_spool(existing["image_id"], image_data)
+        return existing
+
+    session = _new_image_session(uuid.uuid4().hex, content_hash, decode_rgb_image(image_data), now)
+    _write_image_spool(session["image_id"], image_data)
+    _sweep_image_spool(now)
+    with _image_sessions_lock:
+        _image_sessions[session["image_id"]] = session
+        _evict_image_sessions_locked(now)
+    return session
+
+
+def _get_image_session(image_id: str) -> Optional[dict]:
+    """
+    取得工作階段：先查本進程記憶體，查無時從資料目錄載入其他 worker 建立的原圖。
+    會解碼圖片，請在執行緒池中呼叫。
+    """
+    now = time.time()
+    with _image_sessions_lock:
+        _evict_image_sessions_locked(now)
+        session = _image_sessions.get(image_id)
+        if session is not None:
+            session["last_access"] = now
+            _image_sessions.move_to_end(image_id)
+    if session is not None:
+        _touch_image_spool(image_id)
+        return session
+
+    if not _IMAGE_ID_RE.fullmatch(image_id):
+        return None
+    path = _image_spool_path(image_id)
+    try:
+        if now - os.path.getmtime(path) > IMAGE_SESSION_TTL_SEC:
+            return None
+        with open(path, "rb") as f:
+            image_data = f.read()
+    except FileNotFoundError:
+        return None
+
+    session = _new_image_session(
+        image_id, image_content_hash(image_data), decode_rgb_image(image_data), now
+    )
+    _touch_image_spool(image_id)
+    with _image_sessions_lock:
+        session = _image_sessions.setdefault(image_id, session)
+        _evict_image_sessions_locked(now)
+    return session
+
+
+async def _read_image_input(
+    file: Optional[UploadFile], image_id: Optional[str]
+) -> tuple[np.ndarray, str, Optional[dict]]:
+    """
+    取得分割輸入圖：有 image_id 時使用對應的工作階段，否則讀取上傳檔案。
+    回傳 (RGB array, 內容雜湊, 工作階段或 None)。
+    """
+    if image_id:
+        session = await run_in_threadpool(_get_image_session, image_id)
+        if session is None:
+            raise HTTPException(
+                status_code=404,
+                detail="找不到此 image_id（可能已過期），請重新以 POST /images 上傳",
+            )
+        return session["array"], session["content_hash"], session
+
+    if file is None:
+        raise HTTPException(status_code=400, detail="需提供 file 或 image_id")
+    if not file.content_type or not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="只接受圖片文件")
+    image_data = await file.read()
+    image_array = await run_in_threadpool(decode_rgb_image, image_data)
+    return image_array, image_content_hash(image_data), None
+
+
+# SAM 推論執行器：CPU 密集工作移出 event loop；同時推論數與排隊深度皆有上限
+SAM_INFERENCE_CONCURRENCY = max(1, int(os.environ.get("SAM_INFERENCE_CONCURRENCY", "1")))
+SAM_INFERENCE_MAX_QUEUE = max(0, int(os.environ.get("SAM_INFERENCE_MAX_QUEUE", "8")))
+
+
+class _InferenceExecutor:
+    """
+    有界的推論執行緒池。執行中 + 排隊中的工作數超過上限時直接回 503（附 Retry-After），
+    避免請求在伺服器內無限堆積；event loop 只負責等待結果，不會被 SAM 或 OpenCV 卡住。
+    """
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sam-infer")
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _release(self, _future) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self.completed += 1
+
+    async def run(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="分割服務忙碌中，請稍後再試",
+                    headers={"Retry-After": "2"},
+                )
+            self._in_flight += 1
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self._in_flight -= 1
+            raise
+        # 以 done callback 釋放名額：即使用戶端中斷連線，仍在執行的工作也持續佔用名額直到結束
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+
+_inference_executor = _InferenceExecutor(SAM_INFERENCE_CONCURRENCY, SAM_INFERENCE_MAX_QUEUE)
+
+# SamPredictor 池大小：各 predictor 共用同一份 sam 權重，只各自保存 set_image 後的影像狀態
+SAM_PREDICTOR_POOL_SIZE = max(
+    1, int(os.environ.get("SAM_PREDICTOR_POOL_SIZE", str(SAM_INFERENCE_CONCURRENCY)))
+)
+
+
+class _PredictorPool:
+    """
+    SamPredictor 池。SamPredictor 的 set_image 會改寫自身狀態（features、尺寸），
+    因此每個請求須借出一個 predictor 獨佔使用，用完歸還；不同圖片的請求可同時進行。
+    """
+
+    def __init__(self, model, size: int):
+        self.size = size
+        self._available: "queue.Queue" = queue.Queue()
+        for _ in range(size):
+            self._available.put(SamPredictor(model))
+
+    @contextmanager
+    def checkout(self):
+        sam_predictor = self._available.get()
+        try:
+            yield sam_predictor
+        finally:
+            # 歸還前清掉影像狀態（嵌入仍保留在快取中），避免下一個借用者誤用上一張圖
+            sam_predictor.reset_image()
+            self._available.put(sam_predictor)
+
+    def stats(self) -> dict:
+        return {"size": self.size, "available": self._available.qsize()}
+
+
+def _mask_generator_with(sam_predictor) -> SamAutomaticMaskGenerator:
+    """複製全域 mask_generator 的設定，但改用借出的 predictor，讓自動分割也能並行。"""
+    generator = copy.copy(mask_generator)
+    generator.predictor = sam_predictor
+    return generator
+
+
+# 每個 worker 進程的 torch CPU 執行緒數；多 worker 時建議設為「核心數 / worker 數」避免互搶
+SAM_TORCH_THREADS = int(os.environ.get("SAM_TORCH_THREADS", "0"))
+
+
+def _load_sam_model(model_path: str, device):
+    """
+    載入 vit_b SAM 模型。CPU 上以 mmap 讀取權重並直接掛到模型上（assign=True），
+    權重頁面由作業系統的 page cache 提供且不會被寫入，多個 worker 進程共用同一份實體記憶體，
+    不必各自複製約 375 MB 的權重。舊版 torch 或檢查點格式不支援 mmap 時退回一般載入。
+    """
+    if SAM_TORCH_THREADS > 0:
+        torch.set_num_threads(SAM_TORCH_THREADS)
+
+    if device.type == "cpu":
+        try:
+            model = sam_model_registry["vit_b"](checkpoint=None)
+            state_dict = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+            model.load_state_dict(state_dict, assign=True)
+            model.eval()
+            print("SAM 權重以 mmap 載入（多個 worker 共用 page cache）")
+            return model
+        except (TypeError, RuntimeError) as e:
+            print(f"無法以 mmap 載入 SAM 權重，改用一般載入: {e}")
 
-# 輪詢 Google 長時間作業的間隔（秒）
-_VEO_POLL_INTERVAL_SEC = 8
+    model = sam_model_registry["vit_b"](checkpoint=model_path)
+    model.to(device=device)
+    return model
 
 
 # 全局變數存儲模型
 sam = None
 mask_generator = None
-predictor = None
+predictor_pool = None
+
+
+def _build_mask_generator(sam_model, points_per_side: int = 32) -> SamAutomaticMaskGenerator:
+    """全圖自動分割的 generator 設定：平衡速度與覆蓋率；無 GPU 時全圖自動分割仍可能較慢。"""
+    return SamAutomaticMaskGenerator(
+        sam_model,
+        points_per_side=points_per_side,
+        pred_iou_thresh=0.80,
+        stability_score_thresh=0.88,
+        crop_n_layers=0,
+        crop_n_points_downscale_factor=2,
+        min_mask_region_area=0,
+    )
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """在應用啟動時載入 SAM 模型"""
-    global sam, mask_generator, predictor
+    global sam, mask_generator, predictor_pool
     try:
         # 載入模型
         model_path = "./models/sam_vit_b_01ec64.pth"
@@ -212,31 +1059,30 @@ async def lifespan(app: FastAPI):
             print("服務將啟動，但無法進行圖片分割")
         else:
             device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-            sam = sam_model_registry["vit_b"](checkpoint=model_path)
-            sam.to(device=device)
-            # 平衡速度與覆蓋率；無 GPU 時全圖自動分割仍可能較慢
-            mask_generator = SamAutomaticMaskGenerator(
-                sam,
-                points_per_side=32,
-                pred_iou_thresh=0.80,
-                stability_score_thresh=0.88,
-                crop_n_layers=0,
-                crop_n_points_downscale_factor=2,
-                min_mask_region_area=0,
-            )
-            predictor = SamPredictor(sam)
+            sam = _load_sam_model(model_path, device)
+            mask_generator = _build_mask_generator(sam)
+            predictor_pool = _PredictorPool(sam, SAM_PREDICTOR_POOL_SIZE)
             print(f"SAM 模型載入成功，裝置: {device}")
     except Exception as e:
         print(f"載入模型時發生錯誤: {e}")
         print("服務將啟動，但無法進行圖片分割")
 
+    try:
+        evicted = await run_in_threadpool(_video_job_store.evict)
+        print(f"影片任務存放：淘汰 {evicted}")
+    except Exception as e:
+        print(f"整理影片任務時發生錯誤: {e}")
+    # 排程器啟動後會接手租約過期的進行中任務（例如重啟前尚未完成者）
+    await _veo_scheduler.start()
+
     print(
-        "提示：/generate-video 任務存在於單一進程記憶體。請勿使用多 Worker；"
-        "開發時若使用 uvicorn --reload，檔案變更重載後舊 job_id 會失效，需重新生成。"
+        f"提示：影片任務與圖片工作階段存於 {LAYOUT_CUT_DATA_DIR}，可使用多個 worker"
+        "（例如 uvicorn app:app --workers 4）；各 worker 以 mmap 共用模型權重。"
     )
 
     yield
-    
+
+    await _veo_scheduler.stop()
     # 清理資源（如果需要）
     print("應用關閉")
 
@@ -249,88 +1095,514 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "X-Image-Size", "X-RLE-Format", "X-Work-Scale", "X-Progressive-Grids", "X-Segment-Cache",
+        "Content-Range", "ETag",
+    ],
 )
 
 
-def mask_to_rle(segmentation: np.ndarray) -> dict:
+def _generate_masks_sorted(image_array: np.ndarray) -> list:
     """
-    將 boolean / 0-1 mask 轉成簡單 RLE（run-length encoding），以減少傳輸量。
-    格式為：
+    以 SamAutomaticMaskGenerator 產生所有 masks，並依 score（predicted_iou 為主）由大到小排序。
+    SamAutomaticMaskGenerator 會回傳一個 list，裡面每個元素是 dict，例如：
     {
-        "size": [height, width],
-        "counts": [run1, run2, ...]  # 按照 COCO 慣例，從第一個像素開始的連續長度交替表示 0/1
+      'segmentation': numpy.bool_[H, W],
+      'area': int,
+      'bbox': [x, y, w, h],
+      'predicted_iou': float,
+      'stability_score': float,
+      ...
     }
     """
-    if segmentation.dtype != np.uint8 and segmentation.dtype != bool:
-        segmentation = segmentation.astype(np.uint8)
+    # generator 內部的 predictor 有狀態，借用池中的 predictor 獨佔執行
+    with predictor_pool.checkout() as sam_predictor:
+        masks = _mask_generator_with(sam_predictor).generate(image_array)
+    return sorted(
+        masks,
+        key=lambda m: float(m.get("predicted_iou", m.get("stability_score", 0.0))),
+        reverse=True,
+    )
 
-    # 轉成 0/1 並攤平成一維向量（row-major）
-    if segmentation.dtype == bool:
-        arr = segmentation.astype(np.uint8)
-    else:
-        arr = (segmentation > 0).astype(np.uint8)
 
-    h, w = arr.shape[:2]
-    flat = arr.reshape(-1)
+# /segment-everything 的工作解析度（最長邊像素）：大於此值的圖片先縮小再自動分割，mask 只保留
+# bbox 視窗，輸出時才放大回原圖座標。0 表示以原圖解析度分割（請求可用 work_size 參數覆寫）
+SEGMENT_EVERYTHING_WORK_SIZE = int(os.environ.get("SEGMENT_EVERYTHING_WORK_SIZE", "0"))
 
-    # RLE 編碼
-    counts = []
-    prev = 0
-    run_len = 0
 
-    for v in flat:
-        if v == prev:
-            run_len += 1
-        else:
-            counts.append(run_len)
-            run_len = 1
-            prev = v
+def _generate_masks_at_work_size(image_array: np.ndarray, work_size: int) -> tuple[list, float]:
+    """
+    在工作解析度上執行 _generate_masks_sorted，回傳 (masks_sorted, scale)，scale 為工作解析度 / 原圖。
+    縮小時 mask 以 to_work_crops 的形式保存；不需縮小時照原樣回傳。
+    """
+    work_image, scale = resize_to_work_size(image_array, work_size)
+    if scale >= 1.0:
+        return _generate_masks_sorted(image_array), 1.0
+    return to_work_crops(_generate_masks_sorted(work_image), work_image.shape), scale
 
-    counts.append(run_len)
 
-    return {
-        "size": [int(h), int(w)],
-        "counts": [int(c) for c in counts],
-    }
+# 漸進式自動分割（/segment-everything?progressive=1）各輪的網格密度（每邊點數），由疏到密
+SEGMENT_EVERYTHING_PROGRESSIVE_GRIDS = tuple(
+    int(v) for v in os.environ.get("SEGMENT_EVERYTHING_PROGRESSIVE_GRIDS", "8,16,32").split(",") if v.strip()
+)
 
 
-def mask_to_polygon_flat(segmentation: np.ndarray) -> list:
+def _progressive_pass_sync(
+    image: np.ndarray,
+    content_hash: str,
+    image_session: Optional[dict],
+    points_per_side: int,
+    state: dict,
+) -> list:
     """
-    從二值 / bool mask 擷取最外層輪廓，回傳 Konva Line 可用的平坦座標 [x1,y1,x2,y2,...]。
-    若無有效輪廓則回傳空 list。
+    漸進式自動分割的一輪：以 points_per_side x points_per_side 的網格取點，略過已被先前 mask 覆蓋的點，
+    只對其餘的點執行 mask decoder。回傳本輪新增的 mask（格式同 SamAutomaticMaskGenerator.generate，
+    依 score 排序）；與本輪其他結果或先前結果重疊（box NMS）者捨棄。
+    state 保存跨輪的狀態：covered 為已接受 mask 的聯集、boxes 為其 xyxy box，本輪結果會併入。
+    圖片嵌入經由嵌入快取取得，只有第一輪需要執行 image encoder。
     """
-    if segmentation is None or segmentation.size == 0:
+    height, width = image.shape[:2]
+    points = build_point_grid(points_per_side) * np.array([[width, height]])
+    px = np.clip(points[:, 0].astype(int), 0, width - 1)
+    py = np.clip(points[:, 1].astype(int), 0, height - 1)
+    points = points[~state["covered"][py, px]]
+    if len(points) == 0:
         return []
 
-    if segmentation.dtype == bool:
-        mask_u8 = (segmentation.astype(np.uint8)) * 255
-    else:
-        mask_u8 = (segmentation > 0).astype(np.uint8) * 255
-
-    contours, _ = cv2.findContours(mask_u8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if not contours:
+    crop_box = [0, 0, width, height]
+    data = MaskData()
+    with predictor_pool.checkout() as predictor:
+        _set_image_with_cache(predictor, content_hash, image, session=image_session)
+        generator = _mask_generator_with(predictor)
+        for (batch,) in batch_iterator(generator.points_per_batch, points):
+            data.cat(generator._process_batch(batch, (height, width), crop_box, (height, width)))
+    if len(data["rles"]) == 0:
         return []
 
-    main = max(contours, key=cv2.contourArea)
-    if cv2.contourArea(main) < 1:
-        return []
+    # 先前的 box 以無限大分數參與 NMS，必定保留；只留下本輪未被壓掉的 mask
+    prev_boxes = state["boxes"]
+    boxes = torch.cat([prev_boxes, data["boxes"].float().cpu()])
+    scores = torch.cat([torch.full((len(prev_boxes),), float("inf")), data["iou_preds"].float().cpu()])
+    keep = batched_nms(boxes, scores, torch.zeros(len(boxes)), iou_threshold=generator.box_nms_thresh)
+    keep = keep[keep >= len(prev_boxes)] - len(prev_boxes)
+    data.filter(keep)
+    state["boxes"] = torch.cat([prev_boxes, data["boxes"].float().cpu()])
+    data.to_numpy()
+
+    masks = []
+    for idx, rle in enumerate(data["rles"]):
+        segmentation = rle_to_mask(rle)
+        state["covered"] |= segmentation
+        masks.append({
+            "segmentation": segmentation,
+            "area": area_from_rle(rle),
+            "bbox": box_xyxy_to_xywh(data["boxes"][idx]).tolist(),
+            "predicted_iou": data["iou_preds"][idx].item(),
+            "point_coords": [data["points"][idx].tolist()],
+            "stability_score": data["stability_score"][idx].item(),
+            "crop_box": box_xyxy_to_xywh(np.array(crop_box)).tolist(),
+        })
+    masks.sort(key=lambda m: m["predicted_iou"], reverse=True)
+    return masks
+
+
+async def _iter_progressive_lines(
+    image_array: np.ndarray,
+    content_hash: str,
+    image_session: Optional[dict],
+    work_size: int,
+    grids: tuple,
+    max_masks: int,
+    min_area: int,
+    rle_format: str,
+    min_hole_area: int,
+    min_island_area: int,
+):
+    """
+    依 grids 由疏到密逐輪執行 _progressive_pass_sync，每輪結果後處理完即以 NDJSON 送出
+    （每行另含 pass：第幾輪，從 1 開始）。每輪各自排入推論執行器，輪與輪之間可穿插其他請求。
+    """
+    work_image, scale = resize_to_work_size(image_array, work_size)
+    if scale < 1.0:
+        # 縮小後的圖與其他端點 resize 的圖尺寸可能相同但像素不同，嵌入快取的鍵需區分
+        content_hash = f"{content_hash}:work{work_size}"
+    state = {"covered": np.zeros(work_image.shape[:2], dtype=bool), "boxes": torch.zeros((0, 4))}
+
+    def encode_pass(masks: list, pass_index: int, limit: int) -> list:
+        if scale < 1.0:
+            to_work_crops(masks, work_image.shape)
+        lines = []
+        for record in iter_segment_everything_results(
+            masks, limit, min_area, rle_format, min_hole_area, min_island_area,
+            image_shape=image_array.shape,
+        ):
+            out = mask_record_to_json(record)
+            out["pass"] = pass_index
+            lines.append(json.dumps(out, ensure_ascii=False) + "\n")
+        return lines
+
+    produced = 0
+    for pass_index, points_per_side in enumerate(grids, start=1):
+        masks = await _inference_executor.run(
+            _progressive_pass_sync, work_image, content_hash, image_session, points_per_side, state
+        )
+        lines = await _inference_executor.run(encode_pass, masks, pass_index, max_masks - produced)
+        for line in lines:
+            yield line
+        produced += len(lines)
+        if produced >= max_masks:
+            break
+
+
+def _parse_progressive_grids(grids: Optional[str]) -> tuple:
+    """解析 grids 參數（逗號分隔的每邊點數，例如 "8,16,32"）；未指定時使用 SEGMENT_EVERYTHING_PROGRESSIVE_GRIDS。"""
+    if not grids:
+        return SEGMENT_EVERYTHING_PROGRESSIVE_GRIDS
+    try:
+        parsed = tuple(int(v) for v in grids.split(",") if v.strip())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"無效的 grids: {grids}") from e
+    if not parsed or any(not 1 <= n <= 64 for n in parsed):
+        raise HTTPException(status_code=400, detail="grids 須為 1 到 64 的整數，以逗號分隔")
+    return parsed
 
-    peri = cv2.arcLength(main, True)
-    epsilon = max(0.5, 0.001 * peri)
-    approx = cv2.approxPolyDP(main, epsilon, True)
 
-    if approx is None or len(approx) < 3:
-        return []
+# ?stream=1 時每次交給推論執行器後處理的筆數（補洞、去島、RLE、輪廓與快取寫入都在其中）
+_NDJSON_CHUNK_RECORDS = 16
+
+
+def _next_ndjson_chunk(records) -> list:
+    """從 records 迭代器取出下一批（至多 _NDJSON_CHUNK_RECORDS 筆）並轉成 NDJSON 行。"""
+    return [
+        json.dumps(mask_record_to_json(record), ensure_ascii=False) + "\n"
+        for record in itertools.islice(records, _NDJSON_CHUNK_RECORDS)
+    ]
+
+
+async def _iter_ndjson_lines(records, first_lines: list):
+    """
+    逐批送出 NDJSON 行：first_lines 為已處理好的第一批，之後每批都排入推論執行器，
+    與漸進式分割相同受同時推論數與排隊上限約束，不佔用 Starlette 的預設執行緒池。
+    """
+    lines = first_lines
+    while lines:
+        for line in lines:
+            yield line
+        if len(lines) < _NDJSON_CHUNK_RECORDS:
+            break
+        lines = await _inference_executor.run(_next_ndjson_chunk, records)
+
+
+# /segment-everything 的二進位回應格式（以 Accept 標頭協商，JSON 仍為預設）
+SEGMENT_MASKS_BINARY_MEDIA_TYPE = "application/x-layout-masks"
+_SEGMENT_MASKS_BINARY_ACCEPT = (SEGMENT_MASKS_BINARY_MEDIA_TYPE, "application/octet-stream")
+
+
+def _wants_binary_masks(accept: Optional[str]) -> bool:
+    """Accept 中明確列出二進位格式（且 q 不為 0）時才回傳二進位，其餘一律 JSON。"""
+    for media_range in (accept or "").split(","):
+        parts = [p.strip() for p in media_range.split(";")]
+        if parts[0].lower() not in _SEGMENT_MASKS_BINARY_ACCEPT:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            return True
+    return False
+
+
+# /segment-everything 結果快取：記憶體 LRU + 磁碟（多個 worker 共用），內容為 encode_masks_binary 的
+# cropped 格式。0 表示停用該層
+SEGMENT_CACHE_MAX_BYTES = int(os.environ.get("SEGMENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SEGMENT_CACHE_DISK_MAX_BYTES = int(os.environ.get("SEGMENT_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+
+_SEGMENT_CACHE_META = struct.Struct("<4sI")
+_SEGMENT_CACHE_MAGIC = b"LCSC"
+
+
+class _SegmentResultCache:
+    """
+    自動分割結果的兩層快取。每筆為 {"meta": dict, "payload": bytes}：payload 為二進位編碼的 masks，
+    meta 記錄產生時的 max_masks / min_area、是否因 max_masks 截斷，以及工作解析度比例。
+    磁碟檔案為 "LCSC" + u32 meta 長度 + meta JSON + payload，以 mtime 作為 LRU 順序。
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str, disk_max_bytes: int):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        if disk_max_bytes > 0:
+            os.makedirs(disk_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or self.disk_max_bytes > 0
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.lcsc")
+
+    def _remember(self, key: str, entry: dict) -> None:
+        nbytes = len(entry["payload"])
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old["payload"])
+            self._entries[key] = entry
+            self._bytes += nbytes
+            while self._entries and self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted["payload"])
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry
+        if self.disk_max_bytes > 0:
+            path = self._disk_path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)
+                magic, meta_len = _SEGMENT_CACHE_META.unpack_from(data, 0)
+                if magic == _SEGMENT_CACHE_MAGIC:
+                    start = _SEGMENT_CACHE_META.size
+                    entry = {
+                        "meta": json.loads(data[start:start + meta_len]),
+                        "payload": data[start + meta_len:],
+                    }
+                    self._remember(key, entry)
+                    with self._lock:
+                        self.disk_hits += 1
+                    return entry
+            except (OSError, ValueError, struct.error):
+                pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, meta: dict, payload: bytes) -> None:
+        entry = {"meta": meta, "payload": payload}
+        self._remember(key, entry)
+        if self.disk_max_bytes <= 0 or len(payload) > self.disk_max_bytes:
+            return
+        meta_bytes = json.dumps(meta).encode("utf-8")
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_SEGMENT_CACHE_META.pack(_SEGMENT_CACHE_MAGIC, len(meta_bytes)))
+            f.write(meta_bytes)
+            f.write(payload)
+        os.replace(tmp_path, path)
+        self._evict_disk()
+
+    def _disk_files(self) -> list:
+        files = []
+        with os.scandir(self.disk_dir) as entries:
+            for e in entries:
+                if e.name.endswith(".lcsc"):
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, e.path))
+        return files
+
+    def _evict_disk(self) -> None:
+        files = sorted(self._disk_files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.disk_max_bytes > 0:
+            for _, _, path in self._disk_files():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        disk_files = self._disk_files() if self.disk_max_bytes > 0 else []
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk_entries": len(disk_files),
+                "disk_bytes": sum(size for _, size, _ in disk_files),
+                "disk_max_bytes": self.disk_max_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": ((self.memory_hits + self.disk_hits) / lookups) if lookups else 0.0,
+            }
+
+
+_segment_result_cache = _SegmentResultCache(
+    SEGMENT_CACHE_MAX_BYTES,
+    os.path.join(LAYOUT_CUT_DATA_DIR, "segment_cache"),
+    SEGMENT_CACHE_DISK_MAX_BYTES,
+)
+
+
+def _segment_cache_key(image_hash: str, work_shape, min_hole_area: int, min_island_area: int) -> str:
+    """
+    結果快取的鍵：圖片內容雜湊、SamAutomaticMaskGenerator 的設定，以及會改變每個 mask 內容的參數。
+    解析度以實際分割的尺寸 work_shape（work_size_shape）表示，不同 work_size 只要結果相同（例如都不需縮小）就共用快取。
+    max_masks / min_area 不在鍵中，而是記在 meta，由 _segment_cache_lookup 判斷能否由快取過濾出結果。
+    """
+    generator = mask_generator
+    settings = {
+        "image": image_hash,
+        "model": "vit_b",
+        "points": [len(grid) for grid in generator.point_grids],
+        "points_per_batch": generator.points_per_batch,
+        "pred_iou_thresh": generator.pred_iou_thresh,
+        "stability_score_thresh": generator.stability_score_thresh,
+        "stability_score_offset": generator.stability_score_offset,
+        "box_nms_thresh": generator.box_nms_thresh,
+        "crop_n_layers": generator.crop_n_layers,
+        "crop_nms_thresh": generator.crop_nms_thresh,
+        "crop_overlap_ratio": generator.crop_overlap_ratio,
+        "min_mask_region_area": generator.min_mask_region_area,
+        "work_shape": [int(v) for v in work_shape],
+        "min_hole_area": min_hole_area,
+        "min_island_area": min_island_area,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _segment_cache_lookup(key: str, max_masks: int, min_area: int, rle_format: str) -> Optional[tuple[list, float]]:
+    """
+    由快取取得結果並依本次請求過濾，回傳 (records, scale)；無法由快取滿足時回傳 None。
+    快取的 records 依 score 排序，是「面積 >= meta.min_area 的結果」的前 meta.max_masks 筆；
+    min_area 不小於快取時，依本次 min_area 過濾後的前 max_masks 筆必與重新計算相同，
+    只要數量已足夠或快取當時沒有被 max_masks 截斷。
+    """
+    entry = _segment_result_cache.get(key)
+    if entry is None:
+        return None
+    meta = entry["meta"]
+    if min_area < meta["min_area"]:
+        return None
+    records, _, image_size = decode_masks_binary(entry["payload"])
+    records = [r for r in records if r["area"] >= min_area][:max_masks]
+    if len(records) < max_masks and meta["truncated"]:
+        return None
+    if rle_format == "full":
+        for r in records:
+            r["rle"] = cropped_rle_to_full(r["rle"], image_size)
+    return records, meta["scale"]
+
+
+def _iter_caching_records(records, key: str, max_masks: int, min_area: int, scale: float, image_size, rle_format: str):
+    """
+    逐筆轉送 records（cropped 格式），全部產生完後存入結果快取；rle_format 為 full 時送出前轉成 full。
+    只有完整迭代結束（串流未中斷）時才寫入快取。
+    """
+    collected = []
+    for record in records:
+        collected.append(record)
+        if rle_format == "full":
+            record = dict(record, rle=cropped_rle_to_full(record["rle"], image_size))
+        yield record
+    meta = {
+        "max_masks": max_masks,
+        "min_area": min_area,
+        "truncated": len(collected) >= max_masks,
+        "scale": scale,
+    }
+    try:
+        _segment_result_cache.put(key, meta, encode_masks_binary(collected, "cropped", image_size))
+    except OSError as e:
+        print(f"寫入分割結果快取失敗: {e}")
+
+
+@app.post("/images")
+async def upload_image(file: UploadFile = File(...)):
+    """
+    上傳一次圖片並建立工作階段，回傳 image_id。
+    之後 /segment-everything、/segment-image、/segment-with-mask 可改傳 image_id（Form）取代 file，
+    省去重複上傳與解碼；SAM 嵌入會在第一次需要時計算並保存在工作階段中。
+    閒置超過 IMAGE_SESSION_TTL_SEC 秒的工作階段會被移除。
+    """
+    if not file.content_type or not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="只接受圖片文件")
+
+    try:
+        image_data = await file.read()
+        session = await run_in_threadpool(_create_image_session, image_data)
+    except Exception as e:
+        print(f"建立圖片工作階段時發生錯誤: {e}")
+        raise HTTPException(status_code=400, detail=f"無法解碼圖片: {str(e)}")
+
+    height, width = session["array"].shape[:2]
+    return {
+        "image_id": session["image_id"],
+        "width": int(width),
+        "height": int(height),
+        "content_hash": session["content_hash"],
+        "expires_in": IMAGE_SESSION_TTL_SEC,
+    }
 
-    flat = approx.reshape(-1).astype(int).tolist()
-    return [int(v) for v in flat]
+
+@app.delete("/images/{image_id}")
+async def delete_image(image_id: str):
+    """提前釋放圖片工作階段（含其 SAM 嵌入）。"""
+    with _image_sessions_lock:
+        session = _image_sessions.pop(image_id, None)
+    spooled = False
+    if _IMAGE_ID_RE.fullmatch(image_id):
+        try:
+            os.remove(_image_spool_path(image_id))
+            spooled = True
+        except FileNotFoundError:
+            pass
+    if session is None and not spooled:
+        raise HTTPException(status_code=404, detail="找不到此 image_id")
+    return {"image_id": image_id, "deleted": True}
 
 
 @app.post("/segment-everything")
 async def segment_everything(
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
     max_masks: int = 100,
     min_area: int = 0,
+    min_hole_area: int = 0,
+    min_island_area: int = 0,
+    rle: str = "full",
+    work_size: Optional[int] = None,
+    stream: bool = False,
+    progressive: bool = False,
+    grids: Optional[str] = None,
+    accept: Optional[str] = Header(None),
 ):
     """
     使用 SAM 的 SamAutomaticMaskGenerator 對整張圖片做自動分割（Segment Everything）。
@@ -342,84 +1614,131 @@ async def segment_everything(
     - polygon: 輪廓平坦座標 [x1, y1, x2, y2, ...]（供前端 Konva.Line 繪製貼邊外框）
 
     參數：
+    - file / image_id: 上傳圖片，或 POST /images 取得的 image_id（二擇一）
     - max_masks: 最多回傳幾個物件（依 score 排序，預設 100）
     - min_area: 最小面積（像素）門檻，小於此值的物件會被過濾，預設 0 不過濾
+    - min_hole_area: 填補每個物件中面積小於此值（像素）的孔洞，預設 0 不填補
+    - min_island_area: 移除每個物件中面積小於此值（像素）的碎片，預設 0 不移除
+    - work_size: 工作解析度（最長邊像素）。圖片大於此值時先縮小再自動分割，每個 mask 只在 bbox
+      範圍放大回原圖座標，大圖的記憶體與時間大幅降低；0 為原圖解析度，預設為 SEGMENT_EVERYTHING_WORK_SIZE。
+      實際使用的縮放比例（工作解析度 / 原圖）見回應的 scale 與 X-Work-Scale 標頭
+    - rle: "full"（預設，counts 涵蓋整張圖）或 "cropped"（counts 只涵蓋 bbox 視窗，
+      rle 另含 offset [x, y]；資料量與編解碼時間隨物件大小而非整張圖成長）
+
+    - stream: 為 true（?stream=1）時改以 NDJSON 串流回傳，每後處理完一個物件（依 score 順序）
+      就送出一行，圖片尺寸與 rle 格式放在 X-Image-Size / X-RLE-Format 標頭
+    - progressive: 為 true 時改為漸進式分割並以 NDJSON 串流回傳：先以稀疏網格（預設 8x8）取點，
+      該輪結果先送出，再以較密的網格（16x16、32x32）補上其餘物件；每輪只對尚未被已送出 mask
+      覆蓋的點執行 mask decoder。每行另含 pass（第幾輪，從 1 開始），各輪網格放在 X-Progressive-Grids 標頭
+    - grids: 漸進式分割各輪的每邊點數，以逗號分隔（預設 SEGMENT_EVERYTHING_PROGRESSIVE_GRIDS，即 8,16,32）
+
+    非漸進式的結果會依圖片內容與 generator 設定存入結果快取（見 _segment_cache_key），
+    之後相同的請求直接由快取回傳；X-Segment-Cache 標頭為 hit / miss / off。
+
+    回應格式：預設 JSON；Accept 為 application/x-layout-masks（或 application/octet-stream）時
+    改回傳精簡的二進位格式（varint counts、int16/int32 polygon），格式見 encode_masks_binary。
     """
     # 檢查模型是否載入
     if mask_generator is None:
         raise HTTPException(status_code=503, detail="模型尚未載入，請檢查模型文件是否存在")
 
-    # 檢查檔案類型
-    if not file.content_type or not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="只接受圖片文件")
+    if rle not in ("full", "cropped"):
+        raise HTTPException(status_code=400, detail="rle 只接受 full 或 cropped")
+    if min_hole_area < 0 or min_island_area < 0:
+        raise HTTPException(status_code=400, detail="min_hole_area / min_island_area 不可為負數")
+    if work_size is None:
+        work_size = SEGMENT_EVERYTHING_WORK_SIZE
+    if work_size < 0:
+        raise HTTPException(status_code=400, detail="work_size 不可為負數")
+    progressive_grids = _parse_progressive_grids(grids) if progressive else None
 
     try:
-        # 讀取圖片並轉為 RGB numpy array
-        image_data = await file.read()
-        image = Image.open(BytesIO(image_data))
-        image = image.convert("RGB")
-        image_array = np.array(image)
-
-        # 產生所有 masks（自動分割）
-        # SamAutomaticMaskGenerator 會回傳一個 list，裡面每個元素是 dict，例如：
-        # {
-        #   'segmentation': numpy.bool_[H, W],
-        #   'area': int,
-        #   'bbox': [x, y, w, h],
-        #   'predicted_iou': float,
-        #   'stability_score': float,
-        #   ...
-        # }
-        masks = mask_generator.generate(image_array)
-
-        # 依 score 排序（predicted_iou 為主），由大到小
-        masks_sorted = sorted(
-            masks,
-            key=lambda m: float(m.get("predicted_iou", m.get("stability_score", 0.0))),
-            reverse=True,
-        )
-
-        results = []
-        for m in masks_sorted:
-            area = int(m.get("area", 0))
-            if min_area > 0 and area < min_area:
-                continue
+        # 讀取圖片（或工作階段中已解碼的圖）為 RGB numpy array
+        image_array, image_hash, image_session = await _read_image_input(file, image_id)
+        image_size = [int(image_array.shape[0]), int(image_array.shape[1])]
+
+        if progressive:
+            return StreamingResponse(
+                _iter_progressive_lines(
+                    image_array, image_hash, image_session, work_size, progressive_grids,
+                    max_masks, min_area, rle, min_hole_area, min_island_area,
+                ),
+                media_type="application/x-ndjson",
+                headers={
+                    "X-Image-Size": f"{image_size[0]},{image_size[1]}",
+                    "X-RLE-Format": rle,
+                    "X-Work-Scale": str(round(work_size_scale(image_array.shape, work_size), 6)),
+                    "X-Progressive-Grids": ",".join(str(n) for n in progressive_grids),
+                },
+            )
 
-            segmentation = m["segmentation"]  # bool mask
-            bbox = m.get("bbox", None)
+        # 同一張圖、同樣設定的結果先查快取（記憶體 → 磁碟），能由快取過濾出本次結果時不必重新分割
+        cached = None
+        cache_key = None
+        if _segment_result_cache.enabled:
+            cache_key = _segment_cache_key(
+                image_hash, work_size_shape(image_array.shape, work_size), min_hole_area, min_island_area
+            )
+            cached = await run_in_threadpool(_segment_cache_lookup, cache_key, max_masks, min_area, rle)
 
-            if bbox is None:
-                # 若 bbox 不存在，從 segmentation 推出一個 bbox
-                ys, xs = np.where(segmentation)
-                if len(xs) == 0 or len(ys) == 0:
-                    continue
-                x_min, x_max = xs.min(), xs.max()
-                y_min, y_max = ys.min(), ys.max()
-                bbox = [
-                    int(x_min),
-                    int(y_min),
-                    int(x_max - x_min + 1),
-                    int(y_max - y_min + 1),
-                ]
-
-            # 轉成 RLE，減少資料量
-            rle = mask_to_rle(segmentation)
-            polygon = mask_to_polygon_flat(segmentation)
-
-            result = {
-                "bbox": [int(v) for v in bbox],
-                "area": area,
-                "score": float(m.get("predicted_iou", 0.0)),
-                "stability_score": float(m.get("stability_score", 0.0)),
-                "rle": rle,
-                "polygon": polygon,
-            }
-            results.append(result)
+        if cached is not None:
+            records, scale = cached
+            cache_status = "hit"
+        else:
+            # 產生所有 masks（自動分割，於推論執行器中執行），並依 score 排序
+            masks_sorted, scale = await _inference_executor.run(
+                _generate_masks_at_work_size, image_array, work_size
+            )
+            # 快取一律存 cropped 格式，需要 full 時由 _iter_caching_records 轉換
+            records = iter_segment_everything_results(
+                masks_sorted, max_masks, min_area, "cropped" if cache_key else rle,
+                min_hole_area, min_island_area, image_shape=image_array.shape,
+            )
+            if cache_key:
+                records = _iter_caching_records(
+                    records, cache_key, max_masks, min_area, scale, image_size, rle
+                )
+            cache_status = "miss" if cache_key else "off"
+        scale = round(scale, 6)
+
+        if stream:
+            # 第一批在回應開始前處理，執行器滿載時仍能直接回 503
+            records = iter(records)
+            first_lines = await _inference_executor.run(_next_ndjson_chunk, records)
+            return StreamingResponse(
+                _iter_ndjson_lines(records, first_lines),
+                media_type="application/x-ndjson",
+                headers={
+                    "X-Image-Size": f"{image_size[0]},{image_size[1]}",
+                    "X-RLE-Format": rle,
+                    "X-Work-Scale": str(scale),
+                    "X-Segment-Cache": cache_status,
+                },
+            )
 
-            if len(results) >= max_masks:
-                break
+        if _wants_binary_masks(accept):
+            content = await _inference_executor.run(
+                lambda: encode_masks_binary(list(records), rle, image_size)
+            )
+            return Response(
+                content=content,
+                media_type=SEGMENT_MASKS_BINARY_MEDIA_TYPE,
+                headers={"Vary": "Accept", "X-Work-Scale": str(scale), "X-Segment-Cache": cache_status},
+            )
 
-        return {"masks": results}
+        # 內容已是純 Python 型別，直接以 JSONResponse 輸出，略過 jsonable_encoder 逐值走訪
+        masks_json = await _inference_executor.run(
+            lambda: [mask_record_to_json(r) for r in records]
+        )
+        return JSONResponse(
+            content={
+                "masks": masks_json,
+                "rle_format": rle,
+                "image_size": image_size,
+                "scale": scale,
+            },
+            headers={"Vary": "Accept", "X-Work-Scale": str(scale), "X-Segment-Cache": cache_status},
+        )
 
     except HTTPException:
         raise
@@ -433,91 +1752,152 @@ async def segment_everything(
             detail=f"處理圖片時發生錯誤（segment-everything）: {str(e)}",
         )
 
+# 透明背景 PNG 的 zlib 壓縮等級（0–9，PIL 預設為 6）；較低的值編碼快很多、檔案稍大。
+# /segment-image 可用 compress_level 參數覆寫
+SEGMENT_PNG_COMPRESS_LEVEL = int(os.environ.get("SEGMENT_PNG_COMPRESS_LEVEL", "6"))
+
+# /segment-image 的輸出格式：png（每個 mask 一張 base64 PNG）、rle（bbox + 裁切格式 RLE，由前端自行從原圖合成）、
+# atlas（所有 mask 打包成單一張 sprite atlas PNG）
+_SEGMENT_IMAGE_OUTPUTS = ("png", "rle", "atlas")
+_SPRITE_ATLAS_PADDING = 1
+
+
+def _png_data_url(rgba: np.ndarray, compress_level: Optional[int] = None) -> str:
+    """將 RGBA 陣列編成 PNG data URL；compress_level 省略時使用 SEGMENT_PNG_COMPRESS_LEVEL。"""
+    if compress_level is None:
+        compress_level = SEGMENT_PNG_COMPRESS_LEVEL
+    buffer = BytesIO()
+    Image.fromarray(rgba, mode='RGBA').save(buffer, format='PNG', compress_level=compress_level)
+    return f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
+
+
+def _pack_sprite_atlas(sizes: list, padding: int = _SPRITE_ATLAS_PADDING) -> tuple[list, int, int]:
+    """
+    以 shelf packing 將 (width, height) 的矩形排進一張 atlas：依高度由大到小逐列擺放，
+    寬度取約略正方形的值（至少容納最寬的一個）。回傳 (各矩形的 (x, y)（與 sizes 同順序）, atlas 寬, atlas 高)；
+    矩形之間留 padding 像素，避免前端縮放取樣時相鄰 sprite 互相滲色。
+    """
+    if not sizes:
+        return [], 0, 0
+    total_area = sum((w + padding) * (h + padding) for w, h in sizes)
+    atlas_width = max(max(w for w, _ in sizes), int(np.ceil(np.sqrt(total_area))))
+    positions = [None] * len(sizes)
+    x = y = shelf_height = 0
+    for i in sorted(range(len(sizes)), key=lambda i: sizes[i][1], reverse=True):
+        w, h = sizes[i]
+        if x > 0 and x + w > atlas_width:
+            y += shelf_height + padding
+            x = shelf_height = 0
+        positions[i] = (x, y)
+        x += w + padding
+        shelf_height = max(shelf_height, h)
+    return positions, atlas_width, y + shelf_height
+
+
+def _segment_image_sync(
+    image_array: np.ndarray, output: str = "png", compress_level: Optional[int] = None
+) -> dict:
+    """/segment-image 的 CPU 密集部分（自動分割與輸出編碼），於推論執行器中執行。"""
+    # 執行分割（generator 內部的 predictor 有狀態，借用池中的 predictor 獨佔執行）
+    with predictor_pool.checkout() as sam_predictor:
+        masks = _mask_generator_with(sam_predictor).generate(image_array)
+
+    # 每個 mask 只保留物件實際存在的範圍（最小包圍盒），偏移量為包圍盒在原圖的左上角
+    mask_list = []
+    mask_crops = []
+    for mask_data in masks:
+        segmentation = mask_data['segmentation']  # bool array
+        bbox = mask_bbox(segmentation)
+        if bbox is None:
+            # 如果 mask 為空，跳過
+            continue
+        y_min, y_max, x_min, x_max = bbox
+        mask_crop = segmentation[y_min:y_max, x_min:x_max]
+        crop_height, crop_width = mask_crop.shape
+        entry = {
+            "offsetX": x_min,
+            "offsetY": y_min,
+            "width": crop_width,
+            "height": crop_height,
+        }
+
+        if output == "rle":
+            # 與 mask_to_rle 的裁切格式相同，前端以 offset 將 mask 套回原圖
+            entry["rle"] = {
+                "size": [crop_height, crop_width],
+                "counts": rle_counts(mask_crop.reshape(-1)).tolist(),
+                "offset": [x_min, y_min],
+            }
+        elif output == "atlas":
+            mask_crops.append(mask_crop)
+        else:
+            # 彩色物件 + 透明背景：mask 為 True 的地方 alpha=255，False 的地方 alpha=0
+            rgb_crop = image_array[y_min:y_max, x_min:x_max]
+            alpha_channel = mask_crop.astype(np.uint8) * 255
+            entry["image"] = _png_data_url(np.dstack([rgb_crop, alpha_channel]), compress_level)
+        mask_list.append(entry)
+
+    if output == "png":
+        return {"masks": mask_list}
+
+    result = {"masks": mask_list, "image_size": [int(image_array.shape[0]), int(image_array.shape[1])]}
+    if output == "atlas":
+        # 所有 mask 合成一張透明背景 PNG（只編碼一次）；每個 mask 的 atlasX / atlasY 為其在 atlas 中的位置
+        positions, atlas_width, atlas_height = _pack_sprite_atlas(
+            [(entry["width"], entry["height"]) for entry in mask_list]
+        )
+        atlas = None
+        if mask_list:
+            sheet = np.zeros((atlas_height, atlas_width, 4), dtype=np.uint8)
+            for entry, mask_crop, (atlas_x, atlas_y) in zip(mask_list, mask_crops, positions):
+                x, y, w, h = entry["offsetX"], entry["offsetY"], entry["width"], entry["height"]
+                sprite = sheet[atlas_y:atlas_y + h, atlas_x:atlas_x + w]
+                sprite[..., :3][mask_crop] = image_array[y:y + h, x:x + w][mask_crop]
+                sprite[..., 3] = mask_crop.astype(np.uint8) * 255
+                entry["atlasX"] = atlas_x
+                entry["atlasY"] = atlas_y
+            atlas = {
+                "image": _png_data_url(sheet, compress_level),
+                "width": atlas_width,
+                "height": atlas_height,
+            }
+        result["atlas"] = atlas
+    return result
+
+
 @app.post("/segment-image")
-async def segment_image(file: UploadFile = File(...)):
+async def segment_image(
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    output: str = Form("png"),
+    compress_level: Optional[int] = Form(None),
+):
     """
-    接收圖片並進行自動分割
-    返回分割後的 mask 列表（base64 編碼的 PNG 圖片）
+    接收圖片（或 POST /images 取得的 image_id）並進行自動分割，返回分割後的 mask 列表。
+    每個 mask 皆含 offsetX、offsetY、width、height（包圍盒），另依 output：
+    - png（預設）：image 為裁切後透明背景 PNG 的 data URL
+    - rle：rle 為裁切格式 RLE（size、counts、offset），不做任何影像編碼，由前端從原圖合成；回應另含 image_size
+    - atlas：所有 mask 打包成單一 PNG（回應的 atlas: {image, width, height}），每個 mask 以 atlasX、atlasY
+      標示其 sprite 位置；回應另含 image_size
+    compress_level（0–9）覆寫 PNG 壓縮等級（預設 SEGMENT_PNG_COMPRESS_LEVEL），較低的值編碼較快、檔案較大。
     """
     # 檢查模型是否已載入
     if mask_generator is None:
         raise HTTPException(status_code=503, detail="模型尚未載入，請檢查模型文件是否存在")
-    
-    # 檢查文件類型
-    if not file.content_type or not file.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="只接受圖片文件")
+    if output not in _SEGMENT_IMAGE_OUTPUTS:
+        raise HTTPException(status_code=400, detail="output 僅支援 png、rle 或 atlas")
+    if compress_level is not None and not 0 <= compress_level <= 9:
+        raise HTTPException(status_code=400, detail="compress_level 須介於 0 到 9")
     
     try:
-        # 讀取圖片並轉換為 RGB numpy array
-        image_data = await file.read()
-        image = Image.open(BytesIO(image_data))
-        image = image.convert('RGB')
-        image_array = np.array(image)
+        # 讀取圖片（或工作階段中已解碼的圖）並轉換為 RGB numpy array
+        image_array, _, _ = await _read_image_input(file, image_id)
         
-        # 執行分割
-        masks = mask_generator.generate(image_array)
-        
-        # 將每個 mask 轉換為 base64 PNG（彩色物件 + 透明背景）
-        # 只保留物件實際存在的範圍（最小包圍盒）
-        mask_list = []
-        for mask_data in masks:
-            segmentation = mask_data['segmentation']  # bool array
-            
-            # 計算最小包圍盒（bounding box）
-            # 找到所有 mask 為 True 的像素位置
-            rows = np.any(segmentation, axis=1)
-            cols = np.any(segmentation, axis=0)
-            
-            if not np.any(rows) or not np.any(cols):
-                # 如果 mask 為空，跳過
-                continue
-            
-            # 計算邊界
-            y_min, y_max = np.where(rows)[0][[0, -1]]
-            x_min, x_max = np.where(cols)[0][[0, -1]]
-            
-            # 記錄偏移量（相對於原圖的偏移）
-            offset_x = int(x_min)
-            offset_y = int(y_min)
-            
-            # 計算裁切區域的寬高
-            crop_width = int(x_max - x_min + 1)
-            crop_height = int(y_max - y_min + 1)
-            
-            # 裁切原圖的 RGB 區域
-            rgb_crop = image_array[y_min:y_max+1, x_min:x_max+1].copy()
-            
-            # 裁切 mask 區域
-            mask_crop = segmentation[y_min:y_max+1, x_min:x_max+1]
-            
-            # 創建 alpha 通道：mask 為 True 的地方 alpha=255，False 的地方 alpha=0
-            alpha_channel = (mask_crop * 255).astype(np.uint8)
-            
-            # 將 RGB 和 alpha 合併成 RGBA
-            rgba_image = np.dstack([rgb_crop, alpha_channel])
-            
-            # 創建 RGBA 模式的 PIL Image
-            pil_rgba = Image.fromarray(rgba_image, mode='RGBA')
-            
-            # 轉換為 base64
-            buffer = BytesIO()
-            pil_rgba.save(buffer, format='PNG')
-            buffer.seek(0)
-            base64_str = base64.b64encode(buffer.read()).decode('utf-8')
-            base64_url = f"data:image/png;base64,{base64_str}"
-            
-            # 返回圖片和偏移量信息
-            mask_list.append({
-                "image": base64_url,
-                "offsetX": offset_x,
-                "offsetY": offset_y,
-                "width": crop_width,
-                "height": crop_height
-            })
-        
-        return {"masks": mask_list}
+        return await _inference_executor.run(_segment_image_sync, image_array, output, compress_level)
     
-    except Exception as e:
+    except HTTPException:
+        raise
+    except Exception as e:
         print(f"處理圖片時發生錯誤: {e}")
         raise HTTPException(status_code=500, detail=f"處理圖片時發生錯誤: {str(e)}")
 
@@ -629,328 +2009,743 @@ def process_mask_to_binary(mask_image):
     
     return binary_mask
 
-@app.post("/segment-with-mask")
-async def segment_with_mask(
-    file: UploadFile = File(...),
-    mask: str = Form(...),
-    bbox: str = Form(None)
-):
+def _resize_for_sam(image_array: np.ndarray) -> np.ndarray:
+    """SAM 要求將圖像 resize 到標準尺寸（最長邊 1024，保持寬高比）。"""
+    original_height, original_width = image_array.shape[:2]
+
+    # 計算 resize 尺寸（最長邊為 1024）
+    max_size = 1024
+    scale = max_size / max(original_height, original_width)
+    new_height = int(original_height * scale)
+    new_width = int(original_width * scale)
+
+    # Resize 圖像
+    resized_image = cv2.resize(image_array, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    print(f"調試: 原始圖像尺寸: ({original_height}, {original_width}), Resize 後: ({new_height}, {new_width})")
+    return resized_image
+
+
+def _prepare_mask_prompt(image_array: np.ndarray, mask: str, resized_shape) -> dict:
     """
-    使用 mask 提示進行分割
-    接收原始圖片和 mask（base64 編碼），返回分割結果
+    解碼使用者 mask 並轉成 SAM 提示：二值 mask（原圖尺寸）、resize 後的 mask、
+    低解析度 mask_input（[1, 256, 256]）與 box（resize 後座標 [x, y, x, y]）。
     """
-    # 檢查模型是否已載入
-    if predictor is None:
-        raise HTTPException(status_code=503, detail="模型尚未載入，請檢查模型文件是否存在")
-    
-    # 檢查文件類型
-    if not file.content_type or not file.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="只接受圖片文件")
-    
-    try:
-        # 讀取原始圖像
-        image_data = await file.read()
-        image = Image.open(BytesIO(image_data))
-        image = image.convert('RGB')
-        image_array = np.array(image)
-        
-        # 讀取 mask
-        mask_image = decode_base64_image(mask)
-        
-        # 調試：打印 mask_image 的形狀
-        print(f"調試: mask_image 形狀: {mask_image.shape}, 圖像形狀: {image_array.shape}")
-        
-        # 將 mask 轉換為二值 mask（在調整大小之前）
-        binary_mask = process_mask_to_binary(mask_image)
-        
-        # 確保 binary_mask 是 2D 數組 (H, W)
-        # 如果仍然是3D或更高維度，強制轉換為2D
-        if len(binary_mask.shape) > 2:
-            print(f"警告: binary_mask 形狀異常: {binary_mask.shape}，嘗試轉換為2D")
-            # 如果是3D，取第一個通道或轉換為灰度
-            if len(binary_mask.shape) == 3:
-                if binary_mask.shape[2] == 1:
-                    binary_mask = binary_mask[:, :, 0]
-                elif binary_mask.shape[2] == 3:
-                    # RGB轉灰度
-                    binary_mask = cv2.cvtColor(binary_mask.astype(np.uint8), cv2.COLOR_RGB2GRAY)
-                else:
-                    binary_mask = binary_mask[:, :, 0]
+    # 讀取 mask
+    mask_image = decode_base64_image(mask)
+
+    # 調試：打印 mask_image 的形狀
+    print(f"調試: mask_image 形狀: {mask_image.shape}, 圖像形狀: {image_array.shape}")
+
+    # 將 mask 轉換為二值 mask（在調整大小之前）
+    binary_mask = process_mask_to_binary(mask_image)
+
+    # 確保 binary_mask 是 2D 數組 (H, W)
+    # 如果仍然是3D或更高維度，強制轉換為2D
+    if len(binary_mask.shape) > 2:
+        print(f"警告: binary_mask 形狀異常: {binary_mask.shape}，嘗試轉換為2D")
+        # 如果是3D，取第一個通道或轉換為灰度
+        if len(binary_mask.shape) == 3:
+            if binary_mask.shape[2] == 1:
+                binary_mask = binary_mask[:, :, 0]
+            elif binary_mask.shape[2] == 3:
+                # RGB轉灰度
+                binary_mask = cv2.cvtColor(binary_mask.astype(np.uint8), cv2.COLOR_RGB2GRAY)
             else:
-                # 更高維度，嘗試重塑
-                total_elements = binary_mask.size
-                h, w = image_array.shape[:2]
-                if total_elements == h * w:
-                    binary_mask = binary_mask.reshape(h, w)
-                else:
-                    raise HTTPException(status_code=400, detail=f"無法將 binary_mask 轉換為2D，形狀: {binary_mask.shape}")
-        
-        if len(binary_mask.shape) != 2:
-            raise HTTPException(status_code=400, detail=f"binary_mask 應該是 2D 數組，但得到形狀: {binary_mask.shape}")
-        
-        # 確保 mask 與圖像尺寸一致（在 resize 之前）
-        if binary_mask.shape[:2] != image_array.shape[:2]:
-            binary_mask = cv2.resize(binary_mask, (image_array.shape[1], image_array.shape[0]), interpolation=cv2.INTER_NEAREST)
-        
-        # 最終檢查：確保 binary_mask 是 2D
-        if len(binary_mask.shape) != 2:
-            raise HTTPException(status_code=400, detail=f"調整大小後 binary_mask 應該是 2D 數組，但得到形狀: {binary_mask.shape}")
-        
-        # SAM 要求將圖像 resize 到標準尺寸（最長邊 1024，保持寬高比）
-        # 同時將 mask 也 resize 到相同大小
-        original_height, original_width = image_array.shape[:2]
-        
-        # 計算 resize 尺寸（最長邊為 1024）
-        max_size = 1024
-        scale = max_size / max(original_height, original_width)
-        new_height = int(original_height * scale)
-        new_width = int(original_width * scale)
-        
-        # Resize 圖像
-        resized_image = cv2.resize(image_array, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
-        print(f"調試: 原始圖像尺寸: ({original_height}, {original_width}), Resize 後: ({new_height}, {new_width})")
-        
-        # Resize mask 到相同尺寸（使用最近鄰插值保持二值特性）
-        resized_mask = cv2.resize(binary_mask, (new_width, new_height), interpolation=cv2.INTER_NEAREST)
-        print(f"調試: Resize 後 mask 尺寸: {resized_mask.shape}")
-        
-        # 設置 resize 後的圖像到 SAM predictor
-        predictor.set_image(resized_image)
-        
-        # SAM 的 mask_input 需要是低分辨率（256x256），而不是與圖像相同大小
-        # SAM 內部會自動將 mask_input 上採樣到圖像尺寸
-        # 使用 SAM 的 transform 來確保尺寸匹配
-        mask_input_size = 256
-        
-        # 將 mask resize 到 256x256（低分辨率），使用最近鄰插值保持二值特性
-        low_res_mask = cv2.resize(resized_mask, (mask_input_size, mask_input_size), interpolation=cv2.INTER_NEAREST)
-        
-        # 轉換為 float32，值為 0.0 或 1.0
-        mask_input = (low_res_mask > 127).astype(np.float32)
-        
-        # 確保是2D
-        if len(mask_input.shape) != 2:
-            print(f"錯誤: mask_input 在轉換後不是2D，形狀: {mask_input.shape}")
-            if mask_input.size == mask_input_size * mask_input_size:
-                mask_input = mask_input.reshape(mask_input_size, mask_input_size)
+                binary_mask = binary_mask[:, :, 0]
+        else:
+            # 更高維度，嘗試重塑
+            total_elements = binary_mask.size
+            h, w = image_array.shape[:2]
+            if total_elements == h * w:
+                binary_mask = binary_mask.reshape(h, w)
             else:
-                raise HTTPException(status_code=400, detail=f"mask_input 應該是 2D 數組，但得到形狀: {mask_input.shape}")
-        
-        # SAM 的 predict() 方法期望 mask_input 是 [1, H, W] 格式（3D）
-        # 添加 batch 維度：[H, W] -> [1, H, W]
-        mask_input = np.expand_dims(mask_input, axis=0)
-        
-        # 最終檢查：確保是 3D 數組 [1, H, W]，其中 H=W=256
-        if len(mask_input.shape) != 3:
-            raise HTTPException(status_code=400, detail=f"mask_input 應該是 3D 數組 [1, H, W]，但得到形狀: {mask_input.shape}")
-        
-        # 驗證尺寸
-        if mask_input.shape[1] != mask_input_size or mask_input.shape[2] != mask_input_size:
-            raise HTTPException(status_code=400, detail=f"mask_input 應該是 [1, {mask_input_size}, {mask_input_size}]，但得到: {mask_input.shape}")
-        
-        # 打印最終形狀用於調試
-        print(f"調試: 最終 mask_input 形狀: {mask_input.shape}, 類型: {type(mask_input)}, dtype: {mask_input.dtype}")
-        
-        # 計算 bounding box（從 resize 後的 mask）
-        coords = np.column_stack(np.where(resized_mask > 127))
-        if len(coords) == 0:
-            raise HTTPException(status_code=400, detail="Invalid mask: no valid region found")
-        
-        y_min, x_min = coords.min(axis=0)
-        y_max, x_max = coords.max(axis=0)
-        
-        # 轉換為 [x, y, x, y] 格式（左上角和右下角）
-        input_box = np.array([x_min, y_min, x_max, y_max])
-        
+                raise HTTPException(status_code=400, detail=f"無法將 binary_mask 轉換為2D，形狀: {binary_mask.shape}")
+
+    if len(binary_mask.shape) != 2:
+        raise HTTPException(status_code=400, detail=f"binary_mask 應該是 2D 數組，但得到形狀: {binary_mask.shape}")
+
+    # 確保 mask 與圖像尺寸一致（在 resize 之前）
+    if binary_mask.shape[:2] != image_array.shape[:2]:
+        binary_mask = cv2.resize(binary_mask, (image_array.shape[1], image_array.shape[0]), interpolation=cv2.INTER_NEAREST)
+
+    # 最終檢查：確保 binary_mask 是 2D
+    if len(binary_mask.shape) != 2:
+        raise HTTPException(status_code=400, detail=f"調整大小後 binary_mask 應該是 2D 數組，但得到形狀: {binary_mask.shape}")
+
+    # mask 也 resize 到與 SAM 輸入圖像相同大小
+    new_height, new_width = resized_shape[:2]
+
+    # Resize mask 到相同尺寸（使用最近鄰插值保持二值特性）
+    resized_mask = cv2.resize(binary_mask, (new_width, new_height), interpolation=cv2.INTER_NEAREST)
+    print(f"調試: Resize 後 mask 尺寸: {resized_mask.shape}")
+
+    # SAM 的 mask_input 需要是低分辨率（256x256），而不是與圖像相同大小
+    # SAM 內部會自動將 mask_input 上採樣到圖像尺寸
+    # 使用 SAM 的 transform 來確保尺寸匹配
+    mask_input_size = 256
+
+    # 將 mask resize 到 256x256（低分辨率），使用最近鄰插值保持二值特性
+    low_res_mask = cv2.resize(resized_mask, (mask_input_size, mask_input_size), interpolation=cv2.INTER_NEAREST)
+
+    # 轉換為 float32，值為 0.0 或 1.0
+    mask_input = (low_res_mask > 127).astype(np.float32)
+
+    # 確保是2D
+    if len(mask_input.shape) != 2:
+        print(f"錯誤: mask_input 在轉換後不是2D，形狀: {mask_input.shape}")
+        if mask_input.size == mask_input_size * mask_input_size:
+            mask_input = mask_input.reshape(mask_input_size, mask_input_size)
+        else:
+            raise HTTPException(status_code=400, detail=f"mask_input 應該是 2D 數組，但得到形狀: {mask_input.shape}")
+
+    # SAM 的 predict() 方法期望 mask_input 是 [1, H, W] 格式（3D）
+    # 添加 batch 維度：[H, W] -> [1, H, W]
+    mask_input = np.expand_dims(mask_input, axis=0)
+
+    # 最終檢查：確保是 3D 數組 [1, H, W]，其中 H=W=256
+    if len(mask_input.shape) != 3:
+        raise HTTPException(status_code=400, detail=f"mask_input 應該是 3D 數組 [1, H, W]，但得到形狀: {mask_input.shape}")
+
+    # 驗證尺寸
+    if mask_input.shape[1] != mask_input_size or mask_input.shape[2] != mask_input_size:
+        raise HTTPException(status_code=400, detail=f"mask_input 應該是 [1, {mask_input_size}, {mask_input_size}]，但得到: {mask_input.shape}")
+
+    # 打印最終形狀用於調試
+    print(f"調試: 最終 mask_input 形狀: {mask_input.shape}, 類型: {type(mask_input)}, dtype: {mask_input.dtype}")
+
+    # 計算 bounding box（從 resize 後的 mask）
+    coords = np.column_stack(np.where(resized_mask > 127))
+    if len(coords) == 0:
+        raise HTTPException(status_code=400, detail="Invalid mask: no valid region found")
+
+    y_min, x_min = coords.min(axis=0)
+    y_max, x_max = coords.max(axis=0)
+
+    # 轉換為 [x, y, x, y] 格式（左上角和右下角）
+    input_box = np.array([x_min, y_min, x_max, y_max])
+
+    return {
+        "binary_mask": binary_mask,
+        "resized_mask": resized_mask,
+        "mask_input": mask_input,
+        "input_box": input_box,
+    }
+
+
+def _select_best_mask(masks: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """從 multimask 輸出中選擇分數最高的 mask（通常 scores[0] 是最佳的）。"""
+    best_mask_idx = 0
+    if len(scores) > 1:
+        # 選擇分數最高的 mask
+        best_mask_idx = np.argmax(scores)
+    return masks[best_mask_idx]
+
+
+# 預測後的 mask 後處理管線，分兩個階段，各為一串具名步驟：
+#   "sam"：SAM 輸入解析度（最長邊 1024），以 resize 後的使用者 mask 約束；
+#   "full"：nearest 放大回原圖尺寸後，以原圖尺寸的使用者 mask 約束。
+# 每個階段開始與結束時一律與使用者 mask 取交集（結果不會超出使用者圈選範圍），中間的步驟由預設組合
+# （_REFINE_PRESETS）或請求帶入的 JSON 決定。步驟寫成 "median" 或 {"op": "close", "kernel": 9, "iterations": 3}。
+SEGMENT_REFINE_PRESET = os.environ.get("SEGMENT_REFINE_PRESET", "fast").strip()
+
+
+def _refine_close(mask: np.ndarray, ctx: dict, kernel: int, iterations: int) -> np.ndarray:
+    """CLOSE：先膨脹後腐蝕，填補小孔洞、連接斷開的區域。"""
+    element = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel, kernel))
+    return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, element, iterations=iterations)
+
+
+def _refine_open(mask: np.ndarray, ctx: dict, kernel: int, iterations: int) -> np.ndarray:
+    """OPEN：先腐蝕後膨脹，去除小噪點與毛刺。"""
+    element = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel, kernel))
+    return cv2.morphologyEx(mask, cv2.MORPH_OPEN, element, iterations=iterations)
+
+
+def _refine_median(mask: np.ndarray, ctx: dict, ksize: int) -> np.ndarray:
+    return cv2.medianBlur(mask, ksize)
+
+
+def _refine_gaussian(mask: np.ndarray, ctx: dict, ksize: int, sigma: float) -> np.ndarray:
+    """GaussianBlur 平滑邊緣（之後通常接 threshold 重新二值化）。"""
+    return cv2.GaussianBlur(mask, (ksize, ksize), sigma)
+
+
+def _refine_threshold(mask: np.ndarray, ctx: dict) -> np.ndarray:
+    return (mask > 127).astype(np.uint8) * 255
+
+
+def _refine_constrain(mask: np.ndarray, ctx: dict) -> np.ndarray:
+    """與使用者 mask 取交集，確保遵守使用者圈選範圍。"""
+    return cv2.bitwise_and(mask, ctx["constraint"])
+
+
+def _refine_fill_holes(mask: np.ndarray, ctx: dict, min_hole_area: int) -> np.ndarray:
+    """填補內部孔洞（min_hole_area 為 0 時全部填補，否則只填補小於此面積的孔洞）。"""
+    return fill_mask_holes(mask, min_hole_area)
+
+
+def _refine_remove_islands(mask: np.ndarray, ctx: dict, min_island_area: int) -> np.ndarray:
+    return remove_mask_islands(mask, min_island_area)
+
+
+def _morph_reach(params: dict) -> int:
+    # 每次迭代膨脹與腐蝕各延伸 kernel // 2
+    return 2 * params["iterations"] * (params["kernel"] // 2)
+
+
+# 名稱 -> (函式, 參數預設值, 影響半徑)。影響半徑為輸出像素最遠會受到多遠的輸入像素影響；
+# None 表示以連通區塊為單位處理（見 _refine_margin）
+_REFINE_STAGES = {
+    "close": (_refine_close, {"kernel": 7, "iterations": 1}, _morph_reach),
+    "open": (_refine_open, {"kernel": 3, "iterations": 1}, _morph_reach),
+    "median": (_refine_median, {"ksize": 3}, lambda p: p["ksize"] // 2),
+    "gaussian": (_refine_gaussian, {"ksize": 5, "sigma": 1.5}, lambda p: p["ksize"] // 2),
+    "threshold": (_refine_threshold, {}, lambda p: 0),
+    "constrain": (_refine_constrain, {}, lambda p: 0),
+    "fill_holes": (_refine_fill_holes, {"min_hole_area": 0}, None),
+    "remove_islands": (_refine_remove_islands, {"min_island_area": 64}, None),
+}
+
+_REFINE_PRESETS = {
+    # 原本固定的處理流程（填孔改以連通區塊標記，見 fill_mask_holes）
+    "legacy": {
+        "sam": [
+            {"op": "close", "kernel": 9, "iterations": 3}, "constrain",
+            {"op": "open", "kernel": 3}, "constrain",
+            {"op": "close", "kernel": 7, "iterations": 2}, "constrain",
+            {"op": "median", "ksize": 3}, "constrain",
+            "threshold",
+        ],
+        "full": [
+            {"op": "close", "kernel": 7, "iterations": 3}, "constrain",
+            {"op": "open", "kernel": 3}, "constrain",
+            {"op": "close", "kernel": 7, "iterations": 2}, "constrain",
+            {"op": "gaussian", "ksize": 5, "sigma": 1.5}, "threshold",
+            {"op": "median", "ksize": 5}, "constrain",
+            "fill_holes", "constrain",
+            "threshold",
+        ],
+    },
+    # 填孔與去噪只在 SAM 解析度做一次；原圖解析度只平滑 nearest 放大造成的鋸齒
+    "fast": {
+        "sam": [
+            {"op": "close", "kernel": 7, "iterations": 1}, "constrain",
+            {"op": "open", "kernel": 3}, "constrain",
+        ],
+        "full": [
+            {"op": "gaussian", "ksize": 5, "sigma": 1.5}, "threshold",
+            "fill_holes",
+        ],
+    },
+    # 只以使用者 mask 約束 SAM 的預測
+    "none": {"sam": [], "full": []},
+}
+
+
+def _parse_refine_stage(spec) -> tuple[str, dict]:
+    """將單一步驟（字串或 {"op": ..., 參數...}）正規化為 (名稱, 完整參數)；無效時拋出 ValueError。"""
+    if isinstance(spec, str):
+        name, given = spec, {}
+    elif isinstance(spec, dict) and isinstance(spec.get("op"), str):
+        name = spec["op"]
+        given = {k: v for k, v in spec.items() if k != "op"}
+    else:
+        raise ValueError(f"無效的後處理步驟: {spec!r}")
+    if name not in _REFINE_STAGES:
+        raise ValueError(f"未知的後處理步驟: {name}（可用: {', '.join(_REFINE_STAGES)}）")
+    defaults = _REFINE_STAGES[name][1]
+    unknown = sorted(set(given) - set(defaults))
+    if unknown:
+        raise ValueError(f"後處理步驟 {name} 不支援參數: {', '.join(unknown)}")
+
+    params = dict(defaults)
+    for key, value in given.items():
+        if key == "sigma":
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 10:
+                raise ValueError(f"{name}.sigma 須為 0 到 10 的數值")
+            params[key] = float(value)
+        elif key.endswith("_area"):
+            if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 10 ** 8:
+                raise ValueError(f"{name}.{key} 須為 0 到 100000000 的整數")
+            params[key] = value
+        elif key == "iterations":
+            if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= 10:
+                raise ValueError(f"{name}.iterations 須為 1 到 10 的整數")
+            params[key] = value
+        else:
+            # kernel / ksize
+            if isinstance(value, bool) or not isinstance(value, int) or not 3 <= value <= 31 or value % 2 == 0:
+                raise ValueError(f"{name}.{key} 須為 3 到 31 的奇數")
+            params[key] = value
+    return name, params
+
+
+def _refine_margin(stages: list) -> int:
+    """
+    ROI 邊距：ROI 邊界造成的差異每經過一步會向內傳遞該步的影響半徑，直到下一次與使用者 mask 取交集
+    （框外歸零）為止，因此邊距取相鄰兩次約束之間影響半徑總和的最大值，框內結果即與整張圖處理逐像素相同。
+    以連通區塊為單位的步驟需要整個區塊落在 ROI 內，而區塊最多超出使用者 mask 的邊界框「目前累積的半徑」，
+    故累積值加倍。
+    """
+    margin = accumulated = 0
+    for name, params in stages:
+        if name == "constrain":
+            accumulated = 0
+            continue
+        reach = _REFINE_STAGES[name][2]
+        accumulated += accumulated if reach is None else reach(params)
+        margin = max(margin, accumulated)
+    return margin
+
+
+def _build_refine_pipeline(name: str, spec) -> dict:
+    """由 {"sam": [...], "full": [...]} 建立可執行的管線（含各階段的 ROI 邊距）；無效時拋出 ValueError。"""
+    if not isinstance(spec, dict) or set(spec) - {"sam", "full"}:
+        raise ValueError('後處理管線須為 {"sam": [...], "full": [...]}')
+    pipeline = {"name": name}
+    for phase in ("sam", "full"):
+        steps = spec.get(phase, [])
+        if not isinstance(steps, list):
+            raise ValueError(f"後處理管線的 {phase} 須為陣列")
+        stages = [_parse_refine_stage(step) for step in steps]
+        pipeline[phase] = stages
+        pipeline[f"{phase}_margin"] = _refine_margin(stages)
+    return pipeline
+
+
+_REFINE_PIPELINES = {name: _build_refine_pipeline(name, spec) for name, spec in _REFINE_PRESETS.items()}
+if SEGMENT_REFINE_PRESET not in _REFINE_PIPELINES:
+    print(f"警告: 未知的 SEGMENT_REFINE_PRESET={SEGMENT_REFINE_PRESET!r}，改用 fast")
+    SEGMENT_REFINE_PRESET = "fast"
+
+
+def _resolve_refine_pipeline(refine: Optional[str]) -> dict:
+    """
+    解析 refine 請求參數：預設組合名稱（legacy / fast / none），或 {"sam": [...], "full": [...]} 的 JSON；
+    未指定時使用 SEGMENT_REFINE_PRESET。
+    """
+    refine = (refine or "").strip()
+    if not refine:
+        return _REFINE_PIPELINES[SEGMENT_REFINE_PRESET]
+    if refine in _REFINE_PIPELINES:
+        return _REFINE_PIPELINES[refine]
+    if not refine.startswith("{"):
+        raise HTTPException(
+            status_code=400,
+            detail=f"未知的 refine 預設組合: {refine}（可用: {', '.join(_REFINE_PIPELINES)}，或 JSON 管線）",
+        )
+    try:
+        return _build_refine_pipeline("custom", json.loads(refine))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"無效的 refine 管線: {e}") from e
+
+
+class _RefineStats:
+    """後處理各步驟的累計耗時（依預設組合、階段、步驟分組），供 /admin/refine-stats 查詢。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: dict = {}
+
+    def record(self, preset: str, timings: list) -> None:
+        with self._lock:
+            for t in timings:
+                key = (preset, t["phase"], t["op"])
+                entry = self._stages.setdefault(key, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+                entry["count"] += 1
+                entry["total_ms"] += t["ms"]
+                entry["max_ms"] = max(entry["max_ms"], t["ms"])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stages.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            out: dict = {}
+            for (preset, phase, op), entry in self._stages.items():
+                out.setdefault(preset, []).append({
+                    "phase": phase,
+                    "op": op,
+                    "count": entry["count"],
+                    "total_ms": round(entry["total_ms"], 3),
+                    "avg_ms": round(entry["total_ms"] / entry["count"], 3),
+                    "max_ms": round(entry["max_ms"], 3),
+                })
+            return {"default_preset": SEGMENT_REFINE_PRESET, "presets": out}
+
+
+_refine_stats = _RefineStats()
+
+
+def _run_refine_stages(stages: list, mask: np.ndarray, ctx: dict, phase: str, timings: list) -> np.ndarray:
+    """依序執行一個階段的步驟（前後各自動與使用者 mask 取交集），每步的耗時記入 timings。"""
+    for name, params in [("constrain", {})] + stages + [("constrain", {})]:
+        started = time.perf_counter()
+        mask = _REFINE_STAGES[name][0](mask, ctx, **params)
+        timings.append({
+            "phase": phase,
+            "op": name,
+            "ms": round((time.perf_counter() - started) * 1000, 3),
+        })
+    return mask
+
+
+def _expand_roi(bbox: tuple[int, int, int, int], margin: int, shape) -> tuple[int, int, int, int]:
+    y0, y1, x0, x1 = bbox
+    h, w = shape[:2]
+    return max(0, y0 - margin), min(h, y1 + margin), max(0, x0 - margin), min(w, x1 + margin)
+
+
+def _nearest_resize_index(src_len: int, dst_len: int) -> np.ndarray:
+    """
+    cv2.resize（INTER_NEAREST）在單一軸上的來源索引：對索引向量做同樣的 resize 取得，
+    取整方式與 OpenCV 完全一致。nearest resize 可分離，dst[y, x] = src[iy[y], ix[x]]。
+    """
+    index = np.arange(src_len, dtype=np.int32).reshape(1, -1)
+    return cv2.resize(index, (dst_len, 1), interpolation=cv2.INTER_NEAREST)[0]
+
+
+def _refine_predicted_mask(
+    best_mask: np.ndarray,
+    resized_mask: np.ndarray,
+    binary_mask: np.ndarray,
+    image_array: np.ndarray,
+    pipeline: Optional[dict] = None,
+    include_timings: bool = False,
+) -> dict:
+    """
+    SAM 預測後的處理：依後處理管線（預設 SEGMENT_REFINE_PRESET）在 SAM 解析度與原圖解析度各做一個階段，
+    裁切成透明背景 PNG，回傳 {image, offsetX, offsetY, width, height}；include_timings 時另附
+    refine: {preset, timings, total_ms}。兩個階段都只在使用者 mask 的邊界框加上邊距（見 _refine_margin）的
+    ROI 內進行，成本只與物件大小有關。
+    """
+    if pipeline is None:
+        pipeline = _REFINE_PIPELINES[SEGMENT_REFINE_PRESET]
+    original_height, original_width = image_array.shape[:2]
+    no_result = HTTPException(status_code=400, detail="No valid segmentation result")
+    timings: list = []
+
+    # resize 後解析度的 ROI：使用者 mask 的邊界框 + 邊距
+    user_bbox = mask_bbox(resized_mask)
+    if user_bbox is None:
+        raise no_result
+    ay0, ay1, ax0, ax1 = _expand_roi(user_bbox, pipeline["sam_margin"], resized_mask.shape)
+
+    best_mask_binary = (best_mask[ay0:ay1, ax0:ax1] > 0).astype(np.uint8) * 255
+    print(f"調試: 原始 mask 像素數: {np.count_nonzero(best_mask)}, 尺寸: {best_mask.shape[:2]}")
+
+    # 第一階段開頭的約束即立刻以使用者 mask 約束預測結果，防止 SAM 預測出超出圈選範圍的區域
+    mask_final = _run_refine_stages(
+        pipeline["sam"],
+        best_mask_binary,
+        {"constraint": resized_mask[ay0:ay1, ax0:ax1]},
+        "sam",
+        timings,
+    )
+    print(f"調試: SAM 解析度後處理完成，處理後 mask 像素數: {(mask_final > 0).sum()}")
+
+    # 原圖解析度的 ROI：用戶原始 mask（resize 到原圖尺寸後二值化）的邊界框 + 邊距。
+    # nearest resize 的索引單調遞增，框內的列／欄可由來源邊界框以 searchsorted 求得
+    started = time.perf_counter()
+    user_rows = _nearest_resize_index(binary_mask.shape[0], original_height)
+    user_cols = _nearest_resize_index(binary_mask.shape[1], original_width)
+    user_bbox = mask_bbox(binary_mask > 127)
+    if user_bbox is None:
+        raise no_result
+    user_bbox = (
+        int(np.searchsorted(user_rows, user_bbox[0])),
+        int(np.searchsorted(user_rows, user_bbox[1])),
+        int(np.searchsorted(user_cols, user_bbox[2])),
+        int(np.searchsorted(user_cols, user_bbox[3])),
+    )
+    if user_bbox[0] >= user_bbox[1] or user_bbox[2] >= user_bbox[3]:
+        raise no_result
+    oy0, oy1, ox0, ox1 = _expand_roi(user_bbox, pipeline["full_margin"], image_array.shape)
+
+    # 將 mask resize 回原始圖像尺寸（只取 ROI 內的像素；resize 後解析度 ROI 外恆為 0）
+    mask_final_full = np.zeros(resized_mask.shape[:2], dtype=np.uint8)
+    mask_final_full[ay0:ay1, ax0:ax1] = mask_final
+    up_rows = _nearest_resize_index(resized_mask.shape[0], original_height)
+    up_cols = _nearest_resize_index(resized_mask.shape[1], original_width)
+    best_mask_original_size = mask_final_full[np.ix_(up_rows[oy0:oy1], up_cols[ox0:ox1])]
+
+    # 創建用戶原始 mask 的原始尺寸版本，用於約束
+    user_mask_original = binary_mask[np.ix_(user_rows[oy0:oy1], user_cols[ox0:ox1])]
+    user_mask_original = (user_mask_original > 127).astype(np.uint8) * 255
+    timings.append({"phase": "full", "op": "upscale", "ms": round((time.perf_counter() - started) * 1000, 3)})
+
+    best_mask_original_size = _run_refine_stages(
+        pipeline["full"],
+        best_mask_original_size,
+        {"constraint": user_mask_original},
+        "full",
+        timings,
+    )
+
+    started = time.perf_counter()
+    result = _mask_to_cropped_png(image_array, best_mask_original_size, offset=(ox0, oy0))
+    timings.append({"phase": "full", "op": "png", "ms": round((time.perf_counter() - started) * 1000, 3)})
+
+    _refine_stats.record(pipeline["name"], timings)
+    if result is None:
+        raise no_result
+    if include_timings:
+        total_ms = round(sum(t["ms"] for t in timings), 3)
+        result["refine"] = {"preset": pipeline["name"], "timings": timings, "total_ms": total_ms}
+    return result
+
+
+def _mask_to_cropped_png(image_array: np.ndarray, mask: np.ndarray, offset=(0, 0)) -> Optional[dict]:
+    """
+    依 mask（uint8 0/255）的邊界框裁切原圖成透明背景 PNG，回傳 {image, offsetX, offsetY, width, height}；
+    mask 為空時回傳 None。mask 可以只是原圖中的一塊區域，offset 為其左上角 (x, y)。
+    """
+    # 提取 mask 區域的邊界框（mask 內座標）
+    bbox = mask_bbox(mask)
+    if bbox is None:
+        return None
+    mask_y0, mask_y1, mask_x0, mask_x1 = bbox
+    mask_crop = mask[mask_y0:mask_y1, mask_x0:mask_x1]
+
+    # 換算為原圖座標
+    y_min, x_min = mask_y0 + offset[1], mask_x0 + offset[0]
+    y_max, x_max = mask_y1 - 1 + offset[1], mask_x1 - 1 + offset[0]
+
+    x = int(x_min)
+    y = int(y_min)
+    w = int(x_max - x_min + 1)
+    h = int(y_max - y_min + 1)
+
+    # 裁切原圖的 RGB 區域
+    rgb_crop = image_array[y_min:y_max+1, x_min:x_max+1].copy()
+
+    # 創建 alpha 通道：mask 為 True 的地方 alpha=255，False 的地方 alpha=0
+    alpha_channel = mask_crop.astype(np.uint8)
+
+    # 將 RGB 和 alpha 合併成 RGBA
+    rgba_image = np.dstack([rgb_crop, alpha_channel])
+
+    return {
+        "image": _png_data_url(rgba_image),
+        "offsetX": x,
+        "offsetY": y,
+        "width": w,
+        "height": h
+    }
+
+
+def _segment_with_mask_sync(
+    image_array: np.ndarray,
+    image_hash: str,
+    image_session: Optional[dict],
+    mask: str,
+    pipeline: Optional[dict] = None,
+    include_timings: bool = False,
+) -> dict:
+    """/segment-with-mask 的 CPU 密集部分（mask 解碼、SAM 預測、形態學處理），於推論執行器中執行。"""
+    resized_image = _resize_for_sam(image_array)
+    prompt = _prepare_mask_prompt(image_array, mask, resized_image.shape)
+
+    # predictor 內含 set_image 後的狀態，從池中借出一個獨佔使用到預測完成
+    with predictor_pool.checkout() as predictor:
+        # 設置 resize 後的圖像到 SAM predictor（同一張圖已算過嵌入時直接取用快取）
+        _set_image_with_cache(predictor, image_hash, resized_image, session=image_session)
+
         # 執行預測（使用 multimask_output=True 獲取多個候選 mask，然後選擇最佳）
         masks, scores, logits = predictor.predict(
             point_coords=None,
             point_labels=None,
-            box=input_box[np.newaxis, :],
-            mask_input=mask_input,
+            box=prompt["input_box"][np.newaxis, :],
+            mask_input=prompt["mask_input"],
             multimask_output=True  # 改為 True 以獲取多個候選 mask
         )
-        
-        # 選擇分數最高的 mask（通常 scores[0] 是最佳的）
-        best_mask_idx = 0
-        if len(scores) > 1:
-            # 選擇分數最高的 mask
-            best_mask_idx = np.argmax(scores)
-        
-        best_mask = masks[best_mask_idx]
-        best_mask_binary = (best_mask > 0).astype(np.uint8) * 255
-        
-        print(f"調試: 原始 mask 像素數: {(best_mask_binary > 0).sum()}, 尺寸: {best_mask_binary.shape}")
-        
-        # 關鍵修復：立即使用用戶原始 mask 約束預測結果，確保嚴格遵守用戶圈選範圍
-        # 這可以防止 SAM 預測出超出用戶圈選範圍的區域，避免破碎問題
-        best_mask_binary = cv2.bitwise_and(best_mask_binary, resized_mask)
-        print(f"調試: 約束後 mask 像素數: {(best_mask_binary > 0).sum()}")
-        
-        # 形態學處理：填孔 + 平滑 + 去除噪音
-        # 在 resize 之前進行處理，效率更高
-        
-        # 1. CLOSE 操作：先膨脹後腐蝕，用於填補內部小孔洞和連接斷開的區域
-        # 使用較大的 kernel 來填補較大的孔洞
-        kernel_close = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 9))
-        mask_closed = cv2.morphologyEx(best_mask_binary, cv2.MORPH_CLOSE, kernel_close, iterations=3)
-        
-        # 再次約束，確保形態學處理後仍然遵守用戶圈選範圍
-        mask_closed = cv2.bitwise_and(mask_closed, resized_mask)
-        
-        # 2. OPEN 操作：先腐蝕後膨脹，用於去除小噪點、毛刺和邊緣不平滑
-        # 使用較小的 kernel 來精細去除噪點
-        kernel_open = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-        mask_opened = cv2.morphologyEx(mask_closed, cv2.MORPH_OPEN, kernel_open, iterations=1)
-        
-        # 再次約束，確保 OPEN 操作後仍然遵守用戶圈選範圍
-        mask_opened = cv2.bitwise_and(mask_opened, resized_mask)
-        
-        # 3. 再次 CLOSE 以確保邊緣平滑並填補可能殘留的小孔
-        kernel_close_small = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-        mask_final = cv2.morphologyEx(mask_opened, cv2.MORPH_CLOSE, kernel_close_small, iterations=2)
-        
-        # 再次約束，確保最終結果仍然遵守用戶圈選範圍
-        mask_final = cv2.bitwise_and(mask_final, resized_mask)
-        
-        # 4. 可選：使用中值濾波進一步平滑邊緣（去除小噪點）
-        mask_final = cv2.medianBlur(mask_final, 3)
-        
-        # 再次約束，確保中值濾波後仍然遵守用戶圈選範圍
-        mask_final = cv2.bitwise_and(mask_final, resized_mask)
-        
-        # 5. 確保二值化（中值濾波後可能產生灰度值）
-        mask_final = (mask_final > 127).astype(np.uint8) * 255
-        
-        print(f"調試: 形態學處理完成，處理後 mask 像素數: {(mask_final > 0).sum()}")
-        
-        # 將 mask resize 回原始圖像尺寸
-        best_mask_original_size = cv2.resize(
-            mask_final, 
-            (original_width, original_height), 
-            interpolation=cv2.INTER_NEAREST
-        )
-        
-        # 創建用戶原始 mask 的原始尺寸版本，用於約束
-        user_mask_original = cv2.resize(binary_mask, (original_width, original_height), interpolation=cv2.INTER_NEAREST)
-        user_mask_original = (user_mask_original > 127).astype(np.uint8) * 255
-        
-        # 關鍵修復：resize 後立即約束，防止 resize 引入超出範圍的像素
-        best_mask_original_size = cv2.bitwise_and(best_mask_original_size, user_mask_original)
-        
-        # Resize 後進行更強的形態學處理以修復破碎和填補孔洞
-        # 1. 使用較大的 CLOSE kernel 來填補 resize 可能引入的孔洞
-        kernel_close_large = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-        best_mask_original_size = cv2.morphologyEx(
-            best_mask_original_size, 
-            cv2.MORPH_CLOSE, 
-            kernel_close_large, 
-            iterations=3  # 增加迭代次數以更好地填補孔洞
+
+    best_mask = _select_best_mask(masks, scores)
+    result = _refine_predicted_mask(
+        best_mask, prompt["resized_mask"], prompt["binary_mask"], image_array,
+        pipeline=pipeline, include_timings=include_timings,
+    )
+    return {"masks": [result]}
+
+
+# 批次分割：單次請求的 mask 數上限，以及 mask decoder 每批處理的提示數
+SEGMENT_WITH_MASKS_MAX = int(os.environ.get("SEGMENT_WITH_MASKS_MAX", "32"))
+SAM_DECODER_BATCH_SIZE = max(1, int(os.environ.get("SAM_DECODER_BATCH_SIZE", "16")))
+
+
+def _parse_bboxes(bboxes: Optional[str], count: int) -> list:
+    """解析 bboxes 表單欄位：JSON 陣列，每項為原圖座標 [x1, y1, x2, y2] 或 null，須與 masks 等長。"""
+    if not bboxes:
+        return [None] * count
+    try:
+        parsed = json.loads(bboxes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"bboxes 不是有效的 JSON: {e}") from e
+    if not isinstance(parsed, list) or len(parsed) != count:
+        raise HTTPException(status_code=400, detail="bboxes 須為與 masks 等長的陣列")
+    out = []
+    for item in parsed:
+        if item is None:
+            out.append(None)
+            continue
+        if not isinstance(item, list) or len(item) != 4:
+            raise HTTPException(status_code=400, detail=f"無效的 bbox: {item!r}（須為 [x1, y1, x2, y2]）")
+        try:
+            out.append([float(v) for v in item])
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=f"無效的 bbox: {item!r}") from e
+    return out
+
+
+def _segment_with_masks_sync(
+    image_array: np.ndarray,
+    image_hash: str,
+    image_session: Optional[dict],
+    masks: list,
+    bboxes: list,
+    pipeline: Optional[dict] = None,
+    include_timings: bool = False,
+) -> dict:
+    """
+    /segment-with-masks 的 CPU 密集部分：圖片只 resize 與 set_image 一次，所有提示以
+    predict_torch 分批送入 mask decoder，再逐一做與 /segment-with-mask 相同的後處理。
+    個別 mask 無效時該項回傳 {"error": ...}，不影響其他項目。
+    """
+    resized_image = _resize_for_sam(image_array)
+    original_height, original_width = image_array.shape[:2]
+    scale_x = resized_image.shape[1] / original_width
+    scale_y = resized_image.shape[0] / original_height
+
+    results: list = [None] * len(masks)
+    prompts = []
+    for i, (mask, bbox) in enumerate(zip(masks, bboxes)):
+        try:
+            prompt = _prepare_mask_prompt(image_array, mask, resized_image.shape)
+        except HTTPException as e:
+            results[i] = {"error": e.detail}
+            continue
+        if bbox is not None:
+            # 指定 bbox 時以其取代由 mask 推得的 box 提示（原圖座標換算到 resize 後座標）
+            x1, y1, x2, y2 = bbox
+            prompt["input_box"] = np.array([x1 * scale_x, y1 * scale_y, x2 * scale_x, y2 * scale_y])
+        prompts.append((i, prompt))
+
+    best_masks = {}
+    if prompts:
+        with predictor_pool.checkout() as predictor:
+            _set_image_with_cache(predictor, image_hash, resized_image, session=image_session)
+
+            for start in range(0, len(prompts), SAM_DECODER_BATCH_SIZE):
+                batch = prompts[start:start + SAM_DECODER_BATCH_SIZE]
+                boxes = predictor.transform.apply_boxes(
+                    np.stack([p["input_box"] for _, p in batch]), predictor.original_size
+                )
+                boxes_torch = torch.as_tensor(boxes, dtype=torch.float, device=predictor.device)
+                # 每個 mask_input 為 [1, 256, 256]，堆疊成 [B, 1, 256, 256]
+                mask_input_torch = torch.as_tensor(
+                    np.stack([p["mask_input"] for _, p in batch]),
+                    dtype=torch.float,
+                    device=predictor.device,
+                )
+                masks_torch, scores_torch, _ = predictor.predict_torch(
+                    point_coords=None,
+                    point_labels=None,
+                    boxes=boxes_torch,
+                    mask_input=mask_input_torch,
+                    multimask_output=True,
+                )
+                masks_np = masks_torch.detach().cpu().numpy()
+                scores_np = scores_torch.detach().cpu().numpy()
+                for j, (i, _) in enumerate(batch):
+                    best_masks[i] = _select_best_mask(masks_np[j], scores_np[j])
+
+    # 後處理不需要 predictor，先歸還給池再做
+    for i, prompt in prompts:
+        try:
+            results[i] = _refine_predicted_mask(
+                best_masks.pop(i), prompt["resized_mask"], prompt["binary_mask"], image_array,
+                pipeline=pipeline, include_timings=include_timings,
+            )
+        except HTTPException as e:
+            results[i] = {"error": e.detail}
+
+    return {"masks": results}
+
+
+@app.post("/segment-with-masks")
+async def segment_with_masks(
+    file: Optional[UploadFile] = File(None),
+    masks: list[str] = Form(...),
+    bboxes: Optional[str] = Form(None),
+    image_id: Optional[str] = Form(None),
+    refine: Optional[str] = Form(None),
+    timings: bool = Form(False)
+):
+    """
+    以多個 mask 提示批次分割同一張圖（圖片嵌入只計算一次）。
+    masks 為重複的表單欄位（每個皆為 base64 編碼的 mask）；bboxes 為選填的 JSON 陣列，
+    與 masks 等長，每項為原圖座標 [x1, y1, x2, y2] 或 null，指定時取代由 mask 推得的 box 提示。
+    回傳 {"masks": [...]}，順序與輸入相同，每項為 {image, offsetX, offsetY, width, height}，
+    該 mask 無法分割時為 {"error": ...}。
+    refine 與 timings 同 /segment-with-mask。
+    """
+    if predictor_pool is None:
+        raise HTTPException(status_code=503, detail="模型尚未載入，請檢查模型文件是否存在")
+    if not masks:
+        raise HTTPException(status_code=400, detail="masks 不可為空")
+    if len(masks) > SEGMENT_WITH_MASKS_MAX:
+        raise HTTPException(
+            status_code=400, detail=f"masks 數量超過上限 {SEGMENT_WITH_MASKS_MAX}"
         )
-        # 約束：確保遵守用戶原始圈選範圍
-        best_mask_original_size = cv2.bitwise_and(best_mask_original_size, user_mask_original)
-        
-        # 2. 使用 OPEN 去除小噪點，但使用較小的 kernel 避免過度去除
-        kernel_open_small = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-        best_mask_original_size = cv2.morphologyEx(
-            best_mask_original_size, 
-            cv2.MORPH_OPEN, 
-            kernel_open_small, 
-            iterations=1
+    bbox_list = _parse_bboxes(bboxes, len(masks))
+    pipeline = _resolve_refine_pipeline(refine)
+
+    try:
+        image_array, image_hash, image_session = await _read_image_input(file, image_id)
+
+        return await _inference_executor.run(
+            _segment_with_masks_sync, image_array, image_hash, image_session, masks, bbox_list,
+            pipeline, timings,
         )
-        # 約束：確保 OPEN 操作後仍然遵守用戶圈選範圍
-        best_mask_original_size = cv2.bitwise_and(best_mask_original_size, user_mask_original)
-        
-        # 3. 再次 CLOSE 以確保邊緣平滑並填補可能殘留的小孔
-        kernel_close_medium = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-        best_mask_original_size = cv2.morphologyEx(
-            best_mask_original_size, 
-            cv2.MORPH_CLOSE, 
-            kernel_close_medium, 
-            iterations=2
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"處理圖片時發生錯誤: {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"處理圖片時發生錯誤: {str(e)}")
+
+
+@app.post("/segment-with-mask")
+async def segment_with_mask(
+    file: Optional[UploadFile] = File(None),
+    mask: str = Form(...),
+    bbox: str = Form(None),
+    image_id: Optional[str] = Form(None),
+    refine: Optional[str] = Form(None),
+    timings: bool = Form(False)
+):
+    """
+    使用 mask 提示進行分割
+    接收原始圖片（或 POST /images 取得的 image_id）和 mask（base64 編碼），返回分割結果
+    refine 選擇後處理管線：預設組合名稱（legacy / fast / none，預設為 SEGMENT_REFINE_PRESET），
+    或 {"sam": [...], "full": [...]} 的 JSON；timings 為 true 時每個結果另附各步驟耗時（refine 欄位）。
+    """
+    # 檢查模型是否已載入
+    if predictor_pool is None:
+        raise HTTPException(status_code=503, detail="模型尚未載入，請檢查模型文件是否存在")
+    pipeline = _resolve_refine_pipeline(refine)
+    
+    try:
+        # 讀取原始圖像（或工作階段中已解碼的圖）
+        image_array, image_hash, image_session = await _read_image_input(file, image_id)
+
+        return await _inference_executor.run(
+            _segment_with_mask_sync, image_array, image_hash, image_session, mask,
+            pipeline, timings,
         )
-        # 最終約束：確保最終結果嚴格遵守用戶圈選範圍
-        best_mask_original_size = cv2.bitwise_and(best_mask_original_size, user_mask_original)
-        
-        # 4. 使用 GaussianBlur 平滑邊緣，然後二值化
-        best_mask_original_size = cv2.GaussianBlur(best_mask_original_size, (5, 5), 1.5)
-        best_mask_original_size = (best_mask_original_size > 127).astype(np.uint8) * 255
-        
-        # 5. 使用中值濾波進一步平滑邊緣，減少鋸齒狀邊緣
-        best_mask_original_size = cv2.medianBlur(best_mask_original_size, 5)  # 使用 5x5 而不是 3x3
-        
-        # 最終約束：確保中值濾波後仍然遵守用戶圈選範圍
-        best_mask_original_size = cv2.bitwise_and(best_mask_original_size, user_mask_original)
-        
-        # 6. 填充內部孔洞（使用 floodFill）
-        # 找到所有連通區域，填充內部孔洞
-        h, w = best_mask_original_size.shape
-        mask_filled = best_mask_original_size.copy()
-        
-        # 從邊緣開始 floodFill，將邊緣外的區域標記為背景
-        # 然後反轉，填充內部孔洞
-        mask_inv = cv2.bitwise_not(mask_filled)
-        mask_temp = mask_inv.copy()
-        
-        # 填充邊緣外的區域
-        cv2.floodFill(mask_temp, None, (0, 0), 255)
-        cv2.floodFill(mask_temp, None, (w-1, 0), 255)
-        cv2.floodFill(mask_temp, None, (0, h-1), 255)
-        cv2.floodFill(mask_temp, None, (w-1, h-1), 255)
-        
-        # 反轉得到填充後的 mask（邊緣外的區域被填充，內部孔洞也被填充）
-        mask_filled = cv2.bitwise_not(mask_temp)
-        
-        # 約束：確保填充後仍然遵守用戶圈選範圍
-        best_mask_original_size = cv2.bitwise_and(mask_filled, user_mask_original)
-        
-        # 7. 確保二值化
-        best_mask_original_size = (best_mask_original_size > 127).astype(np.uint8) * 255
-        
-        # 提取 mask 區域的邊界框（基於原始尺寸的 mask）
-        coords = np.column_stack(np.where(best_mask_original_size > 0))
-        if len(coords) == 0:
-            raise HTTPException(status_code=400, detail="No valid segmentation result")
-        
-        y_min, x_min = coords.min(axis=0)
-        y_max, x_max = coords.max(axis=0)
-        
-        x = int(x_min)
-        y = int(y_min)
-        w = int(x_max - x_min + 1)
-        h = int(y_max - y_min + 1)
-        
-        # 裁切原圖的 RGB 區域
-        rgb_crop = image_array[y_min:y_max+1, x_min:x_max+1].copy()
-        
-        # 裁切 mask 區域（基於原始尺寸）
-        mask_crop = best_mask_original_size[y_min:y_max+1, x_min:x_max+1]
-        
-        # 創建 alpha 通道：mask 為 True 的地方 alpha=255，False 的地方 alpha=0
-        alpha_channel = mask_crop.astype(np.uint8)
-        
-        # 將 RGB 和 alpha 合併成 RGBA
-        rgba_image = np.dstack([rgb_crop, alpha_channel])
-        
-        # 創建 RGBA 模式的 PIL Image
-        pil_rgba = Image.fromarray(rgba_image, mode='RGBA')
-        
-        # 轉換為 base64
-        buffer = BytesIO()
-        pil_rgba.save(buffer, format='PNG')
-        buffer.seek(0)
-        base64_str = base64.b64encode(buffer.read()).decode('utf-8')
-        base64_url = f"data:image/png;base64,{base64_str}"
-        
-        result_masks = [{
-            "image": base64_url,
-            "offsetX": x,
-            "offsetY": y,
-            "width": w,
-            "height": h
-        }]
-        
-        return {"masks": result_masks}
     
     except HTTPException:
         raise
@@ -961,6 +2756,178 @@ async def segment_with_mask(
         raise HTTPException(status_code=500, detail=f"處理圖片時發生錯誤: {str(e)}")
 
 
+def _session_sam_input(session: dict) -> np.ndarray:
+    """工作階段圖片 resize 到 SAM 輸入尺寸的結果（首次計算後保存在工作階段，點選互動不必每次 resize）。"""
+    resized = session.get("sam_input")
+    if resized is None:
+        resized = _resize_for_sam(session["array"])
+        resized.setflags(write=False)
+        session["sam_input"] = resized
+    return resized
+
+
+class PromptSegmentBody(BaseModel):
+    image_id: str = Field(..., description="POST /images 取得的 image_id")
+    points: Optional[list[list[float]]] = Field(
+        None, description="點擊座標 [[x, y], ...]（原圖像素座標）"
+    )
+    labels: Optional[list[int]] = Field(
+        None, description="與 points 等長，1 = 前景、0 = 背景；省略時全部視為前景"
+    )
+    boxes: Optional[list[list[float]]] = Field(
+        None, description="框選 [[x1, y1, x2, y2], ...]（原圖像素座標）；每個框各自分割出一個物件"
+    )
+    multimask: Optional[bool] = Field(
+        None, description="是否讓 SAM 產生多個候選再取最高分；省略時僅單一點擊使用"
+    )
+    output: str = Field("rle", description="rle（裁切格式 RLE）或 png（裁切後的透明背景 PNG）")
+
+
+def _segment_prompt_sync(
+    image_array: np.ndarray,
+    image_hash: str,
+    image_session: dict,
+    points: Optional[np.ndarray],
+    labels: Optional[np.ndarray],
+    boxes: Optional[np.ndarray],
+    multimask: bool,
+    output: str,
+) -> dict:
+    """
+    /segment-prompt 的推論部分：沿用 resize 後圖片的嵌入（與 /segment-with-mask 共用快取），
+    以原圖座標的點／框提示執行 mask decoder，輸出直接為原圖解析度。
+    """
+    resized_image = _session_sam_input(image_session)
+    with predictor_pool.checkout() as predictor:
+        _set_image_with_cache(predictor, image_hash, resized_image, session=image_session)
+        # 嵌入以 resize 後的圖計算；把 original_size 設為原圖尺寸，SAM 便會將原圖座標換算到模型輸入，
+        # 並把低解析度 logits 直接放大到原圖尺寸（predictor 歸還時會 reset_image）
+        predictor.original_size = tuple(image_array.shape[:2])
+
+        if boxes is None or len(boxes) <= 1:
+            masks, scores, _ = predictor.predict(
+                point_coords=points,
+                point_labels=labels,
+                box=boxes[0] if boxes is not None else None,
+                multimask_output=multimask,
+            )
+            masks, scores = masks[np.newaxis], scores[np.newaxis]
+        else:
+            # 多個框：各自為一個物件，點提示（若有）套用到每個框，以 predict_torch 一次解碼
+            n = len(boxes)
+            boxes_torch = torch.as_tensor(
+                predictor.transform.apply_boxes(boxes, predictor.original_size),
+                dtype=torch.float,
+                device=predictor.device,
+            )
+            coords_torch = labels_torch = None
+            if points is not None:
+                coords = predictor.transform.apply_coords(points, predictor.original_size)
+                coords_torch = torch.as_tensor(
+                    np.broadcast_to(coords, (n, *coords.shape)).copy(),
+                    dtype=torch.float,
+                    device=predictor.device,
+                )
+                labels_torch = torch.as_tensor(
+                    np.broadcast_to(labels, (n, len(labels))).copy(),
+                    dtype=torch.int,
+                    device=predictor.device,
+                )
+            masks_torch, scores_torch, _ = predictor.predict_torch(
+                point_coords=coords_torch,
+                point_labels=labels_torch,
+                boxes=boxes_torch,
+                multimask_output=multimask,
+            )
+            masks = masks_torch.detach().cpu().numpy()
+            scores = scores_torch.detach().cpu().numpy()
+
+    # 每個物件取分數最高的 mask，得到 [N, H, W] 的原圖解析度堆疊
+    best_idx = np.argmax(scores, axis=1)
+    best_masks = masks[np.arange(len(masks)), best_idx]
+    best_scores = scores[np.arange(len(scores)), best_idx]
+
+    results = [
+        {"score": float(score), "area": int(best.sum())}
+        for best, score in zip(best_masks, best_scores)
+    ]
+    if output == "png":
+        for entry, best in zip(results, best_masks):
+            png = _mask_to_cropped_png(image_array, best.astype(np.uint8) * 255)
+            if png is None:
+                entry["error"] = "No valid segmentation result"
+            else:
+                entry.update(png)
+    else:
+        bboxes = []
+        for best in best_masks:
+            roi = mask_bbox(best)
+            if roi is not None:
+                y0, y1, x0, x1 = roi
+                bboxes.append([x0, y0, x1 - x0, y1 - y0])
+            else:
+                bboxes.append([0, 0, 0, 0])
+        for entry, bbox, rle in zip(results, bboxes, masks_to_rle(best_masks, bboxes=bboxes)):
+            entry["bbox"] = bbox
+            entry["rle"] = rle
+
+    return {"masks": results, "image_size": [int(image_array.shape[0]), int(image_array.shape[1])]}
+
+
+@app.post("/segment-prompt")
+async def segment_prompt(body: PromptSegmentBody):
+    """
+    以點擊點（含前景／背景標籤）和／或框選進行互動分割，JSON 輸入、無需上傳 mask 圖。
+    需先以 POST /images 取得 image_id；同一張圖的嵌入計算過一次後，之後每次點選只需執行 mask decoder。
+    回傳 {"masks": [...], "image_size": [H, W]}，每個框（或沒有框時的點提示）一項：
+    output=rle 時含 score、area、bbox [x, y, w, h] 與裁切格式 rle；output=png 時含
+    {image, offsetX, offsetY, width, height}。
+    """
+    if predictor_pool is None:
+        raise HTTPException(status_code=503, detail="模型尚未載入，請檢查模型文件是否存在")
+    if body.output not in ("rle", "png"):
+        raise HTTPException(status_code=400, detail="output 僅支援 rle 或 png")
+    if not body.points and not body.boxes:
+        raise HTTPException(status_code=400, detail="需提供 points 或 boxes")
+
+    points = labels = boxes = None
+    if body.points:
+        if any(len(p) != 2 for p in body.points):
+            raise HTTPException(status_code=400, detail="points 每項須為 [x, y]")
+        points = np.array(body.points, dtype=np.float64)
+        if body.labels is None:
+            labels = np.ones(len(points), dtype=np.int64)
+        elif len(body.labels) != len(points):
+            raise HTTPException(status_code=400, detail="labels 須與 points 等長")
+        else:
+            labels = np.array(body.labels, dtype=np.int64)
+    if body.boxes:
+        if any(len(b) != 4 for b in body.boxes):
+            raise HTTPException(status_code=400, detail="boxes 每項須為 [x1, y1, x2, y2]")
+        if len(body.boxes) > SEGMENT_WITH_MASKS_MAX:
+            raise HTTPException(
+                status_code=400, detail=f"boxes 數量超過上限 {SEGMENT_WITH_MASKS_MAX}"
+            )
+        boxes = np.array(body.boxes, dtype=np.float64)
+    multimask = body.multimask
+    if multimask is None:
+        # SAM 建議：單一點擊較模糊，產生多個候選取最高分；多點或有框時單一輸出較準確
+        multimask = boxes is None and points is not None and len(points) == 1
+
+    image_array, image_hash, image_session = await _read_image_input(None, body.image_id)
+    return await _inference_executor.run(
+        _segment_prompt_sync,
+        image_array,
+        image_hash,
+        image_session,
+        points,
+        labels,
+        boxes,
+        multimask,
+        body.output,
+    )
+
+
 def _decode_base64_image_data(image_data: str) -> bytes:
     """接受純 Base64 或 data:image/...;base64, 前綴。"""
     s = (image_data or "").strip()
@@ -973,155 +2940,483 @@ def _decode_base64_image_data(image_data: str) -> bytes:
         raise HTTPException(status_code=400, detail=f"無效的 image_data（Base64）: {e}") from e
 
 
-def _download_video_from_gcs_uri(gs_uri: str) -> tuple[bytes, str]:
-    """從 gs://bucket/object 下載影片位元組（需 Service Account 有該物件讀取權限）。"""
-    from google.cloud import storage
+# 自 GCS 串流下載影片時每次讀取的大小
+VEO_GCS_CHUNK_BYTES = int(os.environ.get("VEO_GCS_CHUNK_BYTES", str(8 * 1024 * 1024)))
+
+_gcs_client = None
+_gcs_client_lock = threading.Lock()
+
 
+def _get_gcs_client():
+    """
+    取得共用的 google.cloud.storage Client（首次呼叫時建立，之後重複使用其連線池）。
+    設定 STORAGE_EMULATOR_HOST 時 Client 會連到本機模擬的 GCS 伺服器；亦可直接替換 _gcs_client。
+    """
+    global _gcs_client
+    with _gcs_client_lock:
+        if _gcs_client is None:
+            from google.cloud import storage
+
+            _gcs_client = storage.Client(project=VERTEX_AI_PROJECT)
+        return _gcs_client
+
+
+def _download_video_from_gcs_uri(
+    gs_uri: str, store: _VideoJobStore, client=None
+) -> tuple[str, int, str]:
+    """
+    從 gs://bucket/object 分段下載影片，直接寫入任務存放的影片檔（需 Service Account 有該物件讀取權限），
+    並以物件的 MD5 與大小驗證內容。回傳 (sha256, 位元組數, mime)。
+    """
     if not gs_uri.startswith("gs://"):
         raise ValueError(f"非 GCS URI: {gs_uri}")
     rest = gs_uri[5:]
     if "/" not in rest:
         raise ValueError(f"無效的 GCS URI: {gs_uri}")
     bucket_name, blob_path = rest.split("/", 1)
-    client = storage.Client(project=VERTEX_AI_PROJECT)
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    data = blob.download_as_bytes()
+    if client is None:
+        client = _get_gcs_client()
+    # get_blob 會載入中繼資料（大小、MD5、generation），之後的讀取固定在同一個 generation
+    blob = client.bucket(bucket_name).get_blob(blob_path)
+    if blob is None:
+        raise FileNotFoundError(f"GCS 物件不存在: {gs_uri}")
     mime = blob.content_type or "video/mp4"
-    return data, mime
+    md5 = hashlib.md5()
+    received = 0
+
+    def chunks():
+        nonlocal received
+        with blob.open("rb", chunk_size=VEO_GCS_CHUNK_BYTES) as f:
+            while True:
+                chunk = f.read(VEO_GCS_CHUNK_BYTES)
+                if not chunk:
+                    break
+                md5.update(chunk)
+                received += len(chunk)
+                yield chunk
+
+    def verify():
+        if blob.size is not None and received != blob.size:
+            raise RuntimeError(f"GCS 下載大小不符: 預期 {blob.size}，實際 {received}（{gs_uri}）")
+        # 複合物件沒有 MD5，只能略過
+        if blob.md5_hash and base64.b64encode(md5.digest()).decode("ascii") != blob.md5_hash:
+            raise RuntimeError(f"GCS 下載 MD5 校驗失敗: {gs_uri}")
+
+    sha, size = store.write_video(chunks(), mime, verify=verify)
+    return sha, size, mime
+
+
+def _veo_config_kwargs() -> dict:
+    """影響生成內容的 GenerateVideosConfig 參數（不含輸出位置）。"""
+    return {
+        "duration_seconds": int(os.environ.get("VEO_DURATION_SECONDS", "5")),
+        "aspect_ratio": os.environ.get("VEO_ASPECT_RATIO", "16:9"),
+        "number_of_videos": 1,
+        "person_generation": VEO_PERSON_GENERATION or "allow_adult",
+    }
 
 
-def _run_veo_video_job(job_id: str, image_bytes: bytes, prompt: str) -> None:
-    """於背景執行緒內呼叫 Veo，並更新 _video_jobs。任務開始即納入 try，確保任何例外都寫入 failed。"""
-    from google.genai import types
+def _normalize_veo_prompt(prompt: str) -> str:
+    """去重用的 prompt 正規化：NFKC（全形／半形一致）並合併連續空白。"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
 
-    try:
-        with _video_jobs_lock:
-            if job_id not in _video_jobs:
-                print(
-                    f"Veo 背景任務中止：job_id 不在 _video_jobs（可能主進程已重載）: {job_id}"
-                )
-                return
-            _video_jobs[job_id]["status"] = "running"
-            _video_jobs[job_id]["message"] = "正在生成影片…"
 
-        if genai_client is None:
-            raise RuntimeError("GenAI Client 未初始化，請檢查 vertex-key.json 與 Vertex AI 設定")
+def _veo_request_key(image_bytes: bytes, prompt: str) -> str:
+    """相同圖片、prompt、模型與生成設定的請求共用同一個鍵（用於 /generate-video 去重）。"""
+    payload = {
+        "image_sha256": hashlib.sha256(image_bytes).hexdigest(),
+        "prompt": _normalize_veo_prompt(prompt),
+        "model": VEO_MODEL_ID,
+        "config": _veo_config_kwargs(),
+        "safety_threshold": _veo_resolve_safety_block_threshold(),
+        "safety_image_categories": _veo_safety_include_image_categories(),
+    }
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
 
-        _install_veo_generate_videos_safety_patch()
 
-        gcs_out = VEO_OUTPUT_GCS_URI
-        config_kwargs = {
-            "duration_seconds": int(os.environ.get("VEO_DURATION_SECONDS", "5")),
-            "aspect_ratio": os.environ.get("VEO_ASPECT_RATIO", "16:9"),
-            "number_of_videos": 1,
-            "person_generation": VEO_PERSON_GENERATION or "allow_adult",
-        }
-        if gcs_out:
-            config_kwargs["output_gcs_uri"] = gcs_out
-
-        safety_list = _veo_safety_settings_as_genai_types()
-        veo_debug_json = _veo_debug_predict_request_json(
-            model_id=VEO_MODEL_ID,
-            prompt=prompt,
-            image_bytes=image_bytes,
-            image_mime="image/png",
-            config_kwargs=config_kwargs,
-            safety_settings=safety_list,
-            person_generation=config_kwargs["person_generation"],
-        )
+def _submit_veo_operation(client, job_id: str, image_bytes: bytes, prompt: str):
+    """送出 Veo generate_videos 請求（阻塞呼叫，於執行緒中執行），回傳 (長時間作業, 除錯用請求內容)。"""
+    from google.genai import types
 
-        _veo_tls.safety_settings = safety_list
+    _install_veo_generate_videos_safety_patch()
+
+    gcs_out = VEO_OUTPUT_GCS_URI
+    config_kwargs = _veo_config_kwargs()
+    if gcs_out:
+        config_kwargs["output_gcs_uri"] = gcs_out
+
+    safety_list = _veo_safety_settings_as_genai_types()
+    veo_debug_json = _veo_debug_predict_request_json(
+        model_id=VEO_MODEL_ID,
+        prompt=prompt,
+        image_bytes=image_bytes,
+        image_mime="image/png",
+        config_kwargs=config_kwargs,
+        safety_settings=safety_list,
+        person_generation=config_kwargs["person_generation"],
+    )
+
+    _veo_tls.safety_settings = safety_list
+    try:
         try:
-            try:
-                operation = genai_client.models.generate_videos(
-                    model=VEO_MODEL_ID,
-                    source=types.GenerateVideosSource(
-                        prompt=prompt,
-                        image=types.Image(
-                            image_bytes=image_bytes, mime_type="image/png"
-                        ),
+            operation = client.models.generate_videos(
+                model=VEO_MODEL_ID,
+                source=types.GenerateVideosSource(
+                    prompt=prompt,
+                    image=types.Image(
+                        image_bytes=image_bytes, mime_type="image/png"
                     ),
-                    config=types.GenerateVideosConfig(**config_kwargs),
-                )
-            except Exception as exc:
-                _veo_print_request_debug(
-                    f"generate_videos 例外 job={job_id}", veo_debug_json
-                )
-                try:
-                    from google.genai.errors import APIError
-
-                    if isinstance(exc, APIError):
-                        print(f"Veo APIError.details: {exc.details!r}")
-                        resp = getattr(exc, "response", None)
-                        if resp is not None and hasattr(resp, "text"):
-                            print(f"Veo APIError HTTP body:\n{resp.text}")
-                except ImportError:
-                    pass
-                raise
-        finally:
-            if hasattr(_veo_tls, "safety_settings"):
-                delattr(_veo_tls, "safety_settings")
+                ),
+                config=types.GenerateVideosConfig(**config_kwargs),
+            )
+        except Exception as exc:
+            _veo_print_request_debug(
+                f"generate_videos 例外 job={job_id}", veo_debug_json
+            )
+            try:
+                from google.genai.errors import APIError
 
-        with _video_jobs_lock:
-            _video_jobs[job_id]["gcp_operation_name"] = operation.name
+                if isinstance(exc, APIError):
+                    print(f"Veo APIError.details: {exc.details!r}")
+                    resp = getattr(exc, "response", None)
+                    if resp is not None and hasattr(resp, "text"):
+                        print(f"Veo APIError HTTP body:\n{resp.text}")
+            except ImportError:
+                pass
+            raise
+    finally:
+        if hasattr(_veo_tls, "safety_settings"):
+            delattr(_veo_tls, "safety_settings")
 
-        while operation.done is not True:
-            time.sleep(_VEO_POLL_INTERVAL_SEC)
-            operation = genai_client.operations.get(operation)
-            with _video_jobs_lock:
-                _video_jobs[job_id]["message"] = "影片生成進行中，請稍候…"
+    return operation, veo_debug_json
+
+
+def _veo_operation_from_name(operation_name: str):
+    """以作業名稱重建長時間作業物件（服務重啟或接手其他進程的任務時使用）。"""
+    from google.genai import types
 
-        if operation.error:
+    return types.GenerateVideosOperation(name=operation_name)
+
+
+def _store_veo_result(store: _VideoJobStore, job_id: str, operation, veo_debug_json: Optional[dict]) -> None:
+    """自已完成的長時間作業取出影片（必要時自 GCS 下載）並寫入任務存放（阻塞，於執行緒中執行）。"""
+    if operation.error:
+        if veo_debug_json is not None:
             _veo_print_request_debug(
                 f"長運算完成但回傳錯誤 job={job_id}", veo_debug_json
             )
-            err = operation.error
-            raise RuntimeError(str(err))
-
-        result = operation.response or operation.result
-        if not result or not result.generated_videos:
-            raise RuntimeError("完成後未取得影片結果")
-
-        gv0 = result.generated_videos[0]
-        video = gv0.video if gv0 else None
-        if not video:
-            raise RuntimeError("回應中無 video 物件")
-
-        raw: bytes
-        mime = video.mime_type or "video/mp4"
-        if video.video_bytes:
-            raw = video.video_bytes
-        elif video.uri and video.uri.startswith("gs://"):
-            with _video_jobs_lock:
-                _video_jobs[job_id]["message"] = "正在從雲端儲存取得影片…"
-            raw, mime = _download_video_from_gcs_uri(video.uri)
+        err = operation.error
+        raise RuntimeError(str(err))
+
+    result = operation.response or operation.result
+    if not result or not result.generated_videos:
+        raise RuntimeError("完成後未取得影片結果")
+
+    gv0 = result.generated_videos[0]
+    video = gv0.video if gv0 else None
+    if not video:
+        raise RuntimeError("回應中無 video 物件")
+
+    mime = video.mime_type or "video/mp4"
+    if video.video_bytes:
+        sha, size = store.write_video([video.video_bytes], mime)
+    elif video.uri and video.uri.startswith("gs://"):
+        store.update(job_id, active_only=True, message="正在從雲端儲存取得影片…")
+        sha, size, mime = _download_video_from_gcs_uri(video.uri, store)
+    else:
+        raise RuntimeError(f"未取得影片位元組或 GCS URI: uri={video.uri!r}")
+
+    store.complete_with_video(job_id, sha, size, mime)
+
+
+class _VeoScheduler:
+    """
+    單一 asyncio 排程器管理所有進行中的 Veo 任務：以 heap 依下次輪詢時間排序，
+    輪詢間隔由初始值逐次拉長到上限；所有 API 呼叫共用並行上限與最短呼叫間隔。
+    阻塞的 SDK 呼叫與 SQLite 存取在執行緒中執行，不再為每個任務佔用一條睡眠中的執行緒。
+
+    client_factory / operation_factory / submit_operation 可替換成本機假物件（例如測試時模擬 genai client）。
+    另定期替本進程的任務續約，並接手租約過期（原進程已結束）的任務。
+    """
+
+    def __init__(
+        self,
+        store: _VideoJobStore,
+        client_factory,
+        operation_factory=_veo_operation_from_name,
+        submit_operation=_submit_veo_operation,
+        *,
+        poll_initial: float,
+        poll_max: float,
+        backoff: float,
+        concurrency: int,
+        min_interval: float,
+        max_errors: int,
+    ):
+        self.store = store
+        self.client_factory = client_factory
+        self.operation_factory = operation_factory
+        self.submit_operation = submit_operation
+        self.poll_initial = poll_initial
+        self.poll_max = max(poll_initial, poll_max)
+        self.backoff = max(1.0, backoff)
+        self.concurrency = max(1, concurrency)
+        self.min_interval = max(0.0, min_interval)
+        self.max_errors = max(1, max_errors)
+        # (下次輪詢時間, 序號, job_id)；取消的任務留在 heap 中，取出時略過
+        self._heap: list = []
+        self._seq = itertools.count()
+        # job_id -> {"operation", "interval", "errors", "debug"}：等待下次輪詢的任務
+        self._jobs: dict[str, dict] = {}
+        # job_id -> 送出或輪詢中的 asyncio.Task
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._runner: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._rate_lock: Optional[asyncio.Lock] = None
+        self._next_call_at = 0.0
+        self.api_calls = 0
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._rate_lock = asyncio.Lock()
+        self._runner = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """停止排程；進行中的任務保留在資料庫，租約到期後由下次啟動的進程接手。"""
+        tasks = list(self._tasks.values())
+        if self._runner is not None:
+            tasks.append(self._runner)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._runner = None
+        self._tasks.clear()
+        self._jobs.clear()
+        self._heap.clear()
+
+    def submit(self, job_id: str, image_bytes: bytes, prompt: str) -> None:
+        """排入新任務（需在事件迴圈中呼叫）。"""
+        self._start_task(job_id, self._submit(job_id, image_bytes, prompt))
+
+    def cancel(self, job_id: str) -> bool:
+        """停止追蹤任務（狀態由呼叫端寫入資料庫）；本進程有此任務時回傳 True。"""
+        found = self._jobs.pop(job_id, None) is not None
+        task = self._tasks.pop(job_id, None)
+        if task is not None:
+            task.cancel()
+            found = True
+        return found
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": _WORKER_ID,
+            "waiting": len(self._jobs),
+            "in_flight": len(self._tasks),
+            "concurrency": self.concurrency,
+            "min_interval_sec": self.min_interval,
+            "poll_initial_sec": self.poll_initial,
+            "poll_max_sec": self.poll_max,
+            "api_calls": self.api_calls,
+        }
+
+    def _push(self, job_id: str, delay: float) -> None:
+        due = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self._heap, (due, next(self._seq), job_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _start_task(self, job_id: str, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks[job_id] = task
+
+        def _done(t: asyncio.Task) -> None:
+            if self._tasks.get(job_id) is t:
+                del self._tasks[job_id]
+            if t.cancelled() or t.exception() is not None:
+                return
+            delay = t.result()
+            if delay is not None and job_id in self._jobs:
+                self._push(job_id, delay)
+
+        task.add_done_callback(_done)
+
+    async def _call(self, fn, *args):
+        """受並行上限與最短呼叫間隔限制的 API 呼叫；阻塞的 SDK 呼叫於執行緒中執行。"""
+        async with self._semaphore:
+            async with self._rate_lock:
+                loop = asyncio.get_running_loop()
+                wait = self._next_call_at - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._next_call_at = loop.time() + self.min_interval
+            self.api_calls += 1
+            return await asyncio.to_thread(fn, *args)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        housekeeping_interval = max(1.0, VIDEO_JOB_LEASE_SEC / 3)
+        next_housekeeping = loop.time()
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+            if now >= next_housekeeping:
+                await self._housekeeping()
+                next_housekeeping = now + housekeeping_interval
+            while self._heap and self._heap[0][0] <= now:
+                _, _, job_id = heapq.heappop(self._heap)
+                if job_id in self._jobs and job_id not in self._tasks:
+                    self._start_task(job_id, self._poll(job_id))
+            timeout = next_housekeeping - now
+            if self._heap:
+                timeout = min(timeout, self._heap[0][0] - now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _housekeeping(self) -> None:
+        try:
+            await asyncio.to_thread(self.store.renew_leases, set(self._jobs) | set(self._tasks))
+            for job in await asyncio.to_thread(self.store.claim_orphans):
+                await self._adopt(job)
+        except Exception as e:
+            print(f"Veo 排程器整理任務時發生錯誤: {e}")
+
+    async def _adopt(self, job: dict) -> None:
+        """
+        接手租約過期的進行中任務：已有 gcp_operation_name 者恢復輪詢；
+        尚未送出（沒有作業名稱）者因原始圖片未保存，只能標記失敗。
+        """
+        job_id = job["job_id"]
+        op_name = job.get("gcp_operation_name")
+        if not op_name:
+            reason = ("服務重啟時任務尚未送出，請重新提交生成", "INTERRUPTED")
+        elif self.client_factory() is None:
+            reason = ("服務重啟後 Veo 未就緒，無法接續此任務", "VEO_UNAVAILABLE")
         else:
-            raise RuntimeError(f"未取得影片位元組或 GCS URI: uri={video.uri!r}")
-
-        with _video_jobs_lock:
-            _video_jobs[job_id]["status"] = "completed"
-            _video_jobs[job_id]["message"] = "完成"
-            _video_jobs[job_id]["video_bytes"] = raw
-            _video_jobs[job_id]["video_mime_type"] = mime
-            # 大檔不塞 Base64，改以 /video-result/{job_id} 播放
-            max_b64 = int(os.environ.get("VEO_MAX_BASE64_BYTES", str(2 * 1024 * 1024)))
-            if len(raw) <= max_b64:
-                _video_jobs[job_id]["video_base64"] = base64.b64encode(raw).decode("ascii")
-            else:
-                _video_jobs[job_id]["video_base64"] = None
-            _video_jobs[job_id]["video_url"] = f"/video-result/{job_id}"
+            print(f"接續輪詢 Veo 任務 {job_id}（{op_name}）")
+            self._jobs[job_id] = {
+                "operation": self.operation_factory(op_name),
+                "interval": self.poll_initial,
+                "errors": 0,
+                "debug": None,
+            }
+            self._push(job_id, 0)
+            return
+        await asyncio.to_thread(
+            self.store.update,
+            job_id,
+            active_only=True,
+            status="failed",
+            message=reason[0],
+            error=reason[1],
+            lease_until=None,
+        )
 
-    except Exception as e:
+    async def _fail(self, job_id: str, e: Exception) -> None:
         print(f"Veo 任務 {job_id} 失敗: {e}")
         import traceback
 
-        traceback.print_exc()
-        with _video_jobs_lock:
-            if job_id in _video_jobs:
-                _video_jobs[job_id]["status"] = "failed"
-                _video_jobs[job_id]["message"] = str(e)
-                _video_jobs[job_id]["error"] = str(e)
+        traceback.print_exception(e)
+        await asyncio.to_thread(
+            self.store.update,
+            job_id,
+            active_only=True,
+            status="failed",
+            message=str(e),
+            error=str(e),
+            lease_until=None,
+        )
+
+    async def _submit(self, job_id: str, image_bytes: bytes, prompt: str) -> Optional[float]:
+        """送出生成請求；回傳距離第一次輪詢的秒數（任務已取消或失敗時回傳 None）。"""
+        try:
+            updated = await asyncio.to_thread(
+                self.store.update, job_id, active_only=True, status="running", message="正在生成影片…"
+            )
+            if not updated:
+                print(f"Veo 任務中止：找不到 job_id 或任務已取消: {job_id}")
+                return None
+            client = self.client_factory()
+            if client is None:
+                raise RuntimeError("GenAI Client 未初始化，請檢查 vertex-key.json 與 Vertex AI 設定")
+            operation, veo_debug_json = await self._call(
+                self.submit_operation, client, job_id, image_bytes, prompt
+            )
+            updated = await asyncio.to_thread(
+                self.store.update, job_id, active_only=True, gcp_operation_name=operation.name
+            )
+            if not updated:
+                return None
+            self._jobs[job_id] = {
+                "operation": operation,
+                "interval": self.poll_initial,
+                "errors": 0,
+                "debug": veo_debug_json,
+            }
+            return self.poll_initial
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._fail(job_id, e)
+            return None
+
+    async def _poll(self, job_id: str) -> Optional[float]:
+        """輪詢一次；未完成時回傳下次輪詢的間隔，完成或失敗時回傳 None。"""
+        entry = self._jobs[job_id]
+        try:
+            client = self.client_factory()
+            if client is None:
+                raise RuntimeError("GenAI Client 未初始化，無法輪詢長時間作業")
+            try:
+                operation = await self._call(client.operations.get, entry["operation"])
+            except Exception as e:
+                # 暫時性錯誤（網路、配額）：加倍拉長間隔重試，連續失敗過多才判定任務失敗
+                entry["errors"] += 1
+                if entry["errors"] >= self.max_errors:
+                    raise
+                print(f"Veo 任務 {job_id} 輪詢失敗（第 {entry['errors']} 次），稍後重試: {e}")
+                entry["interval"] = min(entry["interval"] * 2, self.poll_max)
+                return entry["interval"]
+            entry["errors"] = 0
+            entry["operation"] = operation
+
+            if operation.done is not True:
+                updated = await asyncio.to_thread(
+                    self.store.update, job_id, active_only=True, message="影片生成進行中，請稍候…"
+                )
+                if not updated:
+                    # 任務已被取消（可能由其他 worker 處理 DELETE）
+                    self._jobs.pop(job_id, None)
+                    return None
+                entry["interval"] = min(entry["interval"] * self.backoff, self.poll_max)
+                return entry["interval"]
+
+            self._jobs.pop(job_id, None)
+            await asyncio.to_thread(_store_veo_result, self.store, job_id, operation, entry["debug"])
+            return None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._jobs.pop(job_id, None)
+            await self._fail(job_id, e)
+            return None
+
+
+_veo_scheduler = _VeoScheduler(
+    _video_job_store,
+    lambda: genai_client,
+    poll_initial=VEO_POLL_INITIAL_SEC,
+    poll_max=VEO_POLL_MAX_SEC,
+    backoff=VEO_POLL_BACKOFF,
+    concurrency=VEO_API_CONCURRENCY,
+    min_interval=VEO_API_MIN_INTERVAL_SEC,
+    max_errors=VEO_POLL_MAX_ERRORS,
+)
 
 
 class GenerateVideoBody(BaseModel):
@@ -1130,10 +3425,12 @@ class GenerateVideoBody(BaseModel):
 
 
 @app.post("/generate-video")
-async def generate_video(body: GenerateVideoBody):
+async def generate_video(body: GenerateVideoBody, force: bool = False):
     """
     建立 Veo Image-to-Video 背景任務，立即回傳 job_id。
     請以 GET /video-status/{job_id} 輪詢；完成後可用 video_url 或 video_base64。
+    相同圖片 + prompt + 模型與生成設定的請求會沿用既有任務（進行中或已完成），回傳 deduplicated=true；
+    ?force=true 時一律建立新任務。
     """
     if genai_client is None:
         raise HTTPException(
@@ -1149,43 +3446,31 @@ async def generate_video(body: GenerateVideoBody):
         raise HTTPException(status_code=400, detail="圖片資料過短或損毀")
 
     job_id = str(uuid.uuid4())
-    with _video_jobs_lock:
-        _video_jobs[job_id] = {
-            "status": "pending",
-            "message": "已排入佇列",
-            "prompt": prompt[:500],
-            "error": None,
-            "video_bytes": None,
-            "video_mime_type": None,
-            "video_base64": None,
-            "video_url": None,
-            "gcp_operation_name": None,
-        }
+    request_key = _veo_request_key(image_bytes, prompt)
+    fields = {"status": "pending", "message": "已排入佇列", "prompt": prompt[:500]}
+    if force:
+        await run_in_threadpool(
+            _video_job_store.create, job_id, request_key=request_key, **fields
+        )
+    else:
+        job, created = await run_in_threadpool(
+            _video_job_store.create_or_attach, job_id, request_key, **fields
+        )
+        if not created:
+            return {**_video_job_status_payload(job["job_id"], job), "deduplicated": True}
 
-    thread = threading.Thread(
-        target=_run_veo_video_job,
-        args=(job_id, image_bytes, prompt),
-        daemon=True,
-    )
-    thread.start()
+    _veo_scheduler.submit(job_id, image_bytes, prompt)
 
-    return {"job_id": job_id, "status": "pending"}
+    return {"job_id": job_id, "status": "pending", "deduplicated": False}
 
 
-@app.get("/video-status/{job_id}")
-async def video_status(job_id: str):
-    """
-    查詢影片生成狀態；完成時含 video_url，可能含 video_base64（較小檔案時）。
-    若查無任務仍回傳 200 + status=failed（避免輪詢收到 404）；常見原因：uvicorn --reload
-    重載清空記憶體、或多 Worker 導致 POST/GET 打到不同進程。
-    """
-    with _video_jobs_lock:
-        job = _video_jobs.get(job_id)
+def _video_job_status_payload(job_id: str, job: Optional[dict]) -> dict:
+    """任務狀態的對外欄位（不含影片內容）；查無任務時回傳 status=failed + JOB_NOT_FOUND。"""
     if not job:
         return {
             "job_id": job_id,
             "status": "failed",
-            "message": "找不到此任務。可能原因：伺服器已重載（--reload）、使用多個 Worker、或 job_id 錯誤。請重新提交生成。",
+            "message": "找不到此任務。可能原因：job_id 錯誤、任務已超過保留期限被清除，或伺服器資料目錄已被清除。請重新提交生成。",
             "error": "JOB_NOT_FOUND",
         }
 
@@ -1199,25 +3484,306 @@ async def video_status(job_id: str):
     if job["status"] == "completed":
         out["video_mime_type"] = job.get("video_mime_type") or "video/mp4"
         out["video_url"] = job.get("video_url")
-        if job.get("video_base64"):
-            out["video_base64"] = job["video_base64"]
     return out
 
 
+@app.get("/video-status/{job_id}")
+async def video_status(job_id: str):
+    """
+    查詢影片生成狀態；完成時含 video_url，可能含 video_base64（較小檔案時）。
+    若查無任務仍回傳 200 + status=failed（避免輪詢收到 404）；任務存於共用的 SQLite，
+    多個 worker 皆可查詢，查無通常表示 job_id 錯誤或資料目錄被清除。
+    建議改用 GET /video-status/{job_id}/events（SSE）接收狀態推播。
+    """
+    job = await run_in_threadpool(_video_job_store.get, job_id)
+    out = _video_job_status_payload(job_id, job)
+    if job and job["status"] == "completed":
+        # 大檔不塞 Base64，改以 /video-result/{job_id} 播放
+        max_b64 = int(os.environ.get("VEO_MAX_BASE64_BYTES", str(2 * 1024 * 1024)))
+        if job.get("video_size") and job["video_size"] <= max_b64:
+            path = _video_job_store.get_video_path(job)
+            if path:
+                raw = await run_in_threadpool(_read_file_bytes, path)
+                out["video_base64"] = base64.b64encode(raw).decode("ascii")
+    return out
+
+
+# SSE 連線在沒有本進程推播時重新讀取資料庫的間隔（任務可能由其他 worker 處理），以及心跳間隔（秒）
+VIDEO_EVENTS_RECHECK_SEC = float(os.environ.get("VIDEO_EVENTS_RECHECK_SEC", "2"))
+VIDEO_EVENTS_HEARTBEAT_SEC = float(os.environ.get("VIDEO_EVENTS_HEARTBEAT_SEC", "15"))
+
+
+class _VideoJobNotifier:
+    """job_id -> 等待中的 asyncio.Event；任務存放更新時（可能在其他執行緒）喚醒對應的 SSE 連線。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: dict[str, set] = {}
+
+    def subscribe(self, job_id: str) -> tuple:
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters.setdefault(job_id, set()).add(waiter)
+        return waiter
+
+    def unsubscribe(self, job_id: str, waiter: tuple) -> None:
+        with self._lock:
+            waiters = self._waiters.get(job_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[job_id]
+
+    def notify(self, job_id: str) -> None:
+        with self._lock:
+            waiters = list(self._waiters.get(job_id, ()))
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # 事件迴圈已關閉
+                pass
+
+
+_video_job_notifier = _VideoJobNotifier()
+_video_job_store.on_change = _video_job_notifier.notify
+
+
+def _sse_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+async def _iter_video_job_events(job_id: str):
+    """狀態改變時送出 status 事件，任務結束（completed / failed / cancelled）後關閉串流。"""
+    waiter = _video_job_notifier.subscribe(job_id)
+    _, changed = waiter
+    loop = asyncio.get_running_loop()
+    last = None
+    last_sent_at = loop.time()
+    try:
+        while True:
+            changed.clear()
+            job = await run_in_threadpool(_video_job_store.get, job_id)
+            payload = _video_job_status_payload(job_id, job)
+            if payload != last:
+                yield _sse_event("status", payload)
+                last = payload
+                last_sent_at = loop.time()
+            if payload["status"] not in _VIDEO_JOB_ACTIVE_STATUSES:
+                return
+            if loop.time() - last_sent_at >= VIDEO_EVENTS_HEARTBEAT_SEC:
+                # SSE 註解行，維持連線不被代理伺服器切斷
+                yield b": keep-alive\n\n"
+                last_sent_at = loop.time()
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=VIDEO_EVENTS_RECHECK_SEC)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        _video_job_notifier.unsubscribe(job_id, waiter)
+
+
+@app.get("/video-status/{job_id}/events")
+async def video_status_events(job_id: str):
+    """
+    以 Server-Sent Events 推播影片任務狀態（event: status，data 為與 /video-status 相同的 JSON，
+    但不含 video_base64；完成時只給 video_url）。任務結束後伺服器關閉串流。
+    """
+    return StreamingResponse(
+        _iter_video_job_events(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# 分段回傳影片時每次自磁碟讀取的大小
+_VIDEO_RANGE_CHUNK_SIZE = 256 * 1024
+
+_BYTE_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def _parse_byte_range(range_header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """
+    解析單一區段的 Range 標頭，回傳 (start, end)（含 end）；未指定、格式不支援或多區段時回傳 None
+    （回傳完整檔案）。區段超出檔案範圍時拋出 HTTP 416。
+    """
+    if not range_header:
+        return None
+    m = _BYTE_RANGE_RE.fullmatch(range_header.strip())
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+    else:
+        # bytes=-N：最後 N 個位元組
+        start = max(0, size - int(m.group(2)))
+        end = size - 1
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Range 超出影片範圍",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, min(end, size - 1)
+
+
+def _iter_file_range(path: str, start: int, end: int):
+    """分段讀取檔案 [start, end]，不把整個檔案讀進記憶體。"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(_VIDEO_RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
 @app.get("/video-result/{job_id}")
-async def video_result(job_id: str):
-    """任務完成後，以 MP4（或其它 mime）串流回傳，供 <video src> 使用。"""
-    with _video_jobs_lock:
-        job = _video_jobs.get(job_id)
+async def video_result(
+    job_id: str,
+    range_header: Optional[str] = Header(None, alias="range"),
+    if_range: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    任務完成後回傳影片檔，供 <video src> 使用。支援 Range（206 Partial Content），
+    <video> 拖曳進度時只傳送所需區段；ETag 為影片內容雜湊，可搭配 If-None-Match 取得 304。
+    """
+    job = await run_in_threadpool(_video_job_store.get, job_id, True)
     if not job:
         raise HTTPException(status_code=404, detail="找不到此 job_id")
     if job["status"] != "completed":
         raise HTTPException(status_code=409, detail=f"任務尚未完成，狀態: {job['status']}")
-    raw = job.get("video_bytes")
-    if not raw:
-        raise HTTPException(status_code=500, detail="內部錯誤：遺失影片資料")
+    path = _video_job_store.get_video_path(job)
+    if not path:
+        raise HTTPException(status_code=410, detail="影片檔已被清除，請重新提交生成")
     mime = job.get("video_mime_type") or "video/mp4"
-    return Response(content=raw, media_type=mime)
+    etag = f'"{job["video_sha256"]}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=3600",
+    }
+
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    size = os.path.getsize(path)
+    # If-Range 與目前 ETag 不符時，表示用戶端快取的是別的內容，回傳完整檔案
+    byte_range = None
+    if not if_range or if_range.strip() == etag:
+        byte_range = _parse_byte_range(range_header, size)
+    if byte_range is None:
+        return FileResponse(path, media_type=mime, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        _iter_file_range(path, start, end),
+        status_code=206,
+        media_type=mime,
+        headers=headers,
+    )
+
+
+@app.delete("/video-jobs/{job_id}")
+async def cancel_video_job(job_id: str):
+    """
+    取消尚未完成的影片任務。任務存於共用資料庫，任一 worker 皆可處理；
+    持有任務的 worker 在下次輪詢時發現已取消便停止追蹤。Google 端的長時間作業不會被中止。
+    """
+    job = await run_in_threadpool(_video_job_store.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="找不到此 job_id")
+    updated = await run_in_threadpool(
+        _video_job_store.update,
+        job_id,
+        active_only=True,
+        status="cancelled",
+        message="已取消",
+        lease_until=None,
+    )
+    if not updated:
+        job = await run_in_threadpool(_video_job_store.get, job_id)
+        status = job["status"] if job else "unknown"
+        raise HTTPException(status_code=409, detail=f"任務已結束，狀態: {status}")
+    _veo_scheduler.cancel(job_id)
+    return {"job_id": job_id, "status": "cancelled"}
+
+
+@app.get("/admin/veo-scheduler")
+async def veo_scheduler_stats():
+    """查詢本進程 Veo 排程器的任務數與 API 呼叫設定。"""
+    return _veo_scheduler.stats()
+
+
+@app.post("/admin/video-store/evict")
+async def video_store_evict():
+    """立即執行影片任務淘汰（TTL 與容量上限），回傳淘汰統計。"""
+    return await run_in_threadpool(_video_job_store.evict)
+
+
+@app.get("/admin/inference")
+async def inference_stats():
+    """查詢推論執行器的並行上限、目前佔用數與拒絕次數，以及 predictor 池的空閒數。"""
+    out = _inference_executor.stats()
+    out["predictor_pool"] = predictor_pool.stats() if predictor_pool is not None else None
+    return out
+
+
+@app.get("/admin/embedding-cache")
+async def embedding_cache_stats():
+    """查詢 SAM 嵌入快取的使用量與命中率。"""
+    return _embedding_cache.stats()
+
+
+@app.delete("/admin/embedding-cache")
+async def embedding_cache_clear():
+    """清空 SAM 嵌入快取。"""
+    _embedding_cache.clear()
+    return _embedding_cache.stats()
+
+
+@app.get("/admin/segment-cache")
+async def segment_cache_stats():
+    """查詢 /segment-everything 結果快取（記憶體與磁碟）的使用量與命中率。"""
+    return await run_in_threadpool(_segment_result_cache.stats)
+
+
+@app.delete("/admin/segment-cache")
+async def segment_cache_clear():
+    """清空 /segment-everything 結果快取（記憶體與磁碟）。"""
+    await run_in_threadpool(_segment_result_cache.clear)
+    return await run_in_threadpool(_segment_result_cache.stats)
+
+
+@app.get("/admin/refine-stats")
+async def refine_stats():
+    """查詢 mask 後處理各步驟的累計耗時（依預設組合、階段、步驟）。"""
+    return _refine_stats.stats()
+
+
+@app.delete("/admin/refine-stats")
+async def refine_stats_clear():
+    """清空 mask 後處理耗時統計。"""
+    _refine_stats.clear()
+    return _refine_stats.stats()
 
 
 @app.get("/")
@@ -1229,10 +3795,19 @@ async def root():
         "endpoints": {
             "docs": "/docs",
             "redoc": "/redoc",
+            "images": "/images (POST), /images/{image_id} (DELETE)",
             "segment_image": "/segment-image (POST)",
             "segment_with_mask": "/segment-with-mask (POST)",
+            "segment_with_masks": "/segment-with-masks (POST, batch)",
+            "segment_prompt": "/segment-prompt (POST, JSON points / boxes)",
             "generate_video": "/generate-video (POST)",
             "video_status": "/video-status/{job_id} (GET)",
-            "video_result": "/video-result/{job_id} (GET)"
+            "video_status_events": "/video-status/{job_id}/events (GET, SSE)",
+            "video_result": "/video-result/{job_id} (GET)",
+            "cancel_video_job": "/video-jobs/{job_id} (DELETE)",
+            "embedding_cache": "/admin/embedding-cache (GET, DELETE)",
+            "refine_stats": "/admin/refine-stats (GET, DELETE)",
+            "segment_cache": "/admin/segment-cache (GET, DELETE)",
+            "video_store_evict": "/admin/video-store/evict (POST)"
         }
     }
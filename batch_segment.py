@@ -0,0 +1,330 @@
+"""
+離線批次全圖自動分割：一次處理整個資料夾或清單中的圖片，結果寫成分片（shard）檔。
+
+用法：
+    python batch_segment.py images/ --out results/
+    python batch_segment.py manifest.txt --out results/ --format binary --work-size 1024 --workers 4
+
+輸入可為資料夾（遞迴尋找圖片）或清單檔（每行一個路徑，相對路徑以清單檔所在資料夾為準，# 開頭為註解）。
+SAM 模型只在主進程載入一次；解碼與輸出編碼（清理、RLE、polygon）交給 --workers 個子進程，
+各階段同時進行的圖片數以 --queue-depth 為上限，避免大量圖片一次佔滿記憶體。
+子進程只使用 mask_utils（不 import app，不會建立資料目錄、任務資料庫或雲端 client）。
+
+輸出（--out 資料夾內）：
+    settings.json       本次的分割設定；接續執行時設定必須相同
+    ledger.jsonl        進度紀錄：每完成一個分片寫一行 {"shard", "images": [{"path", "masks"}]}，
+                        失敗的圖片寫 {"path", "error"}
+    shard-00000.jsonl   每行一張圖片：{"path", "image_hash", "width", "height", "scale", "masks": [...]}，
+                        masks 格式同 /segment-everything 的 JSON 回應
+    shard-00000.lcmb    --format binary：每張圖片為 u32 標頭長度 + 標頭 JSON（同上但不含 masks）
+                        + u32 資料長度 + /segment-everything 的二進位格式（"LCMK"），可用 iter_binary_shard 讀取
+
+分片先寫入 .tmp 檔，完整寫完才改名並記入 ledger；中斷後以相同指令重新執行即可從最後一個完成的分片接續，
+已記入 ledger 的圖片（包含失敗的，除非指定 --retry-errors）不會重做。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import struct
+import time
+from collections import deque
+
+import mask_utils
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+_SHARD_EXTENSIONS = {"jsonl": ".jsonl", "binary": ".lcmb"}
+_LENGTH = struct.Struct("<I")
+
+
+def _collect_inputs(inputs: list) -> list:
+    """展開資料夾與清單檔，回傳不重複、排序穩定的絕對路徑 list。"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            found = []
+            for root, _, files in os.walk(item):
+                for name in files:
+                    if os.path.splitext(name)[1].lower() in _IMAGE_EXTENSIONS:
+                        found.append(os.path.join(root, name))
+            paths.extend(sorted(found))
+        else:
+            base = os.path.dirname(os.path.abspath(item))
+            with open(item, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        paths.append(os.path.join(base, line))
+    seen = set()
+    unique = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            unique.append(path)
+    return unique
+
+
+def _decode_task(path: str) -> dict:
+    """子進程：讀檔、計算內容雜湊並解碼成 RGB 陣列。"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        return {
+            "path": path,
+            "image_hash": mask_utils.image_content_hash(data),
+            "image": mask_utils.decode_rgb_image(data),
+        }
+    except Exception as e:
+        return {"path": path, "error": f"decode: {e}"}
+
+
+def _encode_task(item: dict, opts: dict) -> dict:
+    """子進程：後處理 masks（清理、RLE、polygon）並編成分片中的一筆資料。"""
+    try:
+        height, width = item["image_shape"][:2]
+        records = list(mask_utils.iter_segment_everything_results(
+            item["masks"],
+            opts["max_masks"],
+            opts["min_area"],
+            opts["rle"],
+            opts["min_hole_area"],
+            opts["min_island_area"],
+            image_shape=item["image_shape"],
+        ))
+        header = {
+            "path": item["path"],
+            "image_hash": item["image_hash"],
+            "width": width,
+            "height": height,
+            "scale": item["scale"],
+        }
+        if opts["format"] == "binary":
+            header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+            payload = mask_utils.encode_masks_binary(records, opts["rle"], (height, width))
+            data = b"".join((_LENGTH.pack(len(header_bytes)), header_bytes, _LENGTH.pack(len(payload)), payload))
+        else:
+            header["masks"] = [mask_utils.mask_record_to_json(r) for r in records]
+            data = (json.dumps(header, ensure_ascii=False) + "\n").encode("utf-8")
+        return {"path": item["path"], "masks": len(records), "data": data}
+    except Exception as e:
+        return {"path": item["path"], "error": f"encode: {e}"}
+
+
+def iter_binary_shard(path: str):
+    """讀取 --format binary 的分片，逐張回傳 (標頭 dict, records)；records 格式同 mask_utils.decode_masks_binary。"""
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos < len(data):
+        (header_len,) = _LENGTH.unpack_from(data, pos)
+        pos += _LENGTH.size
+        header = json.loads(data[pos:pos + header_len])
+        pos += header_len
+        (payload_len,) = _LENGTH.unpack_from(data, pos)
+        pos += _LENGTH.size
+        records, _, _ = mask_utils.decode_masks_binary(data[pos:pos + payload_len])
+        pos += payload_len
+        yield header, records
+
+
+class _ShardWriter:
+    """依序寫入分片與 ledger；分片寫滿 shard_size 張圖片（或結束時）才改名並記入 ledger。"""
+
+    def __init__(self, out_dir: str, fmt: str, shard_size: int, next_index: int):
+        self.out_dir = out_dir
+        self.extension = _SHARD_EXTENSIONS[fmt]
+        self.shard_size = shard_size
+        self.next_index = next_index
+        self._file = None
+        self._name = None
+        self._images = []
+        self._ledger = open(os.path.join(out_dir, "ledger.jsonl"), "a", encoding="utf-8")
+
+    def _log(self, entry: dict) -> None:
+        self._ledger.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._ledger.flush()
+        os.fsync(self._ledger.fileno())
+
+    def write(self, path: str, masks: int, data: bytes) -> None:
+        if self._file is None:
+            self._name = f"shard-{self.next_index:05d}{self.extension}"
+            self.next_index += 1
+            self._file = open(os.path.join(self.out_dir, self._name + ".tmp"), "wb")
+        self._file.write(data)
+        self._images.append({"path": path, "masks": masks})
+        if len(self._images) >= self.shard_size:
+            self.flush()
+
+    def error(self, path: str, message: str) -> None:
+        self._log({"path": path, "error": message})
+
+    def flush(self) -> None:
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        final_path = os.path.join(self.out_dir, self._name)
+        os.replace(final_path + ".tmp", final_path)
+        self._log({"shard": self._name, "images": self._images})
+        self._file = None
+        self._images = []
+
+    def close(self) -> None:
+        self.flush()
+        self._ledger.close()
+
+
+def _read_ledger(out_dir: str, retry_errors: bool) -> tuple[set, int]:
+    """讀取 ledger，回傳 (已處理的路徑, 下一個分片編號)；最後一行若寫到一半（中斷）則忽略。"""
+    done = set()
+    next_index = 0
+    path = os.path.join(out_dir, "ledger.jsonl")
+    if not os.path.exists(path):
+        return done, next_index
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "shard" in entry:
+                done.update(image["path"] for image in entry["images"])
+                next_index = max(next_index, int(entry["shard"].split("-")[1].split(".")[0]) + 1)
+            elif not retry_errors:
+                done.add(entry["path"])
+    return done, next_index
+
+
+def _prepare_out_dir(out_dir: str, settings: dict) -> None:
+    """建立輸出資料夾、清除中斷留下的 .tmp 分片，並確認與先前執行的設定相同。"""
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(out_dir):
+        if name.endswith(".tmp"):
+            os.remove(os.path.join(out_dir, name))
+    settings_path = os.path.join(out_dir, "settings.json")
+    if os.path.exists(settings_path):
+        with open(settings_path, encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous != settings:
+            raise SystemExit(f"{out_dir} 已有以不同設定產生的結果，請改用其他 --out 或刪除該資料夾：{previous}")
+    else:
+        with open(settings_path, "w", encoding="utf-8") as f:
+            json.dump(settings, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批次全圖自動分割（資料夾或清單檔），結果寫成可接續的分片檔")
+    parser.add_argument("inputs", nargs="+", help="圖片資料夾或清單檔（每行一個路徑）")
+    parser.add_argument("--out", required=True, help="輸出資料夾")
+    parser.add_argument("--model", default=os.path.join(_APP_DIR, "models", "sam_vit_b_01ec64.pth"))
+    parser.add_argument("--format", choices=("jsonl", "binary"), default="jsonl")
+    parser.add_argument("--rle", choices=("full", "cropped"), default="cropped")
+    parser.add_argument("--shard-size", type=int, default=500, help="每個分片的圖片數")
+    parser.add_argument("--workers", type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)),
+                        help="解碼與編碼的子進程數")
+    parser.add_argument("--queue-depth", type=int, default=0, help="解碼與編碼各自最多同時處理幾張（預設為 workers 的 2 倍）")
+    parser.add_argument("--work-size", type=int, default=0, help="工作解析度（最長邊像素），0 為原圖")
+    parser.add_argument("--points-per-side", type=int, default=32)
+    parser.add_argument("--max-masks", type=int, default=100)
+    parser.add_argument("--min-area", type=int, default=0)
+    parser.add_argument("--min-hole-area", type=int, default=0)
+    parser.add_argument("--min-island-area", type=int, default=0)
+    parser.add_argument("--retry-errors", action="store_true", help="重新處理 ledger 中記為失敗的圖片")
+    args = parser.parse_args()
+
+    if args.shard_size < 1 or args.workers < 1 or args.max_masks < 1:
+        parser.error("--shard-size、--workers、--max-masks 必須 >= 1")
+    if min(args.work_size, args.min_area, args.min_hole_area, args.min_island_area, args.queue_depth) < 0:
+        parser.error("--work-size、--min-area、--min-hole-area、--min-island-area、--queue-depth 不可為負數")
+    queue_depth = args.queue_depth or 2 * args.workers
+
+    opts = {
+        "format": args.format,
+        "rle": args.rle,
+        "work_size": args.work_size,
+        "points_per_side": args.points_per_side,
+        "max_masks": args.max_masks,
+        "min_area": args.min_area,
+        "min_hole_area": args.min_hole_area,
+        "min_island_area": args.min_island_area,
+    }
+    _prepare_out_dir(args.out, opts)
+    done, next_index = _read_ledger(args.out, args.retry_errors)
+    paths = [p for p in _collect_inputs(args.inputs) if p not in done]
+    print(f"共 {len(paths)} 張待處理（已完成 {len(done)} 張）")
+    if not paths:
+        return
+
+    # 模型載入與自動分割沿用伺服器的設定，只在主進程 import app
+    import torch
+
+    import app
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    sam = app._load_sam_model(args.model, device)
+    app.mask_generator = app._build_mask_generator(sam, points_per_side=args.points_per_side)
+    app.predictor_pool = app._PredictorPool(sam, 1)
+
+    writer = _ShardWriter(args.out, args.format, args.shard_size, next_index)
+    ctx = multiprocessing.get_context("spawn")
+    started = time.perf_counter()
+    processed = 0
+
+    def finish(result: dict) -> None:
+        nonlocal processed
+        processed += 1
+        if "error" in result:
+            writer.error(result["path"], result["error"])
+            print(f"[{processed}/{len(paths)}] {result['path']} 失敗: {result['error']}")
+            return
+        writer.write(result["path"], result["masks"], result["data"])
+        rate = processed / (time.perf_counter() - started)
+        print(f"[{processed}/{len(paths)}] {result['path']} masks={result['masks']} ({rate:.2f} 張/秒)")
+
+    with ctx.Pool(args.workers) as pool:
+        pending_paths = deque(paths)
+        decoding = deque()
+        encoding = deque()
+        try:
+            while pending_paths or decoding or encoding:
+                # 解碼預先排入最多 queue_depth 張，推論時子進程同時解碼下一批
+                while pending_paths and len(decoding) < queue_depth:
+                    decoding.append(pool.apply_async(_decode_task, (pending_paths.popleft(),)))
+                # 依序寫出已完成的編碼；編碼佇列已滿時等待最舊的一張
+                while encoding and (encoding[0].ready() or len(encoding) >= queue_depth or not decoding):
+                    finish(encoding.popleft().get())
+                if not decoding:
+                    continue
+
+                decoded = decoding.popleft().get()
+                if "error" in decoded:
+                    # 先寫出之前的圖片，讓 ledger 與分片維持輸入順序
+                    while encoding:
+                        finish(encoding.popleft().get())
+                    finish(decoded)
+                    continue
+                image = decoded.pop("image")
+                try:
+                    masks, scale = app._generate_masks_at_work_size(image, args.work_size)
+                except Exception as e:
+                    while encoding:
+                        finish(encoding.popleft().get())
+                    finish({"path": decoded["path"], "error": f"segment: {e}"})
+                    continue
+                if scale >= 1.0:
+                    # 原圖解析度的 mask 也只保留 bbox 視窗再送往子進程，避免序列化整張圖大小的 bool 陣列
+                    masks = mask_utils.to_work_crops(masks, image.shape)
+                item = dict(decoded, masks=masks, scale=scale, image_shape=image.shape)
+                encoding.append(pool.apply_async(_encode_task, (item, opts)))
+        finally:
+            writer.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"完成 {processed} 張，耗時 {elapsed:.1f} 秒，結果位於 {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+/segment-everything 的效能比較：原圖解析度與工作解析度（work_size）。
+
+用法：
+    python bench_segment_everything.py photo.jpg
+    python bench_segment_everything.py photo.jpg --work-sizes 0 1024 768 --repeat 3 --rle cropped
+
+每個 work_size 在獨立的子進程中執行（各自載入模型一次、先暖身一次），回報自動分割與輸出編碼
+（JSON）的耗時、mask 數、回應大小，以及子進程的峰值記憶體（ru_maxrss，僅 Linux / macOS）。
+work_size 為 0 即目前的原圖解析度路徑。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 為單位，macOS 以 bytes 為單位
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _bench_child(args, work_size, result_queue):
+    sys.path.insert(0, _APP_DIR)
+    import torch
+    import app
+    import mask_utils
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    sam = app._load_sam_model(args.model, device)
+    app.mask_generator = app._build_mask_generator(sam, points_per_side=args.points_per_side)
+    app.predictor_pool = app._PredictorPool(sam, 1)
+    with open(args.image, "rb") as f:
+        image_array = mask_utils.decode_rgb_image(f.read())
+
+    def run_once():
+        started = time.perf_counter()
+        masks_sorted, scale = app._generate_masks_at_work_size(image_array, work_size)
+        generated = time.perf_counter()
+        records = mask_utils.iter_segment_everything_results(
+            masks_sorted, args.max_masks, 0, args.rle, image_shape=image_array.shape
+        )
+        body = json.dumps({"masks": [mask_utils.mask_record_to_json(r) for r in records]})
+        encoded = time.perf_counter()
+        return {
+            "generate_s": generated - started,
+            "encode_s": encoded - generated,
+            "masks": len(masks_sorted),
+            "bytes": len(body),
+            "scale": scale,
+        }
+
+    run_once()  # 暖身（torch 執行緒池、記憶體配置）
+    runs = [run_once() for _ in range(args.repeat)]
+    result_queue.put({
+        "work_size": work_size,
+        "scale": runs[0]["scale"],
+        "masks": runs[0]["masks"],
+        "bytes": runs[0]["bytes"],
+        "generate_s": min(r["generate_s"] for r in runs),
+        "encode_s": min(r["encode_s"] for r in runs),
+        "peak_rss_mb": _peak_rss_mb(),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較 /segment-everything 原圖解析度與工作解析度的效能")
+    parser.add_argument("image", help="測試圖片路徑")
+    parser.add_argument("--model", default=os.path.join(_APP_DIR, "models", "sam_vit_b_01ec64.pth"))
+    parser.add_argument("--work-sizes", type=int, nargs="+", default=[0, 1024])
+    parser.add_argument("--repeat", type=int, default=2, help="每個設定量測幾次（取最小值）")
+    parser.add_argument("--points-per-side", type=int, default=32)
+    parser.add_argument("--max-masks", type=int, default=100)
+    parser.add_argument("--rle", choices=("full", "cropped"), default="full")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for work_size in args.work_sizes:
+        result_queue = ctx.Queue()
+        proc = ctx.Process(target=_bench_child, args=(args, work_size, result_queue))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            print(f"work_size={work_size} 執行失敗（exit code {proc.exitcode}）")
+            continue
+        results.append(result_queue.get())
+
+    print(f"{'work_size':>9} {'scale':>7} {'masks':>6} {'generate_s':>11} {'encode_s':>9} {'json_MB':>8} {'peak_rss_MB':>12}")
+    for r in results:
+        print(
+            f"{r['work_size']:>9} {r['scale']:>7.3f} {r['masks']:>6} {r['generate_s']:>11.2f} "
+            f"{r['encode_s']:>9.2f} {r['bytes'] / 1e6:>8.2f} {str(r['peak_rss_mb']):>12}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,8 @@ import { useBrushTool } from './components/BrushTool'
 
 // RLE 工具
 import { decodeRLEToColoredImageData, getRandomMaskColor } from './utils/rle'
+import { postWithImage, SEGMENT_BATCH_SIZE } from './utils/imageSession'
+import { readNDJSONStream } from './utils/ndjson'
 import {
   loadAnimationHistoryRecords,
   saveAnimationHistoryRecords
@@ -58,6 +60,7 @@ function App() {
   const [videoModalSrc, setVideoModalSrc] = useState(null)
   const [generatedVideos, setGeneratedVideos] = useState([])
   const videoPollRef = useRef(null)
+  const videoEventsRef = useRef(null)
   /** 本次生成完成、尚未寫入紀錄的預覽（關閉 Modal 或下載後 commit） */
   const pendingVideoHistoryRef = useRef(null)
   /** 避免初次從 localStorage hydrate 時覆寫儲存 */
@@ -197,16 +200,13 @@ function App() {
           setHoveredAutoMaskId(null)
           setSelectedAutoMaskIds([])
 
-          const formData = new FormData()
-          formData.append('file', file)
-          console.log('自動分割 API formData 建立完成，開始 fetch...')
+          console.log('自動分割 API 開始 fetch（以 image_id 取代重複上傳）...')
 
-          const response = await fetch(
-            'http://localhost:8000/segment-everything?max_masks=120&min_area=0',
-            {
-              method: 'POST',
-              body: formData
-            }
+          // progressive=1：後端先以稀疏網格分割並送出結果（NDJSON，每行一個物件），再以較密的網格補上其餘物件，
+          // 可邊收邊畫，第一批圖層不必等整張圖的 32x32 網格跑完
+          const response = await postWithImage(
+            'http://localhost:8000/segment-everything?max_masks=120&min_area=0&rle=cropped&progressive=1',
+            file
           )
 
           console.log('自動分割 API 回應物件：', response)
@@ -218,39 +218,43 @@ function App() {
             throw new Error(`HTTP error! status: ${response.status}`)
           }
 
-          const data = await response.json()
-          console.log('自動分割 API 回傳資料：', data)
-
-          const masks = Array.isArray(data.masks) ? data.masks : []
-
-          const processed = masks
-            .map((m, index) => {
-              if (!m.rle || !m.bbox) return null
-              const color = getRandomMaskColor()
-              const imageDataInfo = decodeRLEToColoredImageData(
-                m.rle,
-                m.bbox,
-                color
-              )
-              if (!imageDataInfo || imageDataInfo.width === 0 || imageDataInfo.height === 0) {
-                return null
-              }
-              const polygon = Array.isArray(m.polygon) ? m.polygon.map((v) => Number(v)) : []
-              return {
-                id: `auto-mask-${index}`,
-                bbox: m.bbox,
-                area: m.area,
-                score: m.score,
-                stabilityScore: m.stability_score,
-                color,
-                imageDataInfo,
-                polygon
-              }
-            })
-            .filter(Boolean)
-
-          console.log('自動分割處理後的遮罩數量：', processed.length)
-          setAutoMasks(processed)
+          const toAutoMask = (m, index) => {
+            if (!m.rle || !m.bbox) return null
+            const color = getRandomMaskColor()
+            const imageDataInfo = decodeRLEToColoredImageData(
+              m.rle,
+              m.bbox,
+              color
+            )
+            if (!imageDataInfo || imageDataInfo.width === 0 || imageDataInfo.height === 0) {
+              return null
+            }
+            const polygon = Array.isArray(m.polygon) ? m.polygon.map((v) => Number(v)) : []
+            return {
+              id: `auto-mask-${index}`,
+              bbox: m.bbox,
+              area: m.area,
+              score: m.score,
+              stabilityScore: m.stability_score,
+              color,
+              imageDataInfo,
+              polygon
+            }
+          }
+
+          let received = 0
+          let processedCount = 0
+          await readNDJSONStream(response, (masks) => {
+            const processed = masks
+              .map((m) => toAutoMask(m, received++))
+              .filter(Boolean)
+            processedCount += processed.length
+            if (processed.length > 0) {
+              setAutoMasks((prev) => [...prev, ...processed])
+            }
+          })
+
+          console.log('自動分割處理後的遮罩數量：', processedCount)
         } catch (error) {
           console.error('API 錯誤 (segment-everything):', error)
           if (String(error?.message || '').includes('API_NOT_FOUND_404')) {
@@ -366,6 +370,10 @@ function App() {
         clearInterval(videoPollRef.current)
         videoPollRef.current = null
       }
+      if (videoEventsRef.current) {
+        videoEventsRef.current.close()
+        videoEventsRef.current = null
+      }
     }
   }, [])
 
@@ -390,6 +398,10 @@ function App() {
       clearInterval(videoPollRef.current)
       videoPollRef.current = null
     }
+    if (videoEventsRef.current) {
+      videoEventsRef.current.close()
+      videoEventsRef.current = null
+    }
   }
 
   const commitPendingVideoHistory = useCallback(() => {
@@ -498,6 +510,52 @@ function App() {
         throw new Error('回應中缺少 job_id')
       }
 
+      /** @returns {boolean} true 表示任務仍在進行 */
+      const handleStatus = (status) => {
+        const st = status.status
+
+        if (st === 'completed') {
+          stopVideoPolling()
+          setIsGeneratingVideo(false)
+          let src = null
+          if (status.video_url) {
+            const path = status.video_url.startsWith('/')
+              ? status.video_url
+              : `/${status.video_url}`
+            src = `${API_BASE}${path}`
+          } else if (status.video_base64) {
+            const mime = status.video_mime_type || 'video/mp4'
+            src = `data:${mime};base64,${status.video_base64}`
+          }
+          if (!src) {
+            alert('已完成但未取得影片網址或 Base64，請檢查後端設定')
+            return false
+          }
+          pendingVideoHistoryRef.current = {
+            videoUrl: src,
+            prompt: trimmed,
+            layerName,
+            committed: false
+          }
+          setVideoModalSrc(src)
+          setShowVideoModal(true)
+          setCurrentStep(STEP_GENERATE_DONE)
+          setCompletedSteps((prev) => {
+            const s = new Set(prev)
+            ;[1, 2, STEP_CANVAS, STEP_GENERATE_DONE].forEach((n) => s.add(n))
+            return Array.from(s).sort((a, b) => a - b)
+          })
+          return false
+        }
+        if (st === 'failed' || st === 'cancelled') {
+          stopVideoPolling()
+          setIsGeneratingVideo(false)
+          alert(status.error || status.message || '影片生成失敗')
+          return false
+        }
+        return true
+      }
+
       /** @returns {Promise<boolean>} true 表示應繼續輪詢 */
       const pollOnce = async () => {
         try {
@@ -505,49 +563,7 @@ function App() {
           if (!sres.ok) {
             throw new Error(`狀態查詢失敗: HTTP ${sres.status}`)
           }
-          const status = await sres.json()
-          const st = status.status
-
-          if (st === 'completed') {
-            stopVideoPolling()
-            setIsGeneratingVideo(false)
-            let src = null
-            if (status.video_url) {
-              const path = status.video_url.startsWith('/')
-                ? status.video_url
-                : `/${status.video_url}`
-              src = `${API_BASE}${path}`
-            } else if (status.video_base64) {
-              const mime = status.video_mime_type || 'video/mp4'
-              src = `data:${mime};base64,${status.video_base64}`
-            }
-            if (!src) {
-              alert('已完成但未取得影片網址或 Base64，請檢查後端設定')
-              return false
-            }
-            pendingVideoHistoryRef.current = {
-              videoUrl: src,
-              prompt: trimmed,
-              layerName,
-              committed: false
-            }
-            setVideoModalSrc(src)
-            setShowVideoModal(true)
-            setCurrentStep(STEP_GENERATE_DONE)
-            setCompletedSteps((prev) => {
-              const s = new Set(prev)
-              ;[1, 2, STEP_CANVAS, STEP_GENERATE_DONE].forEach((n) => s.add(n))
-              return Array.from(s).sort((a, b) => a - b)
-            })
-            return false
-          }
-          if (st === 'failed') {
-            stopVideoPolling()
-            setIsGeneratingVideo(false)
-            alert(status.error || status.message || '影片生成失敗')
-            return false
-          }
-          return true
+          return handleStatus(await sres.json())
         } catch (e) {
           stopVideoPolling()
           setIsGeneratingVideo(false)
@@ -557,11 +573,36 @@ function App() {
         }
       }
 
-      const keepPolling = await pollOnce()
-      if (keepPolling) {
-        videoPollRef.current = setInterval(() => {
-          void pollOnce()
-        }, 5000)
+      const startPolling = async () => {
+        const keepPolling = await pollOnce()
+        if (keepPolling) {
+          videoPollRef.current = setInterval(() => {
+            void pollOnce()
+          }, 5000)
+        }
+      }
+
+      // 優先以 SSE 接收狀態推播；瀏覽器不支援或連線被關閉時改回輪詢
+      if (typeof EventSource === 'undefined') {
+        await startPolling()
+      } else {
+        const events = new EventSource(`${API_BASE}/video-status/${jobId}/events`)
+        videoEventsRef.current = events
+        events.addEventListener('status', (event) => {
+          try {
+            handleStatus(JSON.parse(event.data))
+          } catch (e) {
+            console.error(e)
+          }
+        })
+        events.onerror = () => {
+          if (videoEventsRef.current !== events) return
+          if (events.readyState === EventSource.CLOSED) {
+            events.close()
+            videoEventsRef.current = null
+            void startPolling()
+          }
+        }
       }
     } catch (e) {
       stopVideoPolling()
@@ -586,13 +627,7 @@ function App() {
     setCurrentStep(2)
 
     try {
-      const formData = new FormData()
-      formData.append('file', selectedFile)
-
-      const response = await fetch('http://localhost:8000/segment-image', {
-        method: 'POST',
-        body: formData
-      })
+      const response = await postWithImage('http://localhost:8000/segment-image', selectedFile)
 
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`)
@@ -842,15 +877,11 @@ function App() {
         throw new Error('未找到有效連通選取區域')
       }
 
+      // 所有連通區域一次送出批次分割（同一張圖只計算一次嵌入），超過上限時分批
       const mergedMasks = []
-      for (const componentMask of componentMasks) {
-        const formData = new FormData()
-        formData.append('file', selectedFile)
-        formData.append('mask', componentMask)
-
-        const response = await fetch('http://localhost:8000/segment-with-mask', {
-          method: 'POST',
-          body: formData
+      for (let i = 0; i < componentMasks.length; i += SEGMENT_BATCH_SIZE) {
+        const response = await postWithImage('http://localhost:8000/segment-with-masks', selectedFile, {
+          masks: componentMasks.slice(i, i + SEGMENT_BATCH_SIZE)
         })
 
         if (!response.ok) {
@@ -858,8 +889,11 @@ function App() {
         }
 
         const data = await response.json()
-        if (Array.isArray(data.masks)) {
-          mergedMasks.push(...data.masks)
+        for (const item of data.masks || []) {
+          if (item.error) {
+            throw new Error(item.error)
+          }
+          mergedMasks.push(item)
         }
       }
 
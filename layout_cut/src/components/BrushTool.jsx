@@ -1,4 +1,5 @@
 import { useState, useRef, useCallback, useEffect } from 'react'
+import { postWithImage, SEGMENT_BATCH_SIZE } from '../utils/imageSession'
 
 // 控制是否顯示多邊形和矩形工具（目前隱藏）
 const SHOW_POLYGON_TOOL = false
@@ -477,32 +478,20 @@ export function useBrushTool(baseImage, segmentedMasks, selectedFile, imageSize)
         throw new Error('未檢測到有效的圈選區域，請確保圈選區域足夠大')
       }
       
-      // 為每個獨立區域分別調用後端 API
+      // 所有獨立區域一次送出批次分割（同一張圖只計算一次嵌入），超過上限時分批
       const allMasks = []
       
-      // 顯示進度（如果有多個區域）
       if (connectedComponents.length > 1) {
-        console.log(`開始為 ${connectedComponents.length} 個區域分別進行分割...`)
+        console.log(`開始為 ${connectedComponents.length} 個區域進行批次分割...`)
       }
       
-      for (let i = 0; i < connectedComponents.length; i++) {
-        const region = connectedComponents[i]
-        
-        if (connectedComponents.length > 1) {
-          console.log(`處理區域 ${i + 1}/${connectedComponents.length}...`)
-        }
-        
-        // 為該區域創建單獨的 mask
-        const regionMask = createMaskForRegion(region, width, height)
-        
-        // 發送到後端
-        const formData = new FormData()
-        formData.append('file', selectedFile)
-        formData.append('mask', regionMask)
-        
-        const response = await fetch('http://localhost:8000/segment-with-mask', {
-          method: 'POST',
-          body: formData
+      // 為每個區域創建單獨的 mask
+      const regionMasks = connectedComponents.map((region) => createMaskForRegion(region, width, height))
+      
+      for (let start = 0; start < regionMasks.length; start += SEGMENT_BATCH_SIZE) {
+        // 發送到後端（同一張圖只上傳一次，之後帶 image_id）
+        const response = await postWithImage('http://localhost:8000/segment-with-masks', selectedFile, {
+          masks: regionMasks.slice(start, start + SEGMENT_BATCH_SIZE)
         })
         
         if (!response.ok) {
@@ -512,14 +501,18 @@ export function useBrushTool(baseImage, segmentedMasks, selectedFile, imageSize)
           } catch (e) {
             errorText = '無法讀取錯誤訊息'
           }
-          throw new Error(`區域 ${i + 1} 分割失敗: HTTP ${response.status}: ${errorText || '後端服務返回錯誤'}`)
+          throw new Error(`區域分割失敗: HTTP ${response.status}: ${errorText || '後端服務返回錯誤'}`)
         }
         
         const data = await response.json()
         
-        // 收集該區域的分割結果
-        if (data.masks && data.masks.length > 0) {
-          allMasks.push(...data.masks)
+        // 收集各區域的分割結果（順序與送出的 masks 相同）
+        const results = data.masks || []
+        for (let j = 0; j < results.length; j++) {
+          if (results[j].error) {
+            throw new Error(`區域 ${start + j + 1} 分割失敗: ${results[j].error}`)
+          }
+          allMasks.push(results[j])
         }
       }
       
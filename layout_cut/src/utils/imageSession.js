@@ -0,0 +1,75 @@
+// 圖片工作階段：同一個 File 只上傳一次（POST /images），之後分割請求改帶 image_id
+const API_BASE = 'http://localhost:8000'
+
+// 批次分割（/segment-with-masks）單次請求的 mask 數上限，與後端 SEGMENT_WITH_MASKS_MAX 預設值一致
+export const SEGMENT_BATCH_SIZE = 32
+
+// File -> Promise<image_id>
+const imageIdCache = new WeakMap()
+
+async function uploadImage(file) {
+  const formData = new FormData()
+  formData.append('file', file)
+  const response = await fetch(`${API_BASE}/images`, {
+    method: 'POST',
+    body: formData
+  })
+  if (!response.ok) {
+    throw new Error(`HTTP error! status: ${response.status}`)
+  }
+  const data = await response.json()
+  return data.image_id
+}
+
+export function getImageId(file) {
+  if (!imageIdCache.has(file)) {
+    const pending = uploadImage(file).catch((error) => {
+      imageIdCache.delete(file)
+      throw error
+    })
+    imageIdCache.set(file, pending)
+  }
+  return imageIdCache.get(file)
+}
+
+export function forgetImageId(file) {
+  if (file) imageIdCache.delete(file)
+}
+
+/**
+ * 以 multipart 呼叫分割 API：優先帶 image_id，工作階段不存在或過期（404）時改以 file 重送一次。
+ * fields 為其餘表單欄位（例如 { mask }）；陣列值會送出多個同名欄位。
+ */
+export async function postWithImage(url, file, fields = {}) {
+  const buildForm = (imageId) => {
+    const formData = new FormData()
+    if (imageId) {
+      formData.append('image_id', imageId)
+    } else {
+      formData.append('file', file)
+    }
+    Object.entries(fields).forEach(([key, value]) => {
+      // 陣列值以重複欄位送出（例如批次分割的 masks）
+      if (Array.isArray(value)) {
+        value.forEach((item) => formData.append(key, item))
+      } else {
+        formData.append(key, value)
+      }
+    })
+    return formData
+  }
+
+  let imageId = null
+  try {
+    imageId = await getImageId(file)
+  } catch (error) {
+    console.warn('建立圖片工作階段失敗，改為直接上傳檔案：', error)
+  }
+
+  const response = await fetch(url, { method: 'POST', body: buildForm(imageId) })
+  if (imageId && response.status === 404) {
+    forgetImageId(file)
+    return fetch(url, { method: 'POST', body: buildForm(null) })
+  }
+  return response
+}
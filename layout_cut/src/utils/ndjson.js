@@ -0,0 +1,24 @@
+// 逐段讀取 NDJSON（每行一個 JSON 物件）串流回應
+// 每收到一段網路資料就以該段解析出的物件陣列呼叫 onBatch，讓畫面能邊收邊畫
+export async function readNDJSONStream(response, onBatch) {
+  const reader = response.body.getReader()
+  const decoder = new TextDecoder()
+  let buffered = ''
+
+  const parseLines = (lines) =>
+    lines.filter((line) => line.trim() !== '').map((line) => JSON.parse(line))
+
+  while (true) {
+    const { value, done } = await reader.read()
+    if (done) break
+    buffered += decoder.decode(value, { stream: true })
+    const lines = buffered.split('\n')
+    buffered = lines.pop()
+    const items = parseLines(lines)
+    if (items.length > 0) onBatch(items)
+  }
+
+  buffered += decoder.decode()
+  const rest = parseLines([buffered])
+  if (rest.length > 0) onBatch(rest)
+}
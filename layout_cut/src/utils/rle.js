@@ -34,18 +34,23 @@ export function decodeRLEToMask(rle) {
 }
 
 // 將 RLE + bbox 解碼成裁切後的彩色 ImageData 所需資料
+// 支援兩種格式：
+// - 完整格式：size 為整張圖 [H, W]
+// - 裁切格式（/segment-everything?rle=cropped）：size 為 bbox 視窗 [h, w]，offset 為視窗左上角 [x, y]，
+//   只需解碼物件範圍，不必配置整張圖大小的 mask
 // 回傳 { width, height, data: Uint8ClampedArray, offsetX, offsetY }
 export function decodeRLEToColoredImageData(rle, bbox, color) {
   const mask = decodeRLEToMask(rle)
   if (!mask) return null
 
   const [bx, by, bw, bh] = bbox.map(v => Number.isFinite(v) ? v : 0)
-  const { width: fullW, height: fullH, data: maskData } = mask
+  const [ox, oy] = Array.isArray(rle.offset) ? rle.offset : [0, 0]
+  const { width: maskW, height: maskH, data: maskData } = mask
 
-  const x0 = Math.max(0, Math.min(fullW, bx))
-  const y0 = Math.max(0, Math.min(fullH, by))
-  const x1 = Math.max(0, Math.min(fullW, bx + bw))
-  const y1 = Math.max(0, Math.min(fullH, by + bh))
+  const x0 = Math.max(ox, Math.min(ox + maskW, bx))
+  const y0 = Math.max(oy, Math.min(oy + maskH, by))
+  const x1 = Math.max(ox, Math.min(ox + maskW, bx + bw))
+  const y1 = Math.max(oy, Math.min(oy + maskH, by + bh))
 
   const w = Math.max(0, x1 - x0)
   const h = Math.max(0, y1 - y0)
@@ -57,9 +62,9 @@ export function decodeRLEToColoredImageData(rle, bbox, color) {
 
   for (let yy = 0; yy < h; yy++) {
     for (let xx = 0; xx < w; xx++) {
-      const srcX = x0 + xx
-      const srcY = y0 + yy
-      const srcIndex = srcY * fullW + srcX
+      const srcX = x0 + xx - ox
+      const srcY = y0 + yy - oy
+      const srcIndex = srcY * maskW + srcX
 
       if (maskData[srcIndex]) {
         const dstIndex = (yy * w + xx) * 4
@@ -0,0 +1,598 @@
+"""
+mask 相關的純運算工具：RLE / polygon 編碼、孔洞與碎片清理、工作解析度 mask 的裁切與放大，
+以及 segment-everything 結果的 JSON / 二進位格式。只依賴 numpy、OpenCV 與 Pillow，不載入模型、
+不讀寫資料目錄，app.py 與 batch_segment.py 的子進程共用。
+"""
+import hashlib
+import struct
+from io import BytesIO
+from typing import Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# 圖片輸入
+def image_content_hash(image_data: bytes) -> str:
+    """上傳圖片原始位元組的 SHA-256，作為各類快取的鍵。"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def decode_rgb_image(image_data: bytes) -> np.ndarray:
+    """將上傳的圖片位元組解碼為 RGB numpy array。"""
+    image = Image.open(BytesIO(image_data))
+    image = image.convert("RGB")
+    return np.array(image)
+
+
+# RLE 與輪廓（counts 與 COCO 慣例相同：從第一個像素起交替為 0 / 1 的連續長度）
+def mask_to_binary(segmentation: np.ndarray) -> np.ndarray:
+    """將 boolean / 0-1 / uint8 mask 轉成 bool（非 bool、非 uint8 時先轉 uint8，與舊版行為一致）。"""
+    if segmentation.dtype == bool:
+        return segmentation
+    if segmentation.dtype != np.uint8:
+        segmentation = segmentation.astype(np.uint8)
+    return segmentation > 0
+
+
+def _rle_counts_from_changes(change_points: np.ndarray, total: int, starts_with_one: bool) -> np.ndarray:
+    """由變化點（每段 run 的起始索引）推出 counts；首像素為 1 時第一段 0 的長度記為 0。"""
+    boundaries = np.concatenate(([0], change_points, [total]))
+    counts = np.diff(boundaries)
+    if starts_with_one:
+        counts = np.concatenate(([0], counts))
+    return counts
+
+
+def rle_counts(flat: np.ndarray) -> np.ndarray:
+    """一維 bool 向量的 RLE counts（np.diff / np.flatnonzero 變化點偵測，不逐像素迴圈）。"""
+    total = flat.size
+    if total == 0:
+        return np.zeros(1, dtype=np.int64)
+    change_points = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    return _rle_counts_from_changes(change_points, total, bool(flat[0]))
+
+
+def clip_bbox(bbox, shape) -> tuple[int, int, int, int]:
+    """將 [x, y, w, h] 限制在影像範圍 shape=(H, W, ...) 內，回傳整數 (x, y, w, h)。"""
+    img_h, img_w = shape[:2]
+    x0 = min(max(int(bbox[0]), 0), img_w)
+    y0 = min(max(int(bbox[1]), 0), img_h)
+    x1 = min(max(int(bbox[0]) + int(bbox[2]), x0), img_w)
+    y1 = min(max(int(bbox[1]) + int(bbox[3]), y0), img_h)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def mask_to_rle_array(segmentation: np.ndarray, bbox=None) -> dict:
+    """與 mask_to_rle 相同，但 counts 保留為 numpy 陣列（供二進位 / 串流輸出直接使用）。"""
+    arr = mask_to_binary(segmentation)
+
+    if bbox is not None:
+        x, y, w, h = clip_bbox(bbox, arr.shape)
+        window = arr[y:y + h, x:x + w]
+        return {
+            "size": [h, w],
+            "counts": rle_counts(window.reshape(-1)),
+            "offset": [x, y],
+        }
+
+    h, w = arr.shape[:2]
+
+    # 攤平成一維向量（row-major）後以變化點計算各段長度
+    return {
+        "size": [int(h), int(w)],
+        "counts": rle_counts(arr.reshape(-1)),
+    }
+
+
+def mask_to_rle(segmentation: np.ndarray, bbox=None) -> dict:
+    """
+    將 boolean / 0-1 mask 轉成簡單 RLE（run-length encoding），以減少傳輸量。
+    格式為：
+    {
+        "size": [height, width],
+        "counts": [run1, run2, ...]  # 按照 COCO 慣例，從第一個像素開始的連續長度交替表示 0/1
+    }
+    若提供 bbox [x, y, w, h]，則只對該視窗編碼（裁切格式）：size 為視窗的 [h, w]，
+    並多一個 "offset": [x, y] 表示視窗左上角在原圖的位置。
+    """
+    rle = mask_to_rle_array(segmentation, bbox=bbox)
+    rle["counts"] = rle["counts"].tolist()
+    return rle
+
+
+def masks_to_rle(masks, bboxes=None) -> list:
+    """
+    批次版 mask_to_rle：輸入 [N, H, W] 的 mask 堆疊（或同尺寸 mask 的 list），
+    以一次變化點偵測處理所有 mask，回傳與逐一呼叫 mask_to_rle 完全相同的 list。
+    若提供 bboxes（每個 mask 一個 [x, y, w, h]），則各自只對該視窗編碼（裁切格式，含 offset）。
+    """
+    stack = mask_to_binary(np.asarray(masks))
+    if stack.ndim != 3:
+        raise ValueError(f"masks 應為 [N, H, W]，但得到形狀: {stack.shape}")
+
+    n, h, w = stack.shape
+    if n == 0:
+        return []
+    if bboxes is None:
+        windows = None
+        sizes = [(int(h), int(w))] * n
+        flat = stack.reshape(-1)
+    else:
+        if len(bboxes) != n:
+            raise ValueError(f"bboxes 數量 ({len(bboxes)}) 與 masks 數量 ({n}) 不符")
+        windows = [clip_bbox(bbox, stack.shape[1:]) for bbox in bboxes]
+        sizes = [(wh, ww) for _, _, ww, wh in windows]
+        flat = np.concatenate(
+            [mask[y:y + wh, x:x + ww].reshape(-1) for mask, (x, y, ww, wh) in zip(stack, windows)]
+        )
+
+    # 所有視窗串成一條向量做一次變化點偵測，再依各段邊界切分並扣回各自的起點
+    totals = np.array([sh * sw for sh, sw in sizes], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(totals)[:-1]))
+    change_points = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.searchsorted(change_points, starts[1:])
+
+    results = []
+    for i, cp in enumerate(np.split(change_points, bounds)):
+        start, total = int(starts[i]), int(totals[i])
+        if total == 0:
+            counts = np.zeros(1, dtype=np.int64)
+        else:
+            counts = _rle_counts_from_changes(cp[cp != start] - start, total, bool(flat[start]))
+        rle = {"size": [sizes[i][0], sizes[i][1]], "counts": counts.tolist()}
+        if windows is not None:
+            rle["offset"] = [windows[i][0], windows[i][1]]
+        results.append(rle)
+    return results
+
+
+def mask_to_polygon_flat(segmentation: np.ndarray) -> list:
+    """
+    從二值 / bool mask 擷取最外層輪廓，回傳 Konva Line 可用的平坦座標 [x1,y1,x2,y2,...]。
+    若無有效輪廓則回傳空 list。
+    """
+    if segmentation is None or segmentation.size == 0:
+        return []
+
+    if segmentation.dtype == bool:
+        mask_u8 = (segmentation.astype(np.uint8)) * 255
+    else:
+        mask_u8 = (segmentation > 0).astype(np.uint8) * 255
+
+    contours, _ = cv2.findContours(mask_u8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return []
+
+    main = max(contours, key=cv2.contourArea)
+    if cv2.contourArea(main) < 1:
+        return []
+
+    peri = cv2.arcLength(main, True)
+    epsilon = max(0.5, 0.001 * peri)
+    approx = cv2.approxPolyDP(main, epsilon, True)
+
+    if approx is None or len(approx) < 3:
+        return []
+
+    flat = approx.reshape(-1).astype(int).tolist()
+    return [int(v) for v in flat]
+
+
+# mask 清理：孔洞與碎片（只處理前景邊界框內的像素）
+def mask_bbox(mask: np.ndarray) -> Optional[tuple[int, int, int, int]]:
+    """非零像素的邊界框 (y0, y1, x0, x1)（y1、x1 不含）；全為 0 時回傳 None。"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+
+def fill_mask_holes(mask: np.ndarray, min_hole_area: int = 0) -> np.ndarray:
+    """
+    填補 mask（非零為前景）內部的孔洞，回傳新的 mask（dtype 與輸入相同）。
+    孔洞為不與外部背景相連的背景區塊：只對前景邊界框內反轉後的區域做一次
+    connectedComponentsWithStats（4 連通）；框外皆為背景，碰到框邊緣的背景區塊即與外部相連。
+    min_hole_area > 0 時只填補面積小於此值的孔洞，較大的孔洞保留。
+    """
+    out = mask.copy()
+    roi = mask_bbox(mask)
+    if roi is None:
+        return out
+    y0, y1, x0, x1 = roi
+    crop = out[y0:y1, x0:x1]
+    background = (crop == 0).astype(np.uint8)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(background, connectivity=4)
+    left = stats[:, cv2.CC_STAT_LEFT]
+    top = stats[:, cv2.CC_STAT_TOP]
+    holes = (
+        (left > 0)
+        & (top > 0)
+        & (left + stats[:, cv2.CC_STAT_WIDTH] < x1 - x0)
+        & (top + stats[:, cv2.CC_STAT_HEIGHT] < y1 - y0)
+    )
+    holes[0] = False  # 標記 0 是前景
+    if min_hole_area > 0:
+        holes &= stats[:, cv2.CC_STAT_AREA] < min_hole_area
+    if holes.any():
+        crop[holes[labels]] = crop.max()
+    return out
+
+
+def remove_mask_islands(mask: np.ndarray, min_island_area: int) -> np.ndarray:
+    """移除 mask 中面積小於 min_island_area 的前景區塊（8 連通），回傳新的 mask（dtype 與輸入相同）。"""
+    out = mask.copy()
+    roi = mask_bbox(mask) if min_island_area > 0 else None
+    if roi is None:
+        return out
+    y0, y1, x0, x1 = roi
+    crop = out[y0:y1, x0:x1]
+    _, labels, stats, _ = cv2.connectedComponentsWithStats((crop != 0).astype(np.uint8), connectivity=8)
+    small = stats[:, cv2.CC_STAT_AREA] < min_island_area
+    small[0] = False  # 標記 0 是背景
+    if small.any():
+        crop[small[labels]] = 0
+    return out
+
+
+def clean_segmentation(segmentation: np.ndarray, bbox, min_hole_area: int, min_island_area: int):
+    """
+    清理 SamAutomaticMaskGenerator 的 mask：先移除小於 min_island_area 的碎片，再填補小於
+    min_hole_area 的孔洞（兩者為 0 時不處理）。只處理 bbox（SAM 的 [x, y, w, h]，右/下邊界包含）
+    視窗內的像素；回傳 (segmentation, bbox, area)，清理後為空時回傳 None。
+    """
+    x, y, w, h = clip_bbox([bbox[0], bbox[1], bbox[2] + 1, bbox[3] + 1], segmentation.shape)
+    window = segmentation[y:y + h, x:x + w]
+    window = remove_mask_islands(window, min_island_area)
+    if min_hole_area > 0:
+        window = fill_mask_holes(window, min_hole_area)
+    roi = mask_bbox(window)
+    if roi is None:
+        return None
+    cleaned = segmentation.copy()
+    cleaned[y:y + h, x:x + w] = window
+    y0, y1, x0, x1 = roi
+    return cleaned, [x + x0, y + y0, x1 - x0 - 1, y1 - y0 - 1], int(np.count_nonzero(window))
+
+
+# 工作解析度：大圖先縮小再自動分割，mask 只保留 bbox 視窗，輸出時才放大回原圖座標
+def work_size_scale(shape, work_size: int) -> float:
+    """工作解析度 / 原圖的縮放比例；work_size 為 0 或圖片不大於 work_size 時為 1.0。"""
+    longest = max(shape[:2])
+    if work_size <= 0 or longest <= work_size:
+        return 1.0
+    return work_size / longest
+
+
+def work_size_shape(shape, work_size: int) -> tuple[int, int]:
+    """實際分割時的圖片尺寸 (高, 寬)：縮小到工作解析度後的尺寸，不需縮小時為原圖尺寸。"""
+    height, width = shape[:2]
+    scale = work_size_scale(shape, work_size)
+    if scale >= 1.0:
+        return int(height), int(width)
+    return max(1, round(height * scale)), max(1, round(width * scale))
+
+
+def resize_to_work_size(image_array: np.ndarray, work_size: int) -> tuple[np.ndarray, float]:
+    """將圖片縮小到工作解析度（最長邊 work_size），回傳 (圖片, scale)；不需縮小時回傳原圖與 1.0。"""
+    scale = work_size_scale(image_array.shape, work_size)
+    if scale >= 1.0:
+        return image_array, 1.0
+    work_height, work_width = work_size_shape(image_array.shape, work_size)
+    work_image = cv2.resize(image_array, (work_width, work_height), interpolation=cv2.INTER_AREA)
+    return work_image, scale
+
+
+def to_work_crops(masks: list, work_shape) -> list:
+    """
+    將工作解析度 mask 的全尺寸 segmentation 換成 work_crop（bbox 視窗內的 bool 陣列）與
+    work_box (y0, y1, x0, x1)、work_shape，由 _upsample_mask_crop 在輸出時放大。原地修改並回傳 masks。
+    """
+    for m in masks:
+        segmentation = m.pop("segmentation")
+        work_box = mask_bbox(segmentation)
+        if work_box is not None:
+            y0, y1, x0, x1 = work_box
+            m["work_crop"] = segmentation[y0:y1, x0:x1].copy()
+        m["work_box"] = work_box
+        m["work_shape"] = tuple(work_shape[:2])
+    return masks
+
+
+def _upsample_mask_crop(m: dict, image_shape) -> tuple[np.ndarray, int, int]:
+    """將工作解析度的 work_crop 放大成原圖座標的 bool 視窗（線性內插後二值化，邊緣較平滑），回傳 (window, x, y)。"""
+    wy0, wy1, wx0, wx1 = m["work_box"]
+    work_h, work_w = m["work_shape"]
+    height, width = image_shape[:2]
+    sy, sx = height / work_h, width / work_w
+    y0, y1 = int(np.floor(wy0 * sy)), min(height, int(np.ceil(wy1 * sy)))
+    x0, x1 = int(np.floor(wx0 * sx)), min(width, int(np.ceil(wx1 * sx)))
+    window = cv2.resize(
+        m["work_crop"].astype(np.uint8) * 255, (x1 - x0, y1 - y0), interpolation=cv2.INTER_LINEAR
+    )
+    return window > 127, x0, y0
+
+
+def _crop_mask_record(
+    m: dict, image_shape, min_area: int, rle_format: str, min_hole_area: int, min_island_area: int
+) -> Optional[dict]:
+    """
+    工作解析度 mask 的後處理：只放大 bbox 視窗，清理、RLE、polygon 都在視窗上計算再換算回原圖座標
+    （面積、bbox 為放大後的值）。清理後為空或小於 min_area 時回傳 None。
+    """
+    if m["work_box"] is None:
+        return None
+    window, x, y = _upsample_mask_crop(m, image_shape)
+    window = remove_mask_islands(window, min_island_area)
+    if min_hole_area > 0:
+        window = fill_mask_holes(window, min_hole_area)
+    roi = mask_bbox(window)
+    if roi is None:
+        return None
+    y0, y1, x0, x1 = roi
+    window = window[y0:y1, x0:x1]
+    x, y = x + x0, y + y0
+    h, w = window.shape
+    area = int(np.count_nonzero(window))
+    if min_area > 0 and area < min_area:
+        return None
+
+    if rle_format == "cropped":
+        mask_rle = {"size": [h, w], "counts": rle_counts(window.reshape(-1)), "offset": [x, y]}
+    else:
+        full = np.zeros(image_shape[:2], dtype=bool)
+        full[y:y + h, x:x + w] = window
+        mask_rle = mask_to_rle_array(full)
+    polygon = mask_to_polygon_flat(window)
+    polygon = [v + (x if i % 2 == 0 else y) for i, v in enumerate(polygon)]
+
+    return {
+        # 與 SAM 相同的 bbox 慣例：右/下邊界包含，寬高為 x_max - x_min
+        "bbox": [x, y, w - 1, h - 1],
+        "area": area,
+        "score": _record_score(m, "predicted_iou"),
+        "stability_score": _record_score(m, "stability_score"),
+        "rle": mask_rle,
+        "polygon": polygon,
+    }
+
+
+# /segment-everything 的結果 records（rle.counts 為 numpy 陣列，輸出前再依格式轉換）
+def _record_score(m: dict, key: str) -> float:
+    """
+    取出 SAM 分數並先捨入到 float32：二進位格式（含結果快取）以 f32 儲存，
+    如此 JSON、串流與快取命中輸出的數值一致。
+    """
+    return float(np.float32(m.get(key, 0.0)))
+
+
+def iter_segment_everything_results(
+    masks_sorted,
+    max_masks: int,
+    min_area: int,
+    rle_format: str,
+    min_hole_area: int = 0,
+    min_island_area: int = 0,
+    image_shape=None,
+):
+    """
+    依 score 順序逐一後處理 SamAutomaticMaskGenerator 的結果（清理碎片與孔洞、bbox、RLE、polygon），
+    逐筆產生回傳用的 dict；rle.counts 為 numpy 陣列，輸出前再依格式轉換。
+    工作解析度產生的 mask（見 to_work_crops）在此才放大，需傳入原圖 image_shape。
+    """
+    produced = 0
+    for m in masks_sorted:
+        if "work_box" in m:
+            record = _crop_mask_record(m, image_shape, min_area, rle_format, min_hole_area, min_island_area)
+            if record is None:
+                continue
+            yield record
+            produced += 1
+            if produced >= max_masks:
+                break
+            continue
+
+        area = int(m.get("area", 0))
+        if min_area > 0 and area < min_area:
+            continue
+
+        segmentation = m["segmentation"]  # bool mask
+        bbox = m.get("bbox", None)
+
+        if bbox is None:
+            # 若 bbox 不存在，從 segmentation 推出一個 bbox
+            ys, xs = np.where(segmentation)
+            if len(xs) == 0 or len(ys) == 0:
+                continue
+            x_min, x_max = xs.min(), xs.max()
+            y_min, y_max = ys.min(), ys.max()
+            bbox = [
+                int(x_min),
+                int(y_min),
+                int(x_max - x_min + 1),
+                int(y_max - y_min + 1),
+            ]
+
+        if min_hole_area > 0 or min_island_area > 0:
+            # 清理後面積與 bbox 可能改變，min_area 以清理後的面積再判斷一次
+            cleaned = clean_segmentation(segmentation, bbox, min_hole_area, min_island_area)
+            if cleaned is None:
+                continue
+            segmentation, bbox, area = cleaned
+            if min_area > 0 and area < min_area:
+                continue
+
+        # 轉成 RLE，減少資料量（cropped 模式只編碼 bbox 視窗）
+        # SAM 的 bbox 右/下邊界為包含式，轉成 xywh 後寬高少 1，視窗需各補 1 像素才涵蓋整個物件
+        rle_window = None
+        if rle_format == "cropped":
+            rle_window = [bbox[0], bbox[1], bbox[2] + 1, bbox[3] + 1]
+        mask_rle = mask_to_rle_array(segmentation, bbox=rle_window)
+        polygon = mask_to_polygon_flat(segmentation)
+
+        yield {
+            "bbox": [int(v) for v in bbox],
+            "area": area,
+            "score": _record_score(m, "predicted_iou"),
+            "stability_score": _record_score(m, "stability_score"),
+            "rle": mask_rle,
+            "polygon": polygon,
+        }
+
+        produced += 1
+        if produced >= max_masks:
+            break
+
+
+def mask_record_to_json(record: dict) -> dict:
+    """將 iter_segment_everything_results 的結果轉成可 JSON 序列化的 dict。"""
+    out = dict(record)
+    out["rle"] = dict(record["rle"])
+    out["rle"]["counts"] = record["rle"]["counts"].tolist()
+    return out
+
+
+# 二進位 mask 格式（/segment-everything 的 application/x-layout-masks 回應、結果快取與批次分片共用）
+_MASKS_MAGIC = b"LCMK"
+_MASKS_VERSION = 1
+_POLYGON_DTYPES = {2: np.dtype("<i2"), 4: np.dtype("<i4")}
+
+
+def _encode_varints(values: np.ndarray) -> bytes:
+    """以 numpy 一次完成無號 LEB128 varint 編碼（每 7 bit 一組，最高位為延續旗標）。"""
+    v = np.asarray(values, dtype=np.uint64).reshape(-1)
+    if v.size == 0:
+        return b""
+    n_groups = max(1, (int(v.max()).bit_length() + 6) // 7)
+    shifts = np.arange(n_groups, dtype=np.uint64) * np.uint64(7)
+    groups = ((v[:, None] >> shifts[None, :]) & np.uint64(0x7F)).astype(np.uint8)
+
+    # 每個值實際需要的組數（0 也佔 1 組）
+    n_bytes = np.ones(v.size, dtype=np.int64)
+    for k in range(1, n_groups):
+        n_bytes += (v >> np.uint64(7 * k)) > 0
+
+    group_idx = np.arange(n_groups)[None, :]
+    groups[group_idx < (n_bytes[:, None] - 1)] |= 0x80
+    return groups[group_idx < n_bytes[:, None]].tobytes()
+
+
+def encode_masks_binary(records: list, rle_format: str, image_size) -> bytes:
+    """
+    將 segment-everything 的結果編成長度前綴的二進位格式（全部 little-endian）：
+
+    標頭：magic "LCMK"、u16 版本、u8 rle 格式（0=full, 1=cropped）、u8 保留、
+          u32 圖高、u32 圖寬、u32 mask 數
+    每個 mask：
+      i32 bbox[4]、u32 area、f32 score、f32 stability_score、
+      i32 offset_x、i32 offset_y、u32 rle 高、u32 rle 寬（full 格式時 offset 為 0、尺寸同原圖）、
+      u32 counts 個數、u32 counts 位元組數、counts（LEB128 varint）、
+      u8 polygon 元素位元組數（2=int16, 4=int32）、u32 polygon 座標數、polygon 座標陣列
+    """
+    img_h, img_w = image_size
+    parts = [
+        struct.pack(
+            "<4sHBBIII",
+            _MASKS_MAGIC,
+            _MASKS_VERSION,
+            1 if rle_format == "cropped" else 0,
+            0,
+            int(img_h),
+            int(img_w),
+            len(records),
+        )
+    ]
+    for rec in records:
+        rle = rec["rle"]
+        counts = np.asarray(rle["counts"])
+        offset_x, offset_y = rle.get("offset", (0, 0))
+        rle_h, rle_w = rle["size"]
+        varints = _encode_varints(counts)
+
+        polygon = np.asarray(rec["polygon"], dtype=np.int64)
+        fits_int16 = polygon.size == 0 or (polygon.min() >= -32768 and polygon.max() <= 32767)
+        poly_itemsize = 2 if fits_int16 else 4
+
+        parts.append(
+            struct.pack(
+                "<4iIff2i2III",
+                *[int(v) for v in rec["bbox"]],
+                int(rec["area"]),
+                float(rec["score"]),
+                float(rec["stability_score"]),
+                int(offset_x),
+                int(offset_y),
+                int(rle_h),
+                int(rle_w),
+                int(counts.size),
+                len(varints),
+            )
+        )
+        parts.append(varints)
+        parts.append(struct.pack("<BI", poly_itemsize, int(polygon.size)))
+        parts.append(polygon.astype(_POLYGON_DTYPES[poly_itemsize]).tobytes())
+    return b"".join(parts)
+
+
+def _decode_varints(data: bytes) -> np.ndarray:
+    """_encode_varints 的反向：以 numpy 一次解出所有無號 LEB128 varint，回傳 int64 陣列。"""
+    b = np.frombuffer(data, dtype=np.uint8)
+    if b.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero((b & 0x80) == 0)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # 每個位元組在所屬 varint 中的組序（第幾個 7 bit）
+    group = np.arange(b.size) - np.repeat(starts, ends - starts + 1)
+    values = (b & 0x7F).astype(np.uint64) << (group.astype(np.uint64) * np.uint64(7))
+    return np.add.reduceat(values, starts).astype(np.int64)
+
+
+def decode_masks_binary(data: bytes) -> tuple[list, str, list]:
+    """encode_masks_binary 的反向，回傳 (records, rle_format, image_size)；records 格式同 iter_segment_everything_results。"""
+    magic, version, rle_code, _, img_h, img_w, count = struct.unpack_from("<4sHBBIII", data, 0)
+    if magic != _MASKS_MAGIC or version != _MASKS_VERSION:
+        raise ValueError("不支援的 mask 二進位格式")
+    rle_format = "cropped" if rle_code == 1 else "full"
+    pos = struct.calcsize("<4sHBBIII")
+    record_header = struct.Struct("<4iIff2i2III")
+    polygon_header = struct.Struct("<BI")
+    records = []
+    for _ in range(count):
+        (x, y, w, h, area, score, stability, offset_x, offset_y,
+         rle_h, rle_w, n_counts, n_bytes) = record_header.unpack_from(data, pos)
+        pos += record_header.size
+        counts = _decode_varints(data[pos:pos + n_bytes])
+        pos += n_bytes
+        if counts.size != n_counts:
+            raise ValueError("mask 二進位資料損毀（counts 數量不符）")
+        poly_itemsize, n_poly = polygon_header.unpack_from(data, pos)
+        pos += polygon_header.size
+        dtype = _POLYGON_DTYPES[poly_itemsize]
+        polygon = np.frombuffer(data, dtype=dtype, count=n_poly, offset=pos)
+        pos += n_poly * poly_itemsize
+
+        rle = {"size": [rle_h, rle_w], "counts": counts}
+        if rle_format == "cropped":
+            rle["offset"] = [offset_x, offset_y]
+        records.append({
+            "bbox": [x, y, w, h],
+            "area": area,
+            "score": score,
+            "stability_score": stability,
+            "rle": rle,
+            "polygon": polygon.astype(int).tolist(),
+        })
+    return records, rle_format, [img_h, img_w]
+
+
+def cropped_rle_to_full(rle: dict, image_size) -> dict:
+    """將 cropped 格式的 RLE（bbox 視窗 + offset）轉成涵蓋整張圖的 full 格式。"""
+    h, w = rle["size"]
+    x, y = rle["offset"]
+    counts = np.asarray(rle["counts"])
+    window = np.repeat(np.arange(counts.size) % 2 == 1, counts).reshape(h, w)
+    full = np.zeros((int(image_size[0]), int(image_size[1])), dtype=bool)
+    full[y:y + h, x:x + w] = window
+    return {"size": [int(image_size[0]), int(image_size[1])], "counts": rle_counts(full.reshape(-1))}
@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app 在 import 時就會建立資料目錄與 SQLite 任務存放，測試一律改放到暫存目錄
+os.environ.setdefault("LAYOUT_CUT_DATA_DIR", tempfile.mkdtemp(prefix="layout_cut_test_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    """每個測試各自一份空的影片任務存放。"""
+    return app._VideoJobStore(
+        str(tmp_path / "video_jobs.sqlite3"),
+        str(tmp_path / "videos"),
+        ttl_sec=3600,
+        max_bytes=1024 * 1024 * 1024,
+    )
@@ -0,0 +1,147 @@
+"""_download_video_from_gcs_uri 對假 GCS client：分段寫入任務存放、大小與 MD5 校驗失敗時捨棄暫存檔並使任務失敗。"""
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+VIDEO = bytes(range(256)) * 41  # 10,496 bytes
+
+
+class FakeBlob:
+    def __init__(self, data: bytes, md5_hash=None, size=None, content_type="video/mp4"):
+        self.data = data
+        self.size = len(data) if size is None else size
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode("ascii") if md5_hash is None else md5_hash
+        self.content_type = content_type
+        self.reads = []
+        self.open_chunk_size = None
+
+    def open(self, mode, chunk_size=None):
+        assert mode == "rb"
+        self.open_chunk_size = chunk_size
+        blob = self
+
+        class Reader(io.BytesIO):
+            def read(self, n=-1):
+                chunk = super().read(n)
+                blob.reads.append(len(chunk))
+                return chunk
+
+        return Reader(self.data)
+
+
+class FakeGcsClient:
+    def __init__(self, blobs: dict):
+        self.blobs = blobs
+
+    def bucket(self, name):
+        return SimpleNamespace(get_blob=lambda path: self.blobs.get(f"{name}/{path}"))
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(app, "VEO_GCS_CHUNK_BYTES", 1000)
+
+
+def _video_dir_files(store):
+    return sorted(os.listdir(store.video_dir))
+
+
+def test_streams_chunks_into_store(store, small_chunks):
+    blob = FakeBlob(VIDEO, content_type="video/webm")
+    client = FakeGcsClient({"bucket/out/video.webm": blob})
+
+    sha, size, mime = app._download_video_from_gcs_uri("gs://bucket/out/video.webm", store, client=client)
+
+    assert blob.open_chunk_size == 1000
+    assert blob.reads == [1000] * 10 + [496, 0]
+    assert (sha, size, mime) == (hashlib.sha256(VIDEO).hexdigest(), len(VIDEO), "video/webm")
+    assert _video_dir_files(store) == [f"{sha}.webm"]
+    with open(store.video_path(sha, mime), "rb") as f:
+        assert f.read() == VIDEO
+
+
+def test_md5_mismatch_discards_temp_file(store, small_chunks):
+    wrong_md5 = base64.b64encode(hashlib.md5(b"other").digest()).decode("ascii")
+    client = FakeGcsClient({"bucket/video.mp4": FakeBlob(VIDEO, md5_hash=wrong_md5)})
+
+    with pytest.raises(RuntimeError, match="MD5"):
+        app._download_video_from_gcs_uri("gs://bucket/video.mp4", store, client=client)
+    assert _video_dir_files(store) == []
+
+
+def test_size_mismatch_discards_temp_file(store, small_chunks):
+    client = FakeGcsClient({"bucket/video.mp4": FakeBlob(VIDEO, size=len(VIDEO) + 1)})
+
+    with pytest.raises(RuntimeError, match="大小不符"):
+        app._download_video_from_gcs_uri("gs://bucket/video.mp4", store, client=client)
+    assert _video_dir_files(store) == []
+
+
+def test_composite_object_without_md5_is_accepted(store, small_chunks):
+    client = FakeGcsClient({"bucket/video.mp4": FakeBlob(VIDEO, md5_hash="")})
+
+    sha, size, _ = app._download_video_from_gcs_uri("gs://bucket/video.mp4", store, client=client)
+    assert size == len(VIDEO)
+    assert _video_dir_files(store) == [f"{sha}.mp4"]
+
+
+def test_missing_object_and_bad_uri(store):
+    client = FakeGcsClient({})
+    with pytest.raises(FileNotFoundError):
+        app._download_video_from_gcs_uri("gs://bucket/missing.mp4", store, client=client)
+    with pytest.raises(ValueError):
+        app._download_video_from_gcs_uri("https://example.com/video.mp4", store, client=client)
+    with pytest.raises(ValueError):
+        app._download_video_from_gcs_uri("gs://bucket-only", store, client=client)
+
+
+def test_md5_mismatch_fails_job(store, small_chunks, monkeypatch):
+    """排程器輪詢到完成、影片只有 GCS URI 且校驗失敗：任務標記失敗且不留下任何影片檔。"""
+    wrong_md5 = base64.b64encode(hashlib.md5(b"other").digest()).decode("ascii")
+    monkeypatch.setattr(app, "_gcs_client", FakeGcsClient({"bucket/video.mp4": FakeBlob(VIDEO, md5_hash=wrong_md5)}))
+
+    video = SimpleNamespace(video_bytes=None, mime_type="video/mp4", uri="gs://bucket/video.mp4")
+    done = SimpleNamespace(
+        name="operations/1",
+        done=True,
+        error=None,
+        response=SimpleNamespace(generated_videos=[SimpleNamespace(video=video)]),
+        result=None,
+    )
+    genai_client = SimpleNamespace(operations=SimpleNamespace(get=lambda operation: done))
+    store.create("job-1", status="running", gcp_operation_name="operations/1")
+    store.update("job-1", lease_until=time.time() - 1)
+
+    async def scenario():
+        scheduler = app._VeoScheduler(
+            store,
+            lambda: genai_client,
+            operation_factory=lambda name: SimpleNamespace(name=name),
+            poll_initial=0.01,
+            poll_max=0.01,
+            backoff=1.0,
+            concurrency=1,
+            min_interval=0.0,
+            max_errors=1,
+        )
+        await scheduler.start()
+        deadline = time.monotonic() + 5
+        while store.get("job-1")["status"] in app._VIDEO_JOB_ACTIVE_STATUSES:
+            assert time.monotonic() < deadline, "等待逾時"
+            await asyncio.sleep(0.005)
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+    job = store.get("job-1")
+    assert job["status"] == "failed"
+    assert "MD5" in job["error"]
+    assert job["video_sha256"] is None
+    assert _video_dir_files(store) == []
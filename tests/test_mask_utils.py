@@ -0,0 +1,60 @@
+"""mask_utils.masks_to_rle 與逐一呼叫 mask_to_rle 的結果須完全相同（含全 0、全 1 與裁切格式）。"""
+import json
+
+import numpy as np
+import pytest
+
+import mask_utils
+
+
+def _stack(h=23, w=31, seed=0):
+    rng = np.random.default_rng(seed)
+    masks = [
+        np.zeros((h, w), dtype=bool),
+        np.ones((h, w), dtype=bool),
+        rng.random((h, w)) > 0.5,
+        np.zeros((h, w), dtype=bool),
+    ]
+    masks[3][5:12, 7:20] = True
+    masks[3][0, 0] = True
+    masks.append(np.zeros((h, w), dtype=bool))
+    masks[4][-1, -1] = True
+    return np.stack(masks)
+
+
+def _dumps(rles):
+    return json.dumps(rles).encode("utf-8")
+
+
+@pytest.mark.parametrize("dtype", [bool, np.uint8, np.float32])
+def test_full_frame_matches_per_mask(dtype):
+    stack = _stack().astype(dtype)
+    expected = [mask_utils.mask_to_rle(mask) for mask in stack]
+    assert _dumps(mask_utils.masks_to_rle(stack)) == _dumps(expected)
+
+
+def test_cropped_matches_per_mask():
+    stack = _stack()
+    bboxes = []
+    for mask in stack:
+        roi = mask_utils.mask_bbox(mask)
+        if roi is None:
+            bboxes.append([0, 0, 0, 0])
+        else:
+            y0, y1, x0, x1 = roi
+            bboxes.append([x0, y0, x1 - x0, y1 - y0])
+    # 額外測試超出影像範圍的框會被裁切
+    bboxes[2] = [-5, 10, 100, 100]
+
+    expected = [mask_utils.mask_to_rle(mask, bbox=bbox) for mask, bbox in zip(stack, bboxes)]
+    assert _dumps(mask_utils.masks_to_rle(stack, bboxes=bboxes)) == _dumps(expected)
+
+
+def test_single_and_empty_stacks():
+    ones = np.ones((1, 4, 5), dtype=bool)
+    assert mask_utils.masks_to_rle(ones) == [mask_utils.mask_to_rle(ones[0])]
+    assert mask_utils.masks_to_rle(np.zeros((0, 4, 5), dtype=bool)) == []
+    with pytest.raises(ValueError):
+        mask_utils.masks_to_rle(np.zeros((4, 5), dtype=bool))
+    with pytest.raises(ValueError):
+        mask_utils.masks_to_rle(ones, bboxes=[])
@@ -0,0 +1,97 @@
+"""/segment-everything 的結果快取：同一張圖在快取未命中與命中時回傳的內容須完全相同。"""
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import app
+
+H, W = 60, 80
+
+
+def _png_bytes():
+    buf = BytesIO()
+    Image.fromarray(np.random.default_rng(0).integers(0, 255, (H, W, 3), dtype=np.uint8)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def _fake_masks():
+    """三個矩形 mask；分數刻意使用 float32 無法精確表示的 float64 值。"""
+    masks = []
+    for i, (x, y, w, h) in enumerate([(5, 5, 30, 20), (40, 10, 25, 40), (10, 35, 20, 15)]):
+        seg = np.zeros((H, W), dtype=bool)
+        seg[y:y + h, x:x + w] = True
+        masks.append({
+            "segmentation": seg,
+            "area": int(seg.sum()),
+            "bbox": [x, y, w - 1, h - 1],
+            "predicted_iou": 0.987654321123 - i * 0.1,
+            "stability_score": 0.912345678987 - i * 0.01,
+        })
+    return masks
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    calls = []
+
+    def generate(image_array, work_size):
+        calls.append(work_size)
+        return _fake_masks(), 1.0
+
+    # 只提供 _segment_cache_key 讀取的設定
+    generator = SimpleNamespace(
+        point_grids=[np.zeros((16, 2))],
+        points_per_batch=64,
+        pred_iou_thresh=0.88,
+        stability_score_thresh=0.95,
+        stability_score_offset=1.0,
+        box_nms_thresh=0.7,
+        crop_n_layers=0,
+        crop_nms_thresh=0.7,
+        crop_overlap_ratio=512 / 1500,
+        min_mask_region_area=0,
+    )
+    monkeypatch.setattr(app, "mask_generator", generator)
+    monkeypatch.setattr(app, "_generate_masks_at_work_size", generate)
+    monkeypatch.setattr(
+        app,
+        "_segment_result_cache",
+        app._SegmentResultCache(64 << 20, str(tmp_path / "segment_cache"), 64 << 20),
+    )
+    test_client = TestClient(app.app)
+    test_client.calls = calls
+    return test_client
+
+
+def _post(client, query):
+    return client.post(
+        f"/segment-everything?work_size=0&{query}", files={"file": ("a.png", _png_bytes(), "image/png")}
+    )
+
+
+@pytest.mark.parametrize("query", ["rle=full", "rle=cropped", "rle=cropped&stream=1"])
+def test_hit_and_miss_return_identical_payload(client, query):
+    miss = _post(client, query)
+    hit = _post(client, query)
+
+    assert miss.status_code == hit.status_code == 200
+    assert (miss.headers["x-segment-cache"], hit.headers["x-segment-cache"]) == ("miss", "hit")
+    assert client.calls == [0]
+    assert miss.content == hit.content
+
+
+def test_disk_hit_matches_miss(client):
+    miss = _post(client, "rle=full")
+    cache = app._segment_result_cache
+    with cache._lock:
+        cache._entries.clear()
+        cache._bytes = 0
+    disk_hit = _post(client, "rle=full")
+
+    assert disk_hit.headers["x-segment-cache"] == "hit"
+    assert cache.disk_hits == 1
+    assert miss.content == disk_hit.content
@@ -0,0 +1,259 @@
+"""_VeoScheduler 對本機假 genai client 的行為：送出、退避輪詢、失敗上限、取消與接手孤兒任務。"""
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+VIDEO_BYTES = b"\x00\x00\x00\x18ftypmp42fake-video"
+
+
+def _operation(name: str, done: bool):
+    response = None
+    if done:
+        video = SimpleNamespace(video_bytes=VIDEO_BYTES, mime_type="video/mp4", uri=None)
+        response = SimpleNamespace(generated_videos=[SimpleNamespace(video=video)])
+    return SimpleNamespace(name=name, done=done, error=None, response=response, result=None)
+
+
+class FakeOperations:
+    """operations.get 依 script 逐次回傳：'running'、'done' 或拋出其中的例外；用完後一律完成。"""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = []
+
+    def get(self, operation):
+        self.calls.append(operation.name)
+        step = self.script.pop(0) if self.script else "done"
+        if isinstance(step, Exception):
+            raise step
+        return _operation(operation.name, done=step == "done")
+
+
+class FakeModels:
+    def __init__(self):
+        self.requests = []
+        self.before_return = None
+
+    def generate_videos(self, **kwargs):
+        self.requests.append(kwargs)
+        if self.before_return is not None:
+            self.before_return()
+        return _operation(f"operations/{len(self.requests)}", done=False)
+
+
+class FakeGenaiClient:
+    def __init__(self, script=()):
+        self.models = FakeModels()
+        self.operations = FakeOperations(script)
+
+
+def _fake_submit(client, job_id, image_bytes, prompt):
+    """取代 _submit_veo_operation（需要 google-genai 的型別），直接呼叫假 client。"""
+    operation = client.models.generate_videos(model=app.VEO_MODEL_ID, prompt=prompt, image_bytes=image_bytes)
+    return operation, None
+
+
+def _scheduler(store, client, **overrides):
+    """建立使用假 client 的排程器，並記錄每次排入 heap 的輪詢延遲。"""
+    settings = dict(poll_initial=0.01, poll_max=0.05, backoff=2.0, concurrency=2, min_interval=0.0, max_errors=3)
+    settings.update(overrides)
+    scheduler = app._VeoScheduler(
+        store,
+        lambda: client,
+        operation_factory=lambda name: SimpleNamespace(name=name),
+        submit_operation=_fake_submit,
+        **settings,
+    )
+    delays = []
+    push = scheduler._push
+
+    def recording_push(job_id, delay):
+        delays.append(delay)
+        push(job_id, delay)
+
+    scheduler._push = recording_push
+    return scheduler, delays
+
+
+async def _wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("等待逾時")
+        await asyncio.sleep(0.005)
+
+
+async def _wait_for_finish(store, job_id):
+    await _wait_until(lambda: store.get(job_id)["status"] not in app._VIDEO_JOB_ACTIVE_STATUSES)
+    return store.get(job_id)
+
+
+def test_submit_polls_with_backoff_until_done(store):
+    client = FakeGenaiClient(["running"] * 4)
+
+    async def scenario():
+        scheduler, delays = _scheduler(store, client)
+        await scheduler.start()
+        store.create("job-1", status="pending", prompt="wave")
+        scheduler.submit("job-1", b"png", "wave")
+        job = await _wait_for_finish(store, "job-1")
+        await scheduler.stop()
+        return job, delays
+
+    job, delays = asyncio.run(scenario())
+    # 第一次輪詢在 poll_initial 後，之後每次乘上 backoff，直到 poll_max
+    assert delays == pytest.approx([0.01, 0.02, 0.04, 0.05, 0.05])
+    assert job["status"] == "completed"
+    assert job["gcp_operation_name"] == "operations/1"
+    assert client.models.requests[0]["prompt"] == "wave"
+    assert client.operations.calls == ["operations/1"] * 5
+    with open(store.get_video_path(job), "rb") as f:
+        assert f.read() == VIDEO_BYTES
+
+
+def test_transient_poll_errors_double_interval_and_recover(store):
+    client = FakeGenaiClient([ConnectionError("reset"), ConnectionError("reset"), "done"])
+
+    async def scenario():
+        scheduler, delays = _scheduler(store, client)
+        await scheduler.start()
+        store.create("job-1", status="pending")
+        scheduler.submit("job-1", b"png", "wave")
+        job = await _wait_for_finish(store, "job-1")
+        await scheduler.stop()
+        return job, delays
+
+    job, delays = asyncio.run(scenario())
+    assert delays == pytest.approx([0.01, 0.02, 0.04])
+    assert job["status"] == "completed"
+
+
+def test_poll_fails_job_after_max_errors(store):
+    client = FakeGenaiClient([RuntimeError("quota exceeded")] * 10)
+
+    async def scenario():
+        scheduler, delays = _scheduler(store, client, max_errors=3)
+        await scheduler.start()
+        store.create("job-1", status="pending")
+        scheduler.submit("job-1", b"png", "wave")
+        job = await _wait_for_finish(store, "job-1")
+        await asyncio.sleep(0.1)
+        stats = scheduler.stats()
+        await scheduler.stop()
+        return job, delays, stats
+
+    job, delays, stats = asyncio.run(scenario())
+    assert job["status"] == "failed"
+    assert job["error"] == "quota exceeded"
+    assert len(client.operations.calls) == 3
+    assert delays == pytest.approx([0.01, 0.02, 0.04])
+    assert stats["waiting"] == 0 and stats["in_flight"] == 0
+
+
+def test_cancel_between_submit_and_storing_operation_name(store):
+    """另一個 worker 在 generate_videos 回傳、作業名稱寫入前處理了 DELETE：任務維持取消且不輪詢。"""
+    client = FakeGenaiClient(["running"] * 10)
+    client.models.before_return = lambda: store.update(
+        "job-1", active_only=True, status="cancelled", message="已取消", lease_until=None
+    )
+
+    async def scenario():
+        scheduler, delays = _scheduler(store, client)
+        await scheduler.start()
+        store.create("job-1", status="pending")
+        scheduler.submit("job-1", b"png", "wave")
+        await _wait_until(lambda: "job-1" not in scheduler._tasks)
+        await asyncio.sleep(0.1)
+        stats = scheduler.stats()
+        await scheduler.stop()
+        return delays, stats
+
+    delays, stats = asyncio.run(scenario())
+    job = store.get("job-1")
+    assert job["status"] == "cancelled"
+    assert job["gcp_operation_name"] is None
+    assert client.operations.calls == []
+    assert delays == []
+    assert stats["waiting"] == 0 and stats["in_flight"] == 0
+
+
+def test_cancel_while_submit_in_flight(store):
+    """同一 worker 處理 DELETE（寫入取消並呼叫 cancel()）時 generate_videos 仍在執行緒中。"""
+    client = FakeGenaiClient(["running"] * 10)
+    release = threading.Event()
+    client.models.before_return = lambda: release.wait(5)
+
+    async def scenario():
+        scheduler, delays = _scheduler(store, client)
+        await scheduler.start()
+        store.create("job-1", status="pending")
+        scheduler.submit("job-1", b"png", "wave")
+        await _wait_until(lambda: client.models.requests)
+        store.update("job-1", active_only=True, status="cancelled", message="已取消", lease_until=None)
+        found = scheduler.cancel("job-1")
+        release.set()
+        await asyncio.sleep(0.1)
+        stats = scheduler.stats()
+        await scheduler.stop()
+        return found, delays, stats
+
+    found, delays, stats = asyncio.run(scenario())
+    assert found
+    job = store.get("job-1")
+    assert job["status"] == "cancelled"
+    assert job["gcp_operation_name"] is None
+    assert client.operations.calls == []
+    assert delays == []
+    assert stats["waiting"] == 0 and stats["in_flight"] == 0
+
+
+def test_cancel_stops_polling(store):
+    client = FakeGenaiClient(["running"] * 100)
+
+    async def scenario():
+        scheduler, _ = _scheduler(store, client, poll_max=0.01)
+        await scheduler.start()
+        store.create("job-1", status="pending")
+        scheduler.submit("job-1", b"png", "wave")
+        await _wait_until(lambda: len(client.operations.calls) >= 2)
+        store.update("job-1", active_only=True, status="cancelled", message="已取消", lease_until=None)
+        found = scheduler.cancel("job-1")
+        polls = len(client.operations.calls)
+        await asyncio.sleep(0.1)
+        await scheduler.stop()
+        return found, polls
+
+    found, polls = asyncio.run(scenario())
+    assert found
+    assert len(client.operations.calls) == polls
+    assert store.get("job-1")["status"] == "cancelled"
+
+
+def test_adopts_orphaned_jobs(store):
+    client = FakeGenaiClient(["running"])
+    # 兩個租約已過期的進行中任務：一個已送出（有作業名稱），一個尚未送出
+    store.create("orphan", status="running", gcp_operation_name="operations/orphan")
+    store.update("orphan", lease_until=time.time() - 1)
+    store.create("unsent", status="pending")
+    store.update("unsent", lease_until=time.time() - 1)
+
+    async def scenario():
+        scheduler, delays = _scheduler(store, client)
+        await scheduler.start()
+        orphan = await _wait_for_finish(store, "orphan")
+        unsent = await _wait_for_finish(store, "unsent")
+        await scheduler.stop()
+        return orphan, unsent, delays
+
+    orphan, unsent, delays = asyncio.run(scenario())
+    assert orphan["status"] == "completed"
+    assert client.operations.calls == ["operations/orphan"] * 2
+    assert delays == pytest.approx([0, 0.02])
+    assert unsent["status"] == "failed"
+    assert unsent["error"] == "INTERRUPTED"
+    assert client.models.requests == []
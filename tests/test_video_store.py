@@ -0,0 +1,56 @@
+"""_VideoJobStore.write_video 沿用既有影片檔時，不可在任務引用前被 evict 當成孤兒刪除。"""
+import os
+import threading
+import time
+
+import app
+
+VIDEO = b"\x00\x00\x00\x18ftypmp42same-content"
+
+
+def _age(path, seconds):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_reused_file_survives_evict_until_referenced(store):
+    sha, _ = store.write_video([VIDEO], "video/mp4")
+    path = store.video_path(sha, "video/mp4")
+    # 已無任務引用且超過寬限期的舊檔：下一次 evict 本來就會刪除
+    _age(path, app._VIDEO_ORPHAN_GRACE_SEC + 60)
+
+    assert store.write_video([VIDEO], "video/mp4")[0] == sha
+    assert store.evict()["removed_files"] == 0
+
+    store.create("job-1", status="running")
+    assert store.complete_with_video("job-1", sha, len(VIDEO), "video/mp4")
+    assert store.get_video_path(store.get("job-1")) == path
+    assert os.listdir(store.video_dir) == [os.path.basename(path)]
+
+
+def test_write_video_waits_for_concurrent_evict(store, monkeypatch):
+    """evict 已判定舊檔為孤兒、尚未刪除時另一執行緒寫入相同內容：影片檔最後仍須存在。"""
+    sha, _ = store.write_video([VIDEO], "video/mp4")
+    path = store.video_path(sha, "video/mp4")
+    _age(path, app._VIDEO_ORPHAN_GRACE_SEC + 60)
+
+    about_to_remove = threading.Event()
+    remove = os.remove
+
+    def slow_remove(target):
+        if threading.current_thread().name == "evict" and target == path:
+            about_to_remove.set()
+            time.sleep(0.3)
+        remove(target)
+
+    monkeypatch.setattr(os, "remove", slow_remove)
+    evictor = threading.Thread(target=store.evict, name="evict")
+    evictor.start()
+    assert about_to_remove.wait(5)
+
+    assert store.write_video([VIDEO], "video/mp4")[0] == sha
+    evictor.join(5)
+
+    store.create("job-1", status="running")
+    assert store.complete_with_video("job-1", sha, len(VIDEO), "video/mp4")
+    assert store.get_video_path(store.get("job-1")) == path